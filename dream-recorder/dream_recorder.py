@@ -7,13 +7,28 @@ monkey.patch_all()
 import os
 import logging
 import gevent
+from gevent.event import Event
 import io
 import argparse
+import atexit
+import html
+import time
 
-from flask import Flask, render_template, jsonify, request, send_file
+from flask import Flask, render_template, jsonify, request, send_file, redirect, Response, stream_with_context
 from flask_socketio import SocketIO, emit
-from functions.dream_db import DreamDB
+from functions.dream_db import LIST_COLUMNS, SNIPPET_START, SNIPPET_END
+from functions.db_threadpool import ThreadedDreamDB
 from functions.audio import create_wav_file, process_audio
+from functions.media_gc import run_media_gc
+from functions.app_lock import acquire_app_lock
+from functions.storage import storage_usage
+from functions.library_archive import iter_export
+from functions.metrics import (
+    AUDIO_BYTES, CONTENT_TYPE, SOCKETIO_CLIENTS, render_metrics, run_loop_lag_monitor, update_storage_gauges,
+)
+from functions.media_backend import get_media_backend, PROXY_HEADERS, STREAM_CHUNK_SIZE
+from functions.media_layout import MEDIA_KINDS
+from functions.video import thumbnail_variant_filename, SPRITE_COLUMNS, SPRITE_ROWS
 from functions.config_loader import load_config, get_config
 
 # Configure logging
@@ -35,7 +50,7 @@ recording_state = {
 
 # Video playback state
 video_playback_state = {
-    'current_index': 0,  # Index of the current video being played
+    'current_dream_id': None,  # ID of the dream currently being played
     'is_playing': False  # Whether a video is currently playing
 }
 
@@ -61,8 +76,12 @@ app.config.update(
 # Initialize SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
 
-# Initialize DreamDB
-dream_db = DreamDB()
+# Initialize DreamDB and close its pooled connections on shutdown. Queries run on
+# worker threads so SQLite never blocks the gevent event loop.
+dream_db = ThreadedDreamDB()
+atexit.register(dream_db.close)
+# Set on deletions so the media reaper removes their files without waiting for its next pass
+media_gc_wakeup = Event()
 
 # =============================
 # Core Logic / Helper Functions
@@ -98,6 +117,18 @@ def init_sample_dreams_if_missing():
     except Exception as e:
         print(f"Exception while initializing sample dreams: {e}")
 
+@app.template_filter('thumb_srcset')
+def thumb_srcset(dream):
+    """Build an <img> srcset from the thumbnail sizes stored with a dream."""
+    if not dream.get('thumb_sizes') or not dream.get('thumb_filename'):
+        return ''
+    sizes = [int(s) for s in dream['thumb_sizes'].split(',')]
+    entries = []
+    for size in sizes:
+        filename = dream['thumb_filename'] if size == sizes[-1] else thumbnail_variant_filename(dream['thumb_filename'], size)
+        entries.append(f"/media/thumbs/{filename} {size}w")
+    return ', '.join(entries)
+
 # =============================
 # SocketIO Event Handlers
 # =============================
@@ -105,6 +136,7 @@ def init_sample_dreams_if_missing():
 @socketio.on('connect')
 def handle_connect(auth=None):
     """Handle new client connection."""
+    SOCKETIO_CLIENTS.inc()
     if logger:
         logger.info('Client connected')
     emit('state_update', recording_state)
@@ -112,6 +144,7 @@ def handle_connect(auth=None):
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection."""
+    SOCKETIO_CLIENTS.dec()
     if logger:
         logger.info('Client disconnected')
 
@@ -136,6 +169,7 @@ def handle_audio_data(data):
             audio_bytes = bytes(data['data'])
             # Store the chunk
             audio_chunks.append(audio_bytes)
+            AUDIO_BYTES.inc(len(audio_bytes))
         except Exception as e:
             if logger:
                 logger.error(f"Error handling audio data: {str(e)}")
@@ -170,33 +204,30 @@ def handle_stop_recording():
 def handle_show_previous_dream():
     """Socket event handler for showing previous dream."""
     try:
-        # Get the most recent dreams
-        dreams = dream_db.get_all_dreams()
-        if not dreams:
+        # If we're currently playing a video, step to the next older one (wrapping around)
+        if video_playback_state['is_playing'] and video_playback_state['current_dream_id'] is not None:
+            dream_id = dream_db.get_adjacent_dream_id(video_playback_state['current_dream_id'])
+        else:
+            # If not playing, start with the most recent dream
+            dream_id = dream_db.get_latest_dream_id()
+        if dream_id is None:
             if logger:
                 logger.warning("No dreams found to cycle through.")
             return None
-        # If we're currently playing a video, show the next one in sequence
-        if video_playback_state['is_playing']:
-            video_playback_state['current_index'] += 1
-            if video_playback_state['current_index'] >= len(dreams):
-                video_playback_state['current_index'] = 0  # Wrap around
-        else:
-            # If not playing, start with the most recent dream
-            video_playback_state['current_index'] = 0
-            video_playback_state['is_playing'] = True
-        # Get the dream at the current index
-        dream = dreams[video_playback_state['current_index']]
+        video_playback_state['current_dream_id'] = dream_id
+        video_playback_state['is_playing'] = True
+        dream = dream_db.get_dream(dream_id)
+        if not dream:
+            socketio.emit('error', {'message': 'No dreams found'})
+            return None
+        dream_db.mark_played(dream_id)
         # Emit the video URL to the client
         socketio.emit('play_video', {
             'video_url': f"/media/video/{dream['video_filename']}",
             'loop': True  # Enable looping for the video
         })
         if logger:
-            logger.info(f"Emitted play_video for dream index {video_playback_state['current_index']}: {dream['video_filename']}")
-
-        if not dream:
-            socketio.emit('error', {'message': 'No dreams found'})
+            logger.info(f"Emitted play_video for dream {dream_id}: {dream['video_filename']}")
     except Exception as e:
         if logger:
             logger.error(f"Error in socket handle_show_previous_dream: {str(e)}")
@@ -214,11 +245,21 @@ def index():
                          is_development=app.config['DEBUG'],
                          total_background_images=int(get_config()["TOTAL_BACKGROUND_IMAGES"]))
 
+def page_cursor(dreams, limit):
+    """The keyset cursor (the last dream's id and created_at) for the page after a full one.
+
+    Both values are None after a short page, as there is nothing left to load.
+    """
+    last = dreams[-1] if dreams and len(dreams) >= limit else {}
+    return {'next_before_id': last.get('id'), 'next_before_created_at': last.get('created_at')}
+
 @app.route('/dreams')
 def dreams():
     """Display the dreams library page."""
-    dreams = dream_db.get_all_dreams()
-    return render_template('dreams.html', dreams=dreams)
+    page_size = int(get_config().get('DREAMS_PAGE_SIZE', 50))
+    dreams = dream_db.list_dreams(limit=page_size, columns=LIST_COLUMNS)
+    return render_template('dreams.html', dreams=dreams, page_size=page_size, next_before=page_cursor(dreams, page_size),
+                           sprite_columns=SPRITE_COLUMNS, sprite_rows=SPRITE_ROWS)
 
 # -- API Routes --
 @app.route('/api/config')
@@ -238,6 +279,29 @@ def api_get_config():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/dreams')
+def api_list_dreams():
+    """Return one page of dreams (newest first) for infinite scrolling."""
+    try:
+        page_size = int(get_config().get('DREAMS_PAGE_SIZE', 50))
+        limit = min(max(request.args.get('limit', page_size, type=int), 1), 500)
+        dreams = dream_db.list_dreams(
+            limit=limit,
+            before_id=request.args.get('before_id', type=int),
+            before_created_at=request.args.get('before_created_at'),
+            columns=LIST_COLUMNS,
+        )
+        for dream in dreams:
+            dream['thumb_srcset'] = thumb_srcset(dream)
+        return jsonify({
+            'dreams': dreams,
+            **page_cursor(dreams, limit),
+        })
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API list_dreams: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/gpio_single_tap', methods=['POST'])
 def gpio_single_tap():
     """API endpoint for single tap from GPIO controller."""
@@ -262,34 +326,162 @@ def gpio_double_tap():
             logger.error(f"Error in API gpio_double_tap: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/dreams/search')
+def api_search_dreams():
+    """Full-text search over the prompts, returning ranked pages with highlighted snippets."""
+    try:
+        query = request.args.get('q', '').strip()
+        page_size = int(get_config().get('DREAMS_PAGE_SIZE', 50))
+        limit = min(max(request.args.get('limit', page_size, type=int), 1), 500)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        results = dream_db.search_dreams(query, limit=limit, offset=offset) if query else []
+        for dream in results:
+            dream['thumb_srcset'] = thumb_srcset(dream)
+            # Escape the prompt text, then turn the hit markers into <mark> tags
+            snippet = html.escape(dream.pop('snippet') or '')
+            dream['snippet_html'] = snippet.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+        return jsonify({
+            'results': results,
+            'next_offset': offset + limit if len(results) == limit else None,
+        })
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API search_dreams: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dreams/<int:dream_id>', methods=['GET'])
+def get_dream_details(dream_id):
+    """Return a single dream with its full prompts (loaded when the modal opens)."""
+    try:
+        dream = dream_db.get_dream(dream_id)
+        if not dream:
+            return jsonify({'error': 'Dream not found'}), 404
+        return jsonify(dream)
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API get_dream_details: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dreams/<int:dream_id>/similar')
+def api_similar_dreams(dream_id):
+    """Return the dreams whose prompts are closest to the given dream's."""
+    try:
+        if str(get_config().get('SIMILAR_DREAMS_ENABLED', True)).lower() not in ('1', 'true', 'yes'):
+            return jsonify({'dreams': []})
+        k = min(max(request.args.get('k', 10, type=int), 1), 50)
+        dreams = dream_db.similar_dreams(dream_id, k=k)
+        for dream in dreams:
+            dream['thumb_srcset'] = thumb_srcset(dream)
+        return jsonify({'dreams': dreams})
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API similar_dreams: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dreams/<int:dream_id>/played', methods=['POST'])
+def api_mark_played(dream_id):
+    """Record that a dream was played in the library, keeping it off the storage eviction list."""
+    try:
+        dream_db.mark_played(dream_id)
+        return jsonify({'success': True})
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API mark_played: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/storage')
+def api_storage():
+    """Report media storage usage per directory against the quota and the free disk space."""
+    try:
+        return jsonify(storage_usage())
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API storage: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stats')
+def api_stats():
+    """Report dreams per day, prompt lengths, generation times and failure rates from the summary tables."""
+    try:
+        days = min(max(request.args.get('days', 30, type=int), 1), 366)
+        return jsonify(dream_db.get_stats(days=days))
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dreams/<int:dream_id>/trace')
+def api_dream_trace(dream_id):
+    """Return the stage timings of the pipeline run that produced a dream."""
+    try:
+        trace = dream_db.get_dream_trace(dream_id)
+        if not trace:
+            return jsonify({'error': 'No trace for this dream'}), 404
+        return jsonify(trace)
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API dream_trace: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/traces')
+def api_traces():
+    """List recent pipeline runs, newest first; ?failed=1 shows only runs that produced no dream."""
+    try:
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+        failed = request.args.get('failed')
+        if failed is not None:
+            failed = failed.lower() in ('1', 'true', 'yes')
+        return jsonify({'traces': dream_db.list_traces(limit=limit, failed=failed)})
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API traces: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/traces/<trace_id>')
+def api_trace(trace_id):
+    """Return one pipeline run's spans, including runs that failed before saving a dream."""
+    try:
+        trace = dream_db.get_trace(trace_id)
+        if not trace:
+            return jsonify({'error': 'Trace not found'}), 404
+        return jsonify(trace)
+    except Exception as e:
+        if logger:
+            logger.error(f"Error in API trace: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics')
+def metrics():
+    """Expose pipeline, API, database, storage and event loop metrics in the Prometheus text format."""
+    try:
+        update_storage_gauges(storage_usage)
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not measure media storage: {str(e)}")
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+@app.route('/api/export')
+def api_export():
+    """Stream the whole library as a ZIP (dream rows as NDJSON plus their media); ?media=0 exports rows only."""
+    include_media = request.args.get('media', 'true').lower() in ('1', 'true', 'yes')
+    filename = f"dream-library-{time.strftime('%Y%m%d-%H%M%S')}.zip"
+    return Response(
+        stream_with_context(iter_export(dream_db, include_media=include_media, logger=logger)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
 @app.route('/api/dreams/<int:dream_id>', methods=['DELETE'])
 def delete_dream(dream_id):
-    """Delete a dream and its associated files."""
+    """Delete a dream. Its files are removed shortly after by the media reaper."""
     try:
         # Get the dream details before deletion
         dream = dream_db.get_dream(dream_id)
         if not dream:
             return jsonify({'success': False, 'message': 'Dream not found'}), 404
-        # Delete the dream from the database
+        # Soft-delete the dream; the media reaper removes its files in the background
         if dream_db.delete_dream(dream_id):
-            # Delete associated files
-            try:
-                # Delete video file
-                video_path = os.path.join(get_config()['VIDEOS_DIR'], dream['video_filename'])
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                # Delete thumbnail file
-                thumb_path = os.path.join(get_config()['THUMBS_DIR'], dream['thumb_filename'])
-                if os.path.exists(thumb_path):
-                    os.remove(thumb_path)
-                # Delete audio file
-                audio_path = os.path.join(get_config()['RECORDINGS_DIR'], dream['audio_filename'])
-                if os.path.exists(audio_path):
-                    os.remove(audio_path)
-            except Exception as e:
-                if logger:
-                    logger.error(f"Error deleting files for dream {dream_id}: {str(e)}")
-                # Continue even if file deletion fails
+            media_gc_wakeup.set()
             return jsonify({'success': True, 'message': 'Dream deleted successfully'})
         else:
             return jsonify({'success': False, 'message': 'Failed to delete dream'}), 500
@@ -314,9 +506,46 @@ def notify_config_reload():
     return jsonify({'status': 'reload event emitted'})
 
 # -- Media Routes --
+def send_media(kind, filename, not_found, **kwargs):
+    """Serve a stored media file from the configured media backend.
+
+    Remote backends answer with a redirect to the object (offloading the
+    transfer) or, when redirects are off, proxy it in chunks, forwarding the
+    Range header so seeking still works. Local media is sent from disk.
+    """
+    backend = get_media_backend(logger)
+    headers = kwargs.pop('headers', None) or {}
+    # Players resolve segment URLs against the playlist's final URL, which a
+    # presigned redirect would break, so playlists are always proxied
+    redirectable = not (kind == 'streams' and filename.endswith('.m3u8'))
+    if backend.remote:
+        url = backend.url(kind, filename) if redirectable else None
+        if url:
+            return redirect(url)
+        upstream = backend.get(kind, filename, request.headers.get('Range'))
+        if upstream.status_code == 404:
+            upstream.close()
+            return not_found, 404
+        proxied = {name: upstream.headers[name] for name in PROXY_HEADERS if name in upstream.headers}
+        proxied.update(headers)
+        return Response(
+            stream_with_context(upstream.iter_content(STREAM_CHUNK_SIZE)),
+            status=upstream.status_code, headers=proxied, mimetype=kwargs.get('mimetype'),
+        )
+    try:
+        response = send_file(os.path.join(get_config()[MEDIA_KINDS[kind]], filename), **kwargs)
+    except FileNotFoundError:
+        return not_found, 404
+    if headers:
+        response.headers.update(headers)
+    return response
+
 @app.route('/media/<path:filename>')
 def serve_media(filename):
     """Serve media files (audio and video) from the media directory."""
+    kind, _, name = filename.partition('/')
+    if kind in ('video', 'audio') and name:
+        return send_media(kind, name, "File not found")
     try:
         return send_file(os.path.join('media', filename))
     except FileNotFoundError:
@@ -325,10 +554,23 @@ def serve_media(filename):
 @app.route('/media/thumbs/<path:filename>')
 def serve_thumbnail(filename):
     """Serve thumbnail files from the thumbs directory."""
-    try:
-        return send_file(os.path.join(get_config()['THUMBS_DIR'], filename))
-    except FileNotFoundError:
-        return "Thumbnail not found", 404
+    return send_media('thumbs', filename, "Thumbnail not found")
+
+@app.route('/media/previews/<path:filename>')
+def serve_preview(filename):
+    """Serve hover preview loops and sprite sheets from the previews directory."""
+    return send_media('previews', filename, "Preview not found", max_age=86400)
+
+@app.route('/media/streams/<path:filename>')
+def serve_stream(filename):
+    """Serve HLS playlists and segments from the streams directory with cache headers."""
+    is_playlist = filename.endswith('.m3u8')
+    # Segments never change once written; playlists stay revalidatable in case a dream is re-packaged
+    return send_media(
+        'streams', filename, "Stream not found",
+        mimetype='application/vnd.apple.mpegurl' if is_playlist else 'video/mp2t',
+        headers={'Cache-Control': 'public, max-age=3600' if is_playlist else 'public, max-age=31536000, immutable'},
+    )
 
 # =============================
 # Main Execution Block
@@ -339,6 +581,20 @@ if __name__ == '__main__':  # pragma: no cover
     parser = argparse.ArgumentParser()
     parser.add_argument('--reload', action='store_true', help='Enable auto-reloader')
     args = parser.parse_args()
+    # Held until exit so backup restores refuse to run under the app. With the
+    # reloader only the serving child (WERKZEUG_RUN_MAIN) takes it.
+    if not args.reload or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        try:
+            app_lock = acquire_app_lock(dream_db.db_path)
+        except RuntimeError:
+            logger.info("The database is locked by another process (e.g. a backup restore); waiting for it to finish")
+            app_lock = acquire_app_lock(dream_db.db_path, wait=True)
+    # Finish any schema backfills in the background so boot is not held up
+    dream_db.spawn('run_backfills')
+    # Remove deleted dreams' files and orphaned media in the background
+    gevent.spawn(run_media_gc, dream_db, media_gc_wakeup, logger)
+    # Measure how long the hub takes to resume a sleeping greenlet, for /metrics
+    gevent.spawn(run_loop_lag_monitor)
     # Start the Flask-SocketIO server
     socketio.run(
         app, 
@@ -0,0 +1,26 @@
+import os
+import fcntl
+
+# The running app holds an exclusive lock on this file next to its database,
+# so tools that must not run alongside it (backup restores) can tell it is up
+APP_LOCK_SUFFIX = '.app.lock'
+
+def app_lock_path(db_path):
+    return db_path + APP_LOCK_SUFFIX
+
+def acquire_app_lock(db_path, wait=False):
+    """Take the exclusive app lock of a database; closing the returned file releases it.
+
+    The lock dies with its process, so a crashed app never leaves it stale.
+    Without wait, raises RuntimeError at once if another process (the app, or
+    a restore in progress) holds it.
+    """
+    path = app_lock_path(db_path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(f"{db_path} is in use by the running app; stop it first (docker compose stop app)")
+    return lock_file
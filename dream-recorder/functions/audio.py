@@ -1,11 +1,18 @@
 import wave
 import os
+import time
 import tempfile
 import ffmpeg
 import wave
 
-from datetime import datetime
-from functions.video import generate_video
+from functions.video import generate_video, generate_previews, generate_stream, thumbnail_details, video_metadata
+from functions.storage import ensure_capacity
+from functions.blob_store import store_video
+from functions.media_backend import publish_dream_media
+from functions.media_layout import SHARED_MEDIA_COLUMNS, new_media_filename
+from functions.media_writer import staged, scratch_file
+from functions.tracing import Trace, span, save_trace
+from functions.metrics import PIPELINE_RUNS, external_call
 from functions.config_loader import get_config
 from openai import OpenAI
 
@@ -26,61 +33,75 @@ def create_wav_file(audio_buffer):
 def save_wav_file(audio_data, filename=None, logger=None):
     """Save the WAV file locally for debugging. Converts WebM to WAV using ffmpeg."""
     if filename is None:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"recording_{timestamp}.wav"
-    # Ensure the recordings directory exists
-    os.makedirs(get_config()['RECORDINGS_DIR'], exist_ok=True)
+        filename = new_media_filename('recording', '.wav')
     filepath = os.path.join(get_config()['RECORDINGS_DIR'], filename)
-    # Create a temporary file for the WebM data
-    with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as temp_webm:
-        temp_webm.write(audio_data)
-        temp_webm_path = temp_webm.name
-    try:
-        # Convert WebM to WAV using ffmpeg
-        stream = ffmpeg.input(temp_webm_path)
-        stream = ffmpeg.output(stream, filepath, acodec='pcm_s16le', ac=1, ar=44100)
-        ffmpeg.run(stream, overwrite_output=True, quiet=True)
-        logger.info(f"Saved WAV file to {filepath}")
-        return filename
-    finally:
-        # Clean up temporary file
-        try:
-            os.unlink(temp_webm_path)
-        except:
-            pass
+    # The browser's WebM is only an intermediate; the WAV is staged next to its final name
+    with scratch_file('.webm', near=filepath) as temp_webm_path:
+        with open(temp_webm_path, 'wb') as temp_webm:
+            temp_webm.write(audio_data)
+        with staged(filepath) as (staged_path,):
+            # Convert WebM to WAV using ffmpeg
+            stream = ffmpeg.input(temp_webm_path)
+            stream = ffmpeg.output(stream, staged_path, acodec='pcm_s16le', ac=1, ar=44100)
+            ffmpeg.run(stream, overwrite_output=True, quiet=True)
+    logger.info(f"Saved WAV file to {filepath}")
+    return filename
 
 def generate_video_prompt(transcription, luma_extend=False, logger=None, config=None):
     """Generate an enhanced video prompt from the transcription using GPT."""
     try:
         system_prompt = get_config()['GPT_SYSTEM_PROMPT_EXTEND'] if luma_extend else get_config()['GPT_SYSTEM_PROMPT']
-        response = client.chat.completions.create(
-            model=get_config()['GPT_MODEL'],
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"{transcription}"}
-            ],
-            temperature=float(get_config()['GPT_TEMPERATURE']),
-            max_tokens=int(get_config()['GPT_MAX_TOKENS'])
-        )
+        with external_call('openai', 'chat'):
+            response = client.chat.completions.create(
+                model=get_config()['GPT_MODEL'],
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": f"{transcription}"}
+                ],
+                temperature=float(get_config()['GPT_TEMPERATURE']),
+                max_tokens=int(get_config()['GPT_MAX_TOKENS'])
+            )
         return response.choices[0].message.content.strip()
     except Exception as e:
         if logger:
             logger.error(f"Error generating video prompt: {str(e)}")
         return None
 
+def find_reusable_dream(dream_db, user_prompt, generated_prompt, logger=None):
+    """Return an existing dream whose prompts nearly match, if the prompt cache is enabled.
+
+    Only dreams whose video file is still on disk are reused. Lookup errors are
+    logged and treated as a miss so a new video is generated instead.
+    """
+    if str(get_config().get('PROMPT_CACHE_ENABLED', False)).lower() not in ('1', 'true', 'yes'):
+        return None
+    try:
+        threshold = float(get_config().get('PROMPT_CACHE_THRESHOLD', 0.9))
+        for dream, score in dream_db.find_similar_prompts(user_prompt, generated_prompt, threshold):
+            if os.path.exists(os.path.join(get_config()['VIDEOS_DIR'], dream['video_filename'])):
+                if logger:
+                    logger.info(f"Reusing video of dream {dream['id']} (similarity {score:.3f})")
+                return dream
+    except Exception as e:
+        if logger:
+            logger.warning(f"Prompt cache lookup failed: {str(e)}")
+    return None
+
 def process_audio(sid, socketio, dream_db, recording_state, audio_chunks, logger = None):
     """Process the recorded audio and generate video, then update state and emit events."""
+    started = time.monotonic()
+    # Each stage below is timed as a span and the spans are saved with the dream
+    trace = Trace().start()
     try:
         audio_data = b''.join(audio_chunks)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        wav_filename = f"recording_{timestamp}.wav"
-        wav_filename = save_wav_file(audio_data, wav_filename, logger)
+        with span('decode', bytes=len(audio_data)):
+            wav_filename = save_wav_file(audio_data, new_media_filename('recording', '.wav'), logger)
         # Create a temporary file for the audio
         with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
             temp_file.write(audio_data)
             temp_file_path = temp_file.name
         # Transcribe the audio using OpenAI's Whisper API
-        with open(temp_file_path, 'rb') as audio_file:
+        with span('whisper'), open(temp_file_path, 'rb') as audio_file, external_call('openai', 'transcription'):
             transcription = client.audio.transcriptions.create(
                 model=get_config()['WHISPER_MODEL'],
                 file=audio_file
@@ -95,30 +116,62 @@ def process_audio(sid, socketio, dream_db, recording_state, audio_chunks, logger
         # Check if LUMA_EXTEND is set
         luma_extend = str(get_config()['LUMA_EXTEND']).lower() in ('1', 'true', 'yes')
         # Generate video prompt
-        video_prompt = generate_video_prompt(transcription=transcription.text, luma_extend=luma_extend, logger=logger, config=get_config())
-        if not video_prompt:
-            raise Exception("Failed to generate video prompt")
+        with span('gpt'):
+            video_prompt = generate_video_prompt(transcription=transcription.text, luma_extend=luma_extend, logger=logger, config=get_config())
+            if not video_prompt:
+                raise Exception("Failed to generate video prompt")
         recording_state['video_prompt'] = video_prompt
         if sid:
             socketio.emit('video_prompt_update', {'text': video_prompt}, room=sid)
         else:
             socketio.emit('video_prompt_update', {'text': video_prompt})
-        video_filename, thumb_filename = generate_video(prompt=video_prompt, luma_extend=luma_extend, logger=logger)
-        # Save to database
         DreamData = None
         try:
             from functions.dream_db import DreamData
         except ImportError:
             pass
+        # A near-duplicate of an earlier dream shares its media instead of paying for a new generation
+        with span('reuse_lookup') as lookup:
+            cached = find_reusable_dream(dream_db, transcription.text, video_prompt, logger)
+            lookup['hit'] = bool(cached)
+        if cached:
+            media = {column: cached.get(column) for column in SHARED_MEDIA_COLUMNS}
+            media['source_dream_id'] = cached['id']
+        else:
+            # Free space first so a full disk cannot fail the pipeline halfway through
+            with span('capacity'):
+                if not ensure_capacity(dream_db, logger)['ok']:
+                    raise Exception("Not enough storage space for a new dream")
+            with span('generate_video', luma_extend=luma_extend):
+                video_filename, thumb_filename = generate_video(prompt=video_prompt, luma_extend=luma_extend, logger=logger)
+            media = {'video_filename': video_filename, 'thumb_filename': thumb_filename}
+            with span('thumbnail_details'):
+                media.update(thumbnail_details(thumb_filename, logger))
+            with span('previews'):
+                media.update(generate_previews(video_filename, logger))
+            with span('stream'):
+                media['stream_manifest'] = generate_stream(video_filename, logger)
+            with span('metadata'):
+                media.update(video_metadata(video_filename, logger))
+            with span('blob_store'):
+                media['video_digest'] = store_video(dream_db, video_filename, logger)
+        video_filename = media['video_filename']
+        # A shared media backend needs the files before any recorder can play the dream
+        with span('publish'):
+            publish_dream_media(dict(media, audio_filename=wav_filename), shared=not cached, logger=logger)
+        # Save to database
         dream_data = DreamData(
             user_prompt=recording_state['transcription'],
             generated_prompt=recording_state['video_prompt'],
             audio_filename=wav_filename,
-            video_filename=video_filename,
-            thumb_filename=thumb_filename,
+            pipeline_seconds=round(time.monotonic() - started, 2),
             status='completed',
+            **media,
         )
-        dream_db.save_dream(dream_data.model_dump())
+        with span('db_save'):
+            dream_id = dream_db.save_dream(dream_data.model_dump())
+        save_trace(dream_db, trace, dream_id, logger)
+        PIPELINE_RUNS.inc(outcome='reused' if cached else 'generated')
         recording_state['status'] = 'complete'
         recording_state['video_url'] = f"/media/video/{video_filename}"
         # Emit the video ready event to trigger playback
@@ -133,7 +186,15 @@ def process_audio(sid, socketio, dream_db, recording_state, audio_chunks, logger
         socketio.emit('error', {'message': str(e)})
         if logger:
             logger.error(f"Error processing audio: {str(e)}")
+        try:
+            dream_db.record_pipeline_failure()
+        except Exception as stats_error:
+            if logger:
+                logger.warning(f"Could not record the failed run: {str(stats_error)}")
+        save_trace(dream_db, trace, None, logger)
+        PIPELINE_RUNS.inc(outcome='failed')
     finally:
+        trace.stop()
         # Clean up
         audio_chunks = []
         # Remove temporary file if it exists
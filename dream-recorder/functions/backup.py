@@ -0,0 +1,339 @@
+import os
+import json
+import fcntl
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functions.config_loader import get_config
+from functions.app_lock import acquire_app_lock
+from functions.blob_store import HASH_CHUNK_SIZE, link_or_copy
+from functions.media_layout import MEDIA_KINDS
+from functions.media_writer import staged
+
+# A backup target holds:
+#   objects/ab/<sha256>         file contents, stored once however many snapshots use them
+#   snapshots/<timestamp>.json  the database digest plus {path: digest, size, mtime} of every media file
+# A run hashes and copies only files whose size or mtime changed since the last
+# snapshot, so a nightly backup of an unchanged library is a directory walk.
+
+# Manifest layout version; restores refuse manifests newer than they understand
+BACKUP_FORMAT = 1
+# Directories backed up, keyed by the name their files are recorded under
+BACKUP_DIRS = dict(MEDIA_KINDS, blobs='MEDIA_BLOBS_DIR')
+# Lock file in a target, held by backups, prunes and restores for their whole run
+TARGET_LOCK_NAME = '.lock'
+
+def _object_path(target, digest):
+    return os.path.join(target, 'objects', digest[:2], digest)
+
+def _snapshot_path(target, snapshot):
+    return os.path.join(target, 'snapshots', f"{snapshot}.json")
+
+@contextmanager
+def _target_lock(target):
+    """Hold a target's lock, waiting for any other run using it to finish.
+
+    A prune deletes every object no snapshot refers to yet, which includes the
+    objects a concurrent backup has stored but not yet recorded, so runs on a
+    target take turns. The lock dies with its process, like the app lock.
+    """
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, TARGET_LOCK_NAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def list_snapshots(target):
+    """Snapshot names in a backup target, oldest first."""
+    directory = os.path.join(target, 'snapshots')
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-5] for name in os.listdir(directory) if name.endswith('.json') and not name.startswith('.'))
+
+def load_manifest(target, snapshot=None):
+    """Read a snapshot's manifest (the latest when snapshot is None), or None if there is none."""
+    snapshot = snapshot or next(reversed(list_snapshots(target)), None)
+    if snapshot is None:
+        return None
+    with open(_snapshot_path(target, snapshot)) as f:
+        manifest = json.load(f)
+    if int(manifest.get('format', 0)) > BACKUP_FORMAT:
+        raise ValueError(f"Backup format {manifest['format']} is newer than this recorder understands")
+    return dict(manifest, snapshot=snapshot)
+
+def _ingest(target, path):
+    """Copy a file into the object store, hashing it on the way. Returns (digest, bytes copied).
+
+    Hashing what is copied (rather than hashing and then copying) keeps the
+    object true to its name even if the file is replaced mid-read.
+    """
+    objects = os.path.join(target, 'objects')
+    os.makedirs(objects, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.incoming_', dir=objects)
+    try:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        digest = digest.hexdigest()
+        object_path = _object_path(target, digest)
+        if os.path.exists(object_path):
+            os.remove(tmp_path)
+            return digest, 0
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, object_path)
+        return digest, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _media_files():
+    """Yield (recorded path, local path) for every media file; hidden files (staging leftovers) are skipped."""
+    config = get_config()
+    for kind, key in BACKUP_DIRS.items():
+        directory = config.get(key)
+        if not directory or not os.path.isdir(directory):
+            continue
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            relative = os.path.relpath(root, directory).replace(os.sep, '/')
+            for name in sorted(names):
+                if not name.startswith('.'):
+                    yield f"{kind}/{name}" if relative == '.' else f"{kind}/{relative}/{name}", os.path.join(root, name)
+
+def snapshot_database(db_path, dst_path):
+    """Copy a live database with the SQLite online backup API.
+
+    The copy is a consistent point-in-time snapshot even while the app keeps
+    writing, which copying the file (and its WAL) by hand is not.
+    """
+    source = sqlite3.connect(db_path, timeout=5.0)
+    try:
+        target = sqlite3.connect(dst_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+def create_backup(target, db_path=None, keep=0, logger=None):
+    """Take a snapshot of the database and media into target, copying only what changed.
+
+    Files whose size and mtime match the previous snapshot reuse its digest
+    without being read; hardlinked files (blob store links) are read once.
+    With keep > 0, older snapshots beyond the newest keep are pruned.
+    Waits for any other backup, prune or restore of target to finish first.
+    Returns a report dict.
+    """
+    with _target_lock(target):
+        return _create_backup(target, db_path, keep, logger)
+
+def _create_backup(target, db_path, keep, logger):
+    started = time.monotonic()
+    db_path = db_path or get_config()['DB_PATH']
+    previous = load_manifest(target) or {}
+    known = previous.get('files', {})
+    report = {'snapshot': None, 'files': 0, 'files_hashed': 0, 'bytes_copied': 0}
+    os.makedirs(os.path.join(target, 'objects'), exist_ok=True)
+    # The database is snapshotted first: media written afterwards is at worst an orphan on restore
+    fd, db_copy = tempfile.mkstemp(prefix='.incoming_', suffix='.sqlite3', dir=os.path.join(target, 'objects'))
+    os.close(fd)
+    try:
+        snapshot_database(db_path, db_copy)
+        db_digest, copied = _ingest(target, db_copy)
+        report['bytes_copied'] += copied
+    finally:
+        os.remove(db_copy)
+    files = {}
+    # (device, inode, size, mtime) -> digest, so hardlinked twins are hashed once
+    inodes = {}
+    for recorded, path in _media_files():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entry = known.get(recorded)
+        identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns \
+                and os.path.exists(_object_path(target, entry['digest'])):
+            digest = entry['digest']
+        elif identity in inodes:
+            digest = inodes[identity]
+        else:
+            try:
+                digest, copied = _ingest(target, path)
+            except FileNotFoundError:
+                continue
+            report['files_hashed'] += 1
+            report['bytes_copied'] += copied
+        inodes[identity] = digest
+        files[recorded] = {'digest': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    snapshot = base = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    existing = set(list_snapshots(target))
+    counter = 1
+    while snapshot in existing:
+        counter += 1
+        snapshot = f"{base}-{counter}"
+    with staged(_snapshot_path(target, snapshot)) as (tmp_path,):
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'format': BACKUP_FORMAT,
+                'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'database': db_digest,
+                'files': files,
+            }, f)
+    report.update(snapshot=snapshot, files=len(files), seconds=round(time.monotonic() - started, 2))
+    if keep:
+        _prune_backups(target, keep, logger)
+    if logger:
+        logger.info(
+            f"Backup {snapshot}: {report['files']} files, {report['files_hashed']} hashed, "
+            f"{report['bytes_copied'] / 1048576:.1f} MB copied in {report['seconds']} s"
+        )
+    return report
+
+def prune_backups(target, keep, logger=None):
+    """Drop all but the newest keep snapshots, then objects no remaining snapshot uses. Returns (snapshots, objects) removed."""
+    with _target_lock(target):
+        return _prune_backups(target, keep, logger)
+
+def _prune_backups(target, keep, logger):
+    snapshots = list_snapshots(target)
+    removed = snapshots[:-keep] if keep > 0 else []
+    for snapshot in removed:
+        os.remove(_snapshot_path(target, snapshot))
+    live = set()
+    for snapshot in snapshots[len(removed):]:
+        manifest = load_manifest(target, snapshot)
+        live.add(manifest['database'])
+        live.update(entry['digest'] for entry in manifest['files'].values())
+    objects = 0
+    root_dir = os.path.join(target, 'objects')
+    for root, _, names in os.walk(root_dir):
+        for name in names:
+            # Hidden names are copies a crashed run left behind
+            if name.startswith('.') or name not in live:
+                os.remove(os.path.join(root, name))
+                objects += 1
+    if logger and (removed or objects):
+        logger.info(f"Pruned {len(removed)} snapshots and {objects} objects")
+    return len(removed), objects
+
+def verify_backup(target, snapshot=None, deep=False, logger=None):
+    """Check that every object a snapshot needs is present with the right size.
+
+    deep=True also re-hashes each object and runs SQLite's integrity check on
+    the database copy. Returns a report with the missing and corrupt paths.
+    """
+    manifest = load_manifest(target, snapshot)
+    if manifest is None:
+        raise ValueError(f"No backups in {target}")
+    report = {'snapshot': manifest['snapshot'], 'files': len(manifest['files']), 'missing': [], 'corrupt': []}
+    checked = {}
+    entries = [('database', {'digest': manifest['database'], 'size': None})] + sorted(manifest['files'].items())
+    for recorded, entry in entries:
+        digest = entry['digest']
+        if digest not in checked:
+            path = _object_path(target, digest)
+            if not os.path.exists(path):
+                checked[digest] = 'missing'
+            elif entry['size'] is not None and os.path.getsize(path) != entry['size']:
+                checked[digest] = 'corrupt'
+            elif deep and _hash_file(path) != digest:
+                checked[digest] = 'corrupt'
+            else:
+                checked[digest] = 'ok'
+        if checked[digest] != 'ok':
+            report[checked[digest]].append(recorded)
+    if deep and 'database' not in report['missing'] + report['corrupt']:
+        db = sqlite3.connect(f"file:{_object_path(target, manifest['database'])}?immutable=1", uri=True)
+        try:
+            if db.execute('PRAGMA integrity_check').fetchone()[0] != 'ok':
+                report['corrupt'].append('database')
+        finally:
+            db.close()
+    if logger:
+        logger.info(
+            f"Verified backup {report['snapshot']}: {len(report['missing'])} missing, {len(report['corrupt'])} corrupt"
+        )
+    return report
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def restore_backup(target, snapshot=None, db_path=None, logger=None):
+    """Restore a snapshot's media and database over the current library while the app is stopped.
+
+    Refuses to run (RuntimeError) while the app holds its lock on the
+    database, and holds that lock itself until done, so the app cannot start
+    part way through. Media already in place with the recorded size and mtime
+    is kept, and files sharing contents are restored as hardlinks of one copy,
+    as the blob store had them. The database is loaded last, through SQLite's
+    backup API, so a restore that fails part way leaves it untouched and any
+    other open connection (and its WAL) stays consistent. Returns a report dict.
+    """
+    config = get_config()
+    db_path = db_path or config['DB_PATH']
+    # Held throughout so a backup's prune cannot drop the snapshot mid-restore
+    with _target_lock(target):
+        manifest = load_manifest(target, snapshot)
+        if manifest is None:
+            raise ValueError(f"No backups in {target}")
+        needed = {manifest['database']} | {entry['digest'] for entry in manifest['files'].values()}
+        missing = [digest for digest in needed if not os.path.exists(_object_path(target, digest))]
+        if missing:
+            raise ValueError(f"Backup {manifest['snapshot']} is incomplete: {len(missing)} objects are missing")
+        app_lock = acquire_app_lock(db_path)
+        try:
+            report = _restore(target, manifest, db_path, config)
+        finally:
+            app_lock.close()
+    if logger:
+        logger.info(f"Restored backup {report['snapshot']}: {report['files_restored']} files restored, {report['files_kept']} kept")
+    return report
+
+def _restore(target, manifest, db_path, config):
+    report = {'snapshot': manifest['snapshot'], 'files_restored': 0, 'files_kept': 0}
+    # digest -> first file restored from it, which later copies link to
+    restored = {}
+    for recorded, entry in sorted(manifest['files'].items()):
+        kind, _, name = recorded.partition('/')
+        if kind not in BACKUP_DIRS or '..' in name.split('/'):
+            raise ValueError(f"Unexpected path in backup manifest: {recorded}")
+        path = os.path.join(config[BACKUP_DIRS[kind]], *name.split('/'))
+        try:
+            stat = os.stat(path)
+            if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+                report['files_kept'] += 1
+                restored.setdefault(entry['digest'], path)
+                continue
+        except FileNotFoundError:
+            pass
+        if entry['digest'] in restored:
+            link_or_copy(restored[entry['digest']], path)
+        else:
+            # A copy, not a link, so the library never shares an inode with its backup
+            with staged(path) as (tmp_path,):
+                shutil.copyfile(_object_path(target, entry['digest']), tmp_path)
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        restored.setdefault(entry['digest'], path)
+        report['files_restored'] += 1
+    # Opened from a scratch copy, so SQLite never creates journal files in the backup
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(db_path))) as scratch:
+        copy_path = os.path.join(scratch, 'restore.sqlite3')
+        shutil.copyfile(_object_path(target, manifest['database']), copy_path)
+        snapshot_database(copy_path, db_path)
+    return report
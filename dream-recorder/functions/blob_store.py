@@ -0,0 +1,120 @@
+import os
+import shutil
+import hashlib
+from functions.config_loader import get_config
+from functions.media_writer import staged
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# ioctl that clones a file's extents copy-on-write (btrfs, XFS); Linux only
+FICLONE = 0x40049409
+# Read size used when hashing media
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Media files are never rewritten in place (encoders write a temporary file
+# and os.replace it over the old name), so sharing one inode between the
+# store and any number of media names is safe.
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def blob_path(digest):
+    """Where a blob lives in MEDIA_BLOBS_DIR, fanned out by its first two hex digits."""
+    return os.path.join(get_config().get('MEDIA_BLOBS_DIR', 'media/blobs'), digest[:2], digest)
+
+def link_or_copy(src, dst):
+    """Make dst share src's bytes, replacing dst if it exists.
+
+    Tries a hardlink, then a reflink (copy-on-write clone), then falls back to
+    a plain copy across filesystems. Returns the method used.
+    """
+    with staged(dst) as (tmp_path,):
+        method = None
+        try:
+            os.link(src, tmp_path)
+            method = 'hardlink'
+        except OSError:
+            pass
+        if method is None and fcntl is not None:
+            try:
+                with open(src, 'rb') as source, open(tmp_path, 'wb') as target:
+                    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                shutil.copystat(src, tmp_path)
+                method = 'reflink'
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        if method is None:
+            shutil.copy2(src, tmp_path)
+            method = 'copy'
+    return method
+
+def store_file(dream_db, src, dst=None, logger=None):
+    """Put a file's contents in the blob store and link it at dst.
+
+    With dst=None the file at src is adopted in place: if an identical blob
+    already exists, src is swapped for a link to it and its duplicate bytes
+    are freed. The blob is registered (unreferenced until a dream row points
+    at it through video_digest) before it is written, so a crash never leaves
+    an untracked blob. Returns the digest.
+    """
+    digest = file_digest(src)
+    dream_db.register_blob(digest, os.path.getsize(src))
+    stored = blob_path(digest)
+    if os.path.exists(stored):
+        if dst is not None or not os.path.samefile(src, stored):
+            method = link_or_copy(stored, dst or src)
+            if logger:
+                logger.info(f"Deduplicated {dst or src} against blob {digest[:12]} ({method})")
+    else:
+        link_or_copy(src, stored)
+        if dst is not None:
+            link_or_copy(stored, dst)
+    return digest
+
+def store_video(dream_db, video_filename, logger=None):
+    """Adopt a video in VIDEOS_DIR into the blob store. Returns its digest, or None on failure."""
+    try:
+        return store_file(dream_db, os.path.join(get_config()['VIDEOS_DIR'], video_filename), logger=logger)
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not add {video_filename} to the blob store: {str(e)}")
+        return None
+
+def release_blob(dream_db, digest, logger=None):
+    """Remove a blob once no dream references it. Returns the bytes actually freed.
+
+    Media names linked to the blob keep their data, so this only frees disk
+    space when the store held the last link.
+    """
+    if not digest or not dream_db.purge_blob(digest):
+        return 0
+    path = blob_path(digest)
+    try:
+        freed = os.path.getsize(path) if os.stat(path).st_nlink == 1 else 0
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    if logger:
+        logger.info(f"Released blob {digest[:12]}")
+    return freed
+
+def reap_unreferenced_blobs(dream_db, min_age=3600, limit=200, logger=None):
+    """Release blobs left unreferenced for min_age seconds (e.g. by a failed pipeline). Returns (count, bytes)."""
+    released = freed = 0
+    for digest in dream_db.get_unreferenced_blobs(min_age=min_age, limit=limit):
+        try:
+            freed += release_blob(dream_db, digest, logger)
+            released += 1
+        except OSError as e:
+            if logger:
+                logger.warning(f"Could not remove blob {digest}: {str(e)}")
+    return released, freed
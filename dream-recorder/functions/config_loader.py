@@ -11,6 +11,8 @@ def load_config():
     api_keys = {
         "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
         "LUMALABS_API_KEY": os.getenv("LUMALABS_API_KEY"),
+        "S3_ACCESS_KEY_ID": os.getenv("S3_ACCESS_KEY_ID"),
+        "S3_SECRET_ACCESS_KEY": os.getenv("S3_SECRET_ACCESS_KEY"),
     }
 
     # Determine which config to load
@@ -0,0 +1,55 @@
+import time
+import functools
+from gevent.threadpool import ThreadPool
+from functions.config_loader import get_config
+from functions.dream_db import DreamDB
+from functions.metrics import DB_CALL_SECONDS
+
+# Worker threads used when DB_THREADS is not configured
+DEFAULT_DB_THREADS = 4
+
+class ThreadedDreamDB:
+    """DreamDB front end that keeps the gevent hub responsive.
+
+    sqlite3 blocks inside C code that monkey patching cannot reach, so a query
+    or commit made from a greenlet stalls every other greenlet, Socket.IO audio
+    ingestion included. Here each public DreamDB method runs on a small pool of
+    native threads (sqlite3 releases the GIL while it works) and only the
+    calling greenlet waits for the result. Call it exactly like DreamDB.
+    """
+
+    def __init__(self, db=None, threads=None):
+        if threads is None:
+            threads = int(get_config().get('DB_THREADS', DEFAULT_DB_THREADS))
+        self.threadpool = ThreadPool(threads)
+        # Opening the database can run migrations, so that is dispatched too
+        self.db = db if db is not None else self.threadpool.apply(DreamDB)
+
+    def __getattr__(self, name):
+        if name in ('db', 'threadpool'):
+            raise AttributeError(name)
+        attr = getattr(self.db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def dispatch(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return self.threadpool.apply(attr, args, kwargs)
+            finally:
+                DB_CALL_SECONDS.observe(time.perf_counter() - started, method=name)
+        return dispatch
+
+    def spawn(self, method, *args, **kwargs):
+        """Start a DreamDB call without waiting for it.
+
+        Returns a gevent AsyncResult; get() yields the method's return value or
+        raises its exception. Lets a handler run independent queries concurrently.
+        """
+        return self.threadpool.spawn(getattr(self.db, method), *args, **kwargs)
+
+    def close(self):
+        """Close the database's connections and stop the worker threads."""
+        self.db.close()
+        self.threadpool.kill()
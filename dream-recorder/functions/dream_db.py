@@ -6,17 +6,113 @@ import logging
 from pydantic import BaseModel
 from typing import Optional
 import os
+import threading
+import time
+from contextlib import contextmanager
 from functions.config_loader import get_config
-import shutil
+from functions.vector_index import VectorIndex, get_embedder, dream_text
+from functions.media_layout import MEDIA_COLUMN_DIRS, SHARED_MEDIA_COLUMNS
+from functions.blob_store import store_file, link_or_copy
+from functions.migrations import migrate, pending_backfills, run_backfill_batch
+try:
+    from gevent.monkey import get_original
+    # DreamDB is shared by the gevent hub and native worker threads
+    # (functions.db_threadpool), so its locks must be real OS locks even
+    # after threading has been monkey-patched
+    _native_lock = get_original('threading', 'Lock')
+except ImportError:  # pragma: no cover
+    _native_lock = threading.Lock
 
 logger = logging.getLogger(__name__)
 
+# Pragmas applied to every pooled connection. WAL lets readers proceed while a
+# write commits; NORMAL sync is durable across app crashes in WAL mode.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA temp_store=MEMORY",
+)
+# Idle connections kept open per DreamDB; extra connections are closed on release
+POOL_SIZE = 4
+
+# Columns the library views need; the full prompts are fetched per dream on demand
+LIST_COLUMNS = (
+    'id', 'created_at', 'status', 'video_filename', 'audio_filename',
+    'thumb_filename', 'thumb_sizes', 'thumb_placeholder',
+    'preview_filename', 'sprite_filename', 'stream_manifest', 'duration', 'prompt_excerpt',
+)
+# Bookkeeping columns an import carries over besides the DreamData fields
+IMPORT_EXTRA_COLUMNS = ('created_at', 'last_played_at', 'archived_at')
+# Orderings for picking the coldest dreams when storage runs short
+STORAGE_POLICIES = {
+    'lru': 'COALESCE(last_played_at, created_at), id',
+    'age': 'created_at, id',
+}
+# Length of the user prompt excerpt shown on library cards
+PROMPT_EXCERPT_LENGTH = 50
+# Computed columns that can be requested alongside the stored ones
+DERIVED_COLUMNS = {
+    'prompt_excerpt': (
+        f"substr(dreams.user_prompt, 1, {PROMPT_EXCERPT_LENGTH}) || "
+        f"CASE WHEN length(dreams.user_prompt) > {PROMPT_EXCERPT_LENGTH} THEN '...' ELSE '' END"
+    ),
+}
+
+# Traces of failed runs (which have no dream to be purged with) kept for diagnosis
+FAILED_TRACES_KEPT = 50
+
+# Control characters marking search hits inside snippets; callers swap them for
+# markup after escaping the prompt text
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def _stats_summary(dreams, prompt_chars, generated, reused, failed, generation_seconds):
+    """Turn summed counters into the figures the stats API reports."""
+    runs = generated + reused + failed
+    return {
+        'dreams': dreams,
+        'average_prompt_chars': round(prompt_chars / dreams, 1) if dreams else None,
+        'generated': generated,
+        'reused': reused,
+        'failed': failed,
+        'failure_rate': round(failed / runs, 4) if runs else None,
+        'average_generation_seconds': round(generation_seconds / generated, 1) if generated else None,
+    }
+
+def _histogram_quantile(histogram, q):
+    """Upper bound of the bucket holding the q-quantile of the runs (None if unbounded or empty)."""
+    total = sum(bucket['runs'] for bucket in histogram)
+    if not total:
+        return None
+    seen = 0
+    for bucket in histogram:
+        seen += bucket['runs']
+        if seen >= q * total:
+            return bucket['le']
+    return None
+
 class DreamData(BaseModel):
     user_prompt: str
     generated_prompt: str
     audio_filename: str
     video_filename: str
     thumb_filename: Optional[str] = None
+    thumb_sizes: Optional[str] = None
+    thumb_placeholder: Optional[str] = None
+    preview_filename: Optional[str] = None
+    sprite_filename: Optional[str] = None
+    stream_manifest: Optional[str] = None
+    source_dream_id: Optional[int] = None
+    duration: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    bitrate: Optional[int] = None
+    video_codec: Optional[str] = None
+    file_size: Optional[int] = None
+    video_digest: Optional[str] = None
+    pipeline_seconds: Optional[float] = None
     status: Optional[str] = 'completed'
 
 class DreamDB:
@@ -24,37 +120,104 @@ class DreamDB:
         if db_path is None:
             db_path = get_config()['DB_PATH']
         self.db_path = db_path
+        self._pool = []
+        self._pool_lock = _native_lock()
+        # Cached (ordered ids, id -> position, stamp) used for playback navigation; reset on writes
+        self._id_index = None
+        # Bumped on every reset, so a rebuild that raced a write is not cached
+        self._id_index_generation = 0
+        self._id_index_lock = _native_lock()
+        # Similar-dreams vector index, opened (and built if needed) on first use
+        self._vectors = None
+        # Serializes opening and writing the vector index across threads
+        self._vectors_lock = _native_lock()
         self._init_db()
+
+    def _open_connection(self):
+        """Open a new connection with the row factory and performance pragmas applied."""
+        conn = sqlite3.connect(self.db_path, timeout=5.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection, rolling back any open transaction if the block fails.
+
+        Connections are reused across calls (and across threads or greenlets, one
+        borrower at a time), so the open and pragma setup is paid once.
+        """
+        with self._pool_lock:
+            conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = self._open_connection()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            with self._pool_lock:
+                if len(self._pool) < POOL_SIZE:
+                    self._pool.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """Close all pooled connections and the vector index. Safe to call more than once."""
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            conn.close()
+        with self._vectors_lock:
+            if self._vectors is not None:
+                self._vectors.close()
+                self._vectors = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
     
     def _init_db(self):
-        """Initialize the database and create tables if they don't exist. If the dreams table is created, also initialize sample dreams."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        """Bring the schema up to date. If the dreams table is created, also initialize sample dreams."""
+        with self._connection() as conn:
             # Check if the dreams table exists
-            cursor.execute("""
-                SELECT name FROM sqlite_master WHERE type='table' AND name='dreams';
-            """)
-            table_exists = cursor.fetchone() is not None
-            # Create the table if it doesn't exist
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS dreams (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_prompt TEXT NOT NULL,
-                    generated_prompt TEXT NOT NULL,
-                    audio_filename TEXT NOT NULL,
-                    video_filename TEXT NOT NULL,
-                    thumb_filename TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT
-                )
-            ''')
-            conn.commit()
-            # If the table did not exist before, initialize sample dreams
-            if not table_exists:
-                self._init_sample_dreams()
+            table_exists = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='dreams'"
+            ).fetchone() is not None
+            migrate(conn, logger)
+        # If the table did not exist before, initialize sample dreams
+        if not table_exists:
+            self._init_sample_dreams()
+
+    def run_backfills(self, batch_size=500, pause=0.05):
+        """Work through pending online backfills in small committed batches.
+
+        Meant to run in the background after startup: each batch is its own
+        transaction, and the pause between batches lets other work proceed.
+        Progress is stored, so an interrupted backfill resumes where it stopped.
+        """
+        with self._connection() as conn:
+            names = pending_backfills(conn)
+        for name in names:
+            started = time.perf_counter()
+            batches = 0
+            while True:
+                with self._connection() as conn:
+                    more = run_backfill_batch(conn, name, batch_size)
+                batches += 1
+                if not more:
+                    break
+                time.sleep(pause)
+            if logger:
+                logger.info(f"Backfill {name} finished in {batches} batches, {time.perf_counter() - started:.2f} s")
 
     def _init_sample_dreams(self):
-        """Copy sample dreams and insert them into the database if missing."""
+        """Link sample dreams into the media folders and insert them into the database if missing."""
         SAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'dream_samples')
         VIDEO_DEST = os.path.join(os.path.dirname(__file__), '..', get_config()['VIDEOS_DIR'])
         THUMB_DEST = os.path.join(os.path.dirname(__file__), '..', get_config()['THUMBS_DIR'])
@@ -71,21 +234,22 @@ class DreamDB:
         existing = self.get_all_dreams()
         existing_videos = {d['video_filename'] for d in existing}
         for i, sample in enumerate(SAMPLES, 1):
-            # Copy video
+            # Link video through the blob store, so every copy shares one set of bytes
             src_video = os.path.join(SAMPLES_DIR, sample['video'])
             dst_video = os.path.join(VIDEO_DEST, sample['video_dest'])
-            if not os.path.exists(dst_video):
+            video_digest = None
+            if sample['video_dest'] not in existing_videos or not os.path.exists(dst_video):
                 try:
-                    shutil.copy2(src_video, dst_video)
+                    video_digest = store_file(self, src_video, dst_video, logger)
                 except Exception as e:
                     if logger:
                         logger.warning(f"Could not copy sample video {src_video} to {dst_video}: {e}")
-            # Copy thumb
+            # Link thumb
             src_thumb = os.path.join(SAMPLES_DIR, sample['thumb'])
             dst_thumb = os.path.join(THUMB_DEST, sample['thumb_dest'])
             if not os.path.exists(dst_thumb):
                 try:
-                    shutil.copy2(src_thumb, dst_thumb)
+                    link_or_copy(src_thumb, dst_thumb)
                 except Exception as e:
                     if logger:
                         logger.warning(f"Could not copy sample thumb {src_thumb} to {dst_thumb}: {e}")
@@ -97,6 +261,7 @@ class DreamDB:
                     audio_filename='',
                     video_filename=sample['video_dest'],
                     thumb_filename=sample['thumb_dest'],
+                    video_digest=video_digest,
                     status='completed',
                 )
                 self.save_dream(dream_data.model_dump())
@@ -106,37 +271,79 @@ class DreamDB:
                 if logger:
                     logger.info(f"Sample dream {i} already exists in DB")
     
+    @staticmethod
+    def _fts_query(text):
+        """Turn free text into an FTS5 query: every word must match, the last one as a prefix."""
+        terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+        if not terms:
+            return None
+        terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search_dreams(self, text, limit=20, offset=0, columns=LIST_COLUMNS):
+        """Full-text search over the prompts, best matches first.
+
+        Each result carries the requested columns plus a `snippet` of the
+        matching prompt text with the hits wrapped in SNIPPET_START/SNIPPET_END.
+        """
+        query = self._fts_query(text)
+        if query is None:
+            return []
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # Rank and page inside the FTS table first, so snippets are only built for the page.
+            # Soft-deleted dreams keep their FTS rows, so they are dropped before paging.
+            cursor.execute(f"""
+                SELECT {self._projection(columns)},
+                       snippet(dreams_fts, -1, ?, ?, '...', 12) AS snippet
+                FROM (
+                    SELECT dreams_fts.rowid AS rowid, dreams_fts.rank AS rank FROM dreams_fts
+                    JOIN dreams AS live ON live.id = dreams_fts.rowid AND live.deleted_at IS NULL
+                    WHERE dreams_fts MATCH ?
+                    ORDER BY dreams_fts.rank, dreams_fts.rowid DESC
+                    LIMIT ? OFFSET ?
+                ) AS hits
+                JOIN dreams_fts ON dreams_fts.rowid = hits.rowid AND dreams_fts MATCH ?
+                JOIN dreams ON dreams.id = hits.rowid AND dreams.deleted_at IS NULL
+                ORDER BY hits.rank, hits.rowid DESC
+            """, (SNIPPET_START, SNIPPET_END, query, int(limit), int(offset), query))
+            return [self._row_to_dict(row) for row in cursor.fetchall()]
+
     def save_dream(self, dream_data):
-        """Save a new dream record to the database."""
+        """Save a new dream record to the database.
+
+        A dream carrying pipeline_seconds was just made by the pipeline, so the
+        run is counted in the pipeline stats in the same transaction.
+        """
         required_fields = ['user_prompt', 'generated_prompt', 'audio_filename', 'video_filename']
         for field in required_fields:
             if field not in dream_data:
                 raise ValueError(f"Missing required field: {field}")
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO dreams (
-                    user_prompt, generated_prompt, audio_filename, video_filename,
-                    thumb_filename, status
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                dream_data['user_prompt'],
-                dream_data['generated_prompt'],
-                dream_data['audio_filename'],
-                dream_data['video_filename'],
-                dream_data.get('thumb_filename'),
-                dream_data.get('status', 'completed')
-            ))
+            columns = list(DreamData.model_fields)
+            values = [dream_data.get(column) for column in columns]
+            values[columns.index('status')] = dream_data.get('status', 'completed')
+            cursor.execute(
+                f"INSERT INTO dreams ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                values
+            )
+            dream_id = cursor.lastrowid
+            if dream_data.get('pipeline_seconds') is not None:
+                self._count_pipeline_run(
+                    cursor, dream_id, dream_data['pipeline_seconds'], dream_data.get('source_dream_id') is not None
+                )
             conn.commit()
-            return cursor.lastrowid
+            self._invalidate_id_index()
+        self._index_dream(dict(dream_data, id=dream_id))
+        return dream_id
     
     def get_dream(self, dream_id):
         """Get a single dream by ID."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM dreams WHERE id = ?', (dream_id,))
+            cursor.execute('SELECT * FROM dreams WHERE id = ? AND deleted_at IS NULL', (dream_id,))
             row = cursor.fetchone()
             if row:
                 return self._row_to_dict(row)
@@ -144,12 +351,203 @@ class DreamDB:
     
     def get_all_dreams(self):
         """Get all dreams, ordered by creation date (newest first)."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM dreams WHERE deleted_at IS NULL ORDER BY created_at DESC, id DESC')
+            return [self._row_to_dict(row) for row in cursor.fetchall()]
+
+    def _projection(self, columns):
+        """Build the SELECT list for the requested columns (all columns when None)."""
+        if columns is None:
+            return 'dreams.*'
+        known = set(DreamData.model_fields) | {'id', 'created_at'}
+        parts = []
+        for column in columns:
+            if column in DERIVED_COLUMNS:
+                parts.append(f"{DERIVED_COLUMNS[column]} AS {column}")
+            elif column in known:
+                parts.append(f"dreams.{column} AS {column}")
+            else:
+                raise ValueError(f"Unknown column: {column}")
+        return ', '.join(parts)
+
+    def list_dreams(self, limit=50, before_id=None, before_created_at=None, columns=None):
+        """Get one page of dreams, newest first, using keyset pagination.
+
+        Pass the created_at and id of the last dream of the previous page as
+        before_created_at and before_id to get the next page. The cursor carries
+        its own sort key, so it stays valid after that dream is deleted or purged,
+        and dreams sharing its timestamp are not skipped. before_id alone looks
+        the timestamp up; before_created_at alone returns dreams created strictly
+        earlier. Each page is an index range scan, so its cost does not grow with
+        the library size. Pass columns (e.g. LIST_COLUMNS) to fetch only what a
+        view renders.
+        """
+        if before_id is not None and before_created_at is not None:
+            where = 'AND (created_at, id) < (?, ?)'
+            params = [before_created_at, before_id]
+        elif before_id is not None:
+            where = 'AND (created_at, id) < ((SELECT created_at FROM dreams WHERE id = ?), ?)'
+            params = [before_id, before_id]
+        elif before_created_at is not None:
+            where = 'AND created_at < ?'
+            params = [before_created_at]
+        else:
+            where, params = '', []
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM dreams ORDER BY created_at DESC')
+            cursor.execute(
+                f'SELECT {self._projection(columns)} FROM dreams WHERE deleted_at IS NULL {where} '
+                'ORDER BY created_at DESC, id DESC LIMIT ?',
+                params + [int(limit)]
+            )
             return [self._row_to_dict(row) for row in cursor.fetchall()]
     
+    def _invalidate_id_index(self):
+        with self._id_index_lock:
+            self._id_index = None
+            self._id_index_generation += 1
+
+    def _dream_id_index(self, refresh=False):
+        """Return the cached (ids newest first, id -> position) pair, building it when stale.
+
+        The cache is stamped with the highest dream id, so dreams added by
+        another process (e.g. scripts/import_library.py) show up on the next
+        lookup; writes made here reset it directly.
+        """
+        with self._connection() as conn:
+            # Read before the list, so a dream added in between only causes another rebuild
+            stamp = conn.execute('SELECT MAX(id) FROM dreams').fetchone()[0]
+            with self._id_index_lock:
+                index, generation = self._id_index, self._id_index_generation
+            if index is not None and not refresh and index[2] == stamp:
+                return index[:2]
+            # Answered from idx_dreams_created_at alone (the index carries the ids)
+            rows = conn.execute(
+                'SELECT id FROM dreams WHERE deleted_at IS NULL ORDER BY created_at DESC, id DESC'
+            ).fetchall()
+        ids = [row[0] for row in rows]
+        index = (ids, {dream_id: position for position, dream_id in enumerate(ids)}, stamp)
+        with self._id_index_lock:
+            if self._id_index_generation == generation:
+                self._id_index = index
+        return index[:2]
+
+    def get_latest_dream_id(self):
+        """Get the ID of the newest dream, or None if there are none."""
+        ids, _ = self._dream_id_index()
+        return ids[0] if ids else None
+
+    def get_adjacent_dream_id(self, dream_id, step=1):
+        """Get the ID `step` places older than dream_id (negative for newer), wrapping around.
+
+        Lookups use the cached ordered ID list, so a tap costs one indexed MAX(id)
+        check however large the library grows. An ID missing from the cache refreshes it once; if the
+        dream has since been deleted, navigation restarts at the newest dream.
+        """
+        ids, positions = self._dream_id_index()
+        if dream_id not in positions:
+            ids, positions = self._dream_id_index(refresh=True)
+        if not ids:
+            return None
+        if dream_id not in positions:
+            return ids[0]
+        return ids[(positions[dream_id] + step) % len(ids)]
+
+    @staticmethod
+    def _similarity_enabled():
+        return str(get_config().get('SIMILAR_DREAMS_ENABLED', True)).lower() in ('1', 'true', 'yes')
+
+    def _indexable_dreams(self):
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT id, user_prompt, generated_prompt FROM dreams WHERE deleted_at IS NULL ORDER BY id'
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _vector_index(self):
+        """Open the vector index stored next to the database.
+
+        It is rebuilt if missing, built by another embedder, or out of step
+        with the live dreams (e.g. after a restore, or writes made while
+        similar dreams were disabled).
+        """
+        with self._vectors_lock:
+            if self._vectors is None:
+                embedder = get_embedder(get_config().get('EMBEDDER', 'hashing'), logger)
+                index = VectorIndex(os.path.splitext(self.db_path)[0], embedder, logger)
+                with self._connection() as conn:
+                    watermark = conn.execute(
+                        'SELECT COUNT(*), COALESCE(MAX(id), 0) FROM dreams WHERE deleted_at IS NULL'
+                    ).fetchone()
+                index.open(tuple(watermark), self._indexable_dreams)
+                self._vectors = index
+            return self._vectors
+
+    def rebuild_vector_index(self):
+        """Re-embed every dream, e.g. after switching embedders."""
+        with self._vectors_lock:
+            if self._vectors is not None:
+                self._vectors.close()
+                self._vectors = None
+        index = self._vector_index()
+        rows = self._indexable_dreams()
+        with self._vectors_lock:
+            index.rebuild(rows)
+
+    def _index_dream(self, dream):
+        """Best-effort incremental index update; the database stays the source of truth."""
+        if not dream or not self._similarity_enabled():
+            return
+        try:
+            index = self._vector_index()
+            with self._vectors_lock:
+                index.add(dream)
+        except Exception as e:
+            logger.warning(f"Could not index dream {dream.get('id')}: {e}")
+
+    def similar_dreams(self, dream_id, k=10, columns=LIST_COLUMNS):
+        """Get the k dreams closest to dream_id by cosine similarity, with a `score` each."""
+        index = self._vector_index()
+        with self._vectors_lock:
+            hits = index.similar(dream_id, k=k)
+        if not hits:
+            return []
+        placeholders = ', '.join('?' for _ in hits)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT {self._projection(columns)} FROM dreams WHERE id IN ({placeholders}) AND deleted_at IS NULL',
+                [dream_id for dream_id, _ in hits]
+            )
+            rows = {row['id']: self._row_to_dict(row) for row in cursor.fetchall()}
+        return [dict(rows[hit_id], score=score) for hit_id, score in hits if hit_id in rows]
+
+    def find_similar_prompts(self, user_prompt, generated_prompt, threshold, k=5):
+        """Get up to k (dream, score) pairs whose prompts score at least threshold, best first."""
+        if not self._similarity_enabled():
+            return []
+        index = self._vector_index()
+        vector = index.embedder.embed([dream_text({'user_prompt': user_prompt, 'generated_prompt': generated_prompt})])[0]
+        matches = []
+        with self._vectors_lock:
+            hits = index.query(vector, k=k)
+        for dream_id, score in hits:
+            if score < threshold:
+                break
+            dream = self.get_dream(dream_id)
+            if dream:
+                matches.append((dream, score))
+        return matches
+
+    def video_in_use(self, video_filename, exclude_id=None):
+        """Whether any other dream, live or awaiting the reaper, still points at this video file."""
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT 1 FROM dreams WHERE video_filename = ? AND id IS NOT ? LIMIT 1', (video_filename, exclude_id)
+            ).fetchone()
+            return row is not None
+
     def update_dream(self, dream_id, updates):
         """Update an existing dream."""
         if not updates:
@@ -165,12 +563,14 @@ class DreamDB:
             values.append(dream_id)
             query = f"UPDATE dreams SET {', '.join(set_clauses)} WHERE id = ?"
             
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 try:
                     cursor.execute(query, values)
                     conn.commit()
-                    return cursor.rowcount > 0
+                    if 'created_at' in updates:
+                        self._invalidate_id_index()
+                    updated = cursor.rowcount > 0
                 except sqlite3.Error as e:
                     if logger:
                         logger.error(f"Database error: {str(e)}")
@@ -179,19 +579,361 @@ class DreamDB:
                     if logger:
                         logger.error(f"Values: {values}")
                     raise
+            if updated and ('user_prompt' in updates or 'generated_prompt' in updates):
+                self._index_dream(self.get_dream(dream_id))
+            return updated
         except Exception as e:
             if logger:
                 logger.error(f"Error updating dream {dream_id}: {str(e)}")
             raise
     
     def delete_dream(self, dream_id):
-        """Delete a dream from the database."""
-        with sqlite3.connect(self.db_path) as conn:
+        """Soft-delete a dream: it disappears at once, its files are removed later by the reaper."""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE dreams SET deleted_at = CURRENT_TIMESTAMP WHERE id = ? AND deleted_at IS NULL', (dream_id,)
+            )
+            conn.commit()
+            self._invalidate_id_index()
+            deleted = cursor.rowcount > 0
+        if deleted and self._similarity_enabled():
+            try:
+                index = self._vector_index()
+                with self._vectors_lock:
+                    index.remove(dream_id)
+            except Exception as e:
+                logger.warning(f"Could not remove dream {dream_id} from the vector index: {e}")
+        return deleted
+
+    def mark_played(self, dream_id):
+        """Record that a dream was just played, for least-recently-played storage eviction."""
+        with self._connection() as conn:
+            conn.execute('UPDATE dreams SET last_played_at = CURRENT_TIMESTAMP WHERE id = ?', (dream_id,))
+            conn.commit()
+
+    def get_coldest_dreams(self, policy='lru', limit=20, archived=None):
+        """Get live dreams coldest first under a STORAGE_POLICIES ordering.
+
+        archived=False returns only dreams whose media has not been archived yet,
+        archived=True only archived ones, None both.
+        """
+        if policy not in STORAGE_POLICIES:
+            raise ValueError(f"Unknown storage policy: {policy}")
+        where = {None: '', False: 'AND archived_at IS NULL', True: 'AND archived_at IS NOT NULL'}[archived]
+        with self._connection() as conn:
+            rows = conn.execute(
+                f'SELECT * FROM dreams WHERE deleted_at IS NULL {where} ORDER BY {STORAGE_POLICIES[policy]} LIMIT ?',
+                (int(limit),)
+            ).fetchall()
+            return [self._row_to_dict(row) for row in rows]
+
+    def update_video_dreams(self, video_filename, updates):
+        """Apply the same column updates to every dream that shares a video file."""
+        if not updates:
+            return 0
+        unknown = set(updates) - set(DreamData.model_fields) - {'archived_at', 'last_played_at'}
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM dreams WHERE id = ?', (dream_id,))
+            cursor.execute(
+                f"UPDATE dreams SET {', '.join(f'{key} = ?' for key in updates)} WHERE video_filename = ?",
+                list(updates.values()) + [video_filename]
+            )
+            conn.commit()
+            return cursor.rowcount
+
+    def get_unsharded_dreams(self, limit=100):
+        """Get dreams (deleted ones included) with media still in the legacy flat layout."""
+        with self._connection() as conn:
+            rows = conn.execute(f"""
+                SELECT * FROM dreams
+                WHERE {' OR '.join(
+                    f"({column} IS NOT NULL AND {column} NOT LIKE '%/%/%/%')" if column == 'stream_manifest'
+                    else f"({column} IS NOT NULL AND {column} NOT LIKE '%/%/%')"
+                    for column in MEDIA_COLUMN_DIRS
+                )}
+                ORDER BY id LIMIT ?
+            """, (int(limit),)).fetchall()
+            return [self._row_to_dict(row) for row in rows]
+
+    def rename_media(self, renames):
+        """Rewrite media names in one transaction: every row holding old in column gets new.
+
+        renames is a list of (column, old, new). Renaming by value keeps dreams
+        that share a video consistent. Returns the number of rows changed.
+        """
+        changed = 0
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for column, old, new in renames:
+                if column not in MEDIA_COLUMN_DIRS:
+                    raise ValueError(f"Not a media column: {column}")
+                cursor.execute(f"UPDATE dreams SET {column} = ? WHERE {column} = ?", (new, old))
+                changed += cursor.rowcount
+            conn.commit()
+        return changed
+
+    def get_deleted_dreams(self, limit=100):
+        """Get soft-deleted dreams whose files have not been removed yet, oldest deletion first."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM dreams WHERE deleted_at IS NOT NULL ORDER BY deleted_at, id LIMIT ?', (int(limit),)
+            ).fetchall()
+            return [self._row_to_dict(row) for row in rows]
+
+    def purge_dream(self, dream_id):
+        """Permanently remove a soft-deleted dream's row once its files are gone."""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM dreams WHERE id = ? AND deleted_at IS NOT NULL', (dream_id,))
             conn.commit()
             return cursor.rowcount > 0
+
+    def referenced_media(self, filenames):
+        """Return the subset of filenames that any dream row (deleted ones included) points at."""
+        filenames = list(filenames)
+        if not filenames:
+            return set()
+        placeholders = ', '.join('?' for _ in filenames)
+        media_columns = (
+            'video_filename', 'audio_filename', 'thumb_filename', 'preview_filename', 'sprite_filename', 'stream_manifest',
+        )
+        where = ' OR '.join(f'{column} IN ({placeholders})' for column in media_columns)
+        with self._connection() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(media_columns)} FROM dreams WHERE {where}", filenames * len(media_columns)
+            ).fetchall()
+        names = set(filenames)
+        return {value for row in rows for value in row if value in names}
     
+    def export_dreams(self, after_id=0, limit=500):
+        """Get up to limit live dreams with id > after_id, oldest first, for a library export."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM dreams WHERE id > ? AND deleted_at IS NULL ORDER BY id LIMIT ?', (after_id, int(limit))
+            ).fetchall()
+            return [self._row_to_dict(row) for row in rows]
+
+    def import_dreams(self, rows):
+        """Insert a batch of exported dreams in one transaction.
+
+        Rows keep their created_at, last_played_at and archived_at but get new
+        ids. A row whose video and recording names are already in the library
+        is skipped, so re-running an import is harmless. Returns (id, inserted)
+        per row, the id of the existing dream for skipped rows.
+        """
+        columns = list(DreamData.model_fields) + list(IMPORT_EXTRA_COLUMNS)
+        results = []
+        inserted = []
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for row in rows:
+                existing = cursor.execute(
+                    'SELECT id FROM dreams WHERE video_filename = ? AND audio_filename = ? LIMIT 1',
+                    (row['video_filename'], row['audio_filename'])
+                ).fetchone()
+                if existing:
+                    results.append((existing[0], False))
+                    continue
+                # Missing timestamps fall back to the column defaults
+                present = [column for column in columns if column in DreamData.model_fields or row.get(column)]
+                values = [row.get(column) for column in present]
+                values[present.index('status')] = row.get('status') or 'completed'
+                cursor.execute(
+                    f"INSERT INTO dreams ({', '.join(present)}) VALUES ({', '.join('?' for _ in present)})",
+                    values
+                )
+                results.append((cursor.lastrowid, True))
+                inserted.append(dict(row, id=cursor.lastrowid))
+            conn.commit()
+            self._invalidate_id_index()
+        for dream in inserted:
+            self._index_dream(dream)
+        return results
+
+    @staticmethod
+    def _count_pipeline_run(cursor, dream_id, seconds, reused):
+        # Counted once, on the dream's day; deleting the dream later does not undo it
+        cursor.execute('''
+            INSERT INTO pipeline_stats_daily (day, generated, reused, generation_seconds)
+            SELECT date(created_at), ?, ?, ? FROM dreams WHERE id = ?
+            ON CONFLICT(day) DO UPDATE SET
+                generated = generated + excluded.generated, reused = reused + excluded.reused,
+                generation_seconds = generation_seconds + excluded.generation_seconds
+        ''', (int(not reused), int(reused), 0 if reused else seconds, dream_id))
+        if not reused:
+            cursor.execute('''
+                UPDATE generation_time_histogram SET runs = runs + 1 WHERE bucket = (
+                    SELECT COALESCE(MIN(bucket), (SELECT MAX(bucket) FROM generation_time_histogram))
+                    FROM generation_time_histogram WHERE le >= ?
+                )
+            ''', (seconds,))
+
+    def record_pipeline_failure(self):
+        """Count a pipeline run that ended without a dream in today's stats."""
+        with self._connection() as conn:
+            conn.execute('''
+                INSERT INTO pipeline_stats_daily (day, failed) VALUES (date('now'), 1)
+                ON CONFLICT(day) DO UPDATE SET failed = failed + 1
+            ''')
+            conn.commit()
+
+    def get_stats(self, days=30):
+        """Library and pipeline statistics read from the summary tables, never from dreams.
+
+        Returns all-time totals, an entry for each UTC day with activity in the
+        last `days` days, and the generation time histogram. The summary tables
+        are kept current as dreams are written (library counts by triggers, see
+        functions.migrations; pipeline runs by save_dream and
+        record_pipeline_failure), so the cost depends on the number of days,
+        not dreams.
+        """
+        since = f"-{max(int(days), 1) - 1} days"
+        with self._connection() as conn:
+            library = conn.execute(
+                'SELECT COALESCE(SUM(dreams), 0), COALESCE(SUM(prompt_chars), 0), COALESCE(SUM(reused), 0) '
+                'FROM dream_stats_daily'
+            ).fetchone()
+            pipeline = conn.execute(
+                'SELECT COALESCE(SUM(generated), 0), COALESCE(SUM(reused), 0), COALESCE(SUM(failed), 0), '
+                'COALESCE(SUM(generation_seconds), 0) FROM pipeline_stats_daily'
+            ).fetchone()
+            daily = conn.execute('''
+                WITH days AS (
+                    SELECT day FROM dream_stats_daily WHERE day >= date('now', ?)
+                    UNION SELECT day FROM pipeline_stats_daily WHERE day >= date('now', ?)
+                )
+                SELECT days.day, COALESCE(d.dreams, 0), COALESCE(d.prompt_chars, 0), COALESCE(p.generated, 0),
+                       COALESCE(p.reused, 0), COALESCE(p.failed, 0), COALESCE(p.generation_seconds, 0)
+                FROM days
+                LEFT JOIN dream_stats_daily AS d ON d.day = days.day
+                LEFT JOIN pipeline_stats_daily AS p ON p.day = days.day
+                ORDER BY days.day
+            ''', (since, since)).fetchall()
+            histogram = [
+                {'le': row[0], 'runs': row[1]}
+                for row in conn.execute('SELECT le, runs FROM generation_time_histogram ORDER BY bucket')
+            ]
+        totals = _stats_summary(library[0], library[1], *pipeline)
+        totals['reused_dreams'] = library[2]
+        totals['generation_seconds_p50'] = _histogram_quantile(histogram, 0.5)
+        totals['generation_seconds_p90'] = _histogram_quantile(histogram, 0.9)
+        return {
+            'totals': totals,
+            'daily': [dict(_stats_summary(*row[1:]), day=row[0]) for row in daily],
+            'generation_time_histogram': histogram,
+        }
+
+    def save_trace(self, trace_id, dream_id, started_at, spans):
+        """Store a pipeline run's spans (see functions.tracing); dream_id is None for a failed run.
+
+        Only the newest FAILED_TRACES_KEPT failed runs are kept; a dream's
+        trace is removed along with its row.
+        """
+        rows = [
+            (trace_id, seq, dream_id, started_at, span['name'], span.get('depth', 0), span['start_ms'],
+             span['duration_ms'] or 0, span.get('error'), json.dumps(span['attrs'], default=str) if span.get('attrs') else None)
+            for seq, span in enumerate(spans)
+        ]
+        with self._connection() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO pipeline_traces
+                    (trace_id, seq, dream_id, started_at, name, depth, start_ms, duration_ms, error, attrs)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            if dream_id is None:
+                conn.execute('''
+                    DELETE FROM pipeline_traces WHERE dream_id IS NULL AND trace_id NOT IN (
+                        SELECT trace_id FROM pipeline_traces WHERE dream_id IS NULL
+                        GROUP BY trace_id ORDER BY MAX(started_at) DESC, MAX(rowid) DESC LIMIT ?
+                    )
+                ''', (FAILED_TRACES_KEPT,))
+            conn.commit()
+
+    def _trace(self, conn, where, params):
+        rows = conn.execute(
+            f"SELECT * FROM pipeline_traces WHERE trace_id = ({where}) ORDER BY seq", params
+        ).fetchall()
+        if not rows:
+            return None
+        spans = [{
+            'name': row['name'], 'depth': row['depth'], 'start_ms': row['start_ms'],
+            'duration_ms': row['duration_ms'], 'error': row['error'],
+            'attrs': json.loads(row['attrs']) if row['attrs'] else {},
+        } for row in rows]
+        return {
+            'trace_id': rows[0]['trace_id'],
+            'dream_id': rows[0]['dream_id'],
+            'started_at': rows[0]['started_at'],
+            'status': 'failed' if rows[0]['dream_id'] is None else 'completed',
+            'total_ms': max(span['start_ms'] + span['duration_ms'] for span in spans),
+            'spans': spans,
+        }
+
+    def get_trace(self, trace_id):
+        """Get a pipeline run's trace and its spans in start order, or None."""
+        with self._connection() as conn:
+            return self._trace(conn, '?', (trace_id,))
+
+    def get_dream_trace(self, dream_id):
+        """Get the trace of the pipeline run that produced a dream, or None (e.g. for imported dreams)."""
+        with self._connection() as conn:
+            return self._trace(conn, 'SELECT trace_id FROM pipeline_traces WHERE dream_id = ? LIMIT 1', (dream_id,))
+
+    def list_traces(self, limit=20, failed=None):
+        """Summaries of the most recent pipeline runs, newest first; failed=True/False filters by outcome."""
+        condition = {None: '', True: 'WHERE dream_id IS NULL', False: 'WHERE dream_id IS NOT NULL'}[failed]
+        with self._connection() as conn:
+            rows = conn.execute(f'''
+                SELECT trace_id, MAX(dream_id) AS dream_id, MIN(started_at) AS started_at,
+                       MAX(start_ms + duration_ms) AS total_ms, COUNT(*) AS spans,
+                       MAX(CASE WHEN depth = 0 AND error IS NOT NULL THEN name END) AS failed_stage,
+                       MAX(CASE WHEN depth = 0 THEN error END) AS error
+                FROM pipeline_traces {condition}
+                GROUP BY trace_id ORDER BY MIN(started_at) DESC, MAX(rowid) DESC LIMIT ?
+            ''', (int(limit),)).fetchall()
+        return [
+            dict(self._row_to_dict(row), status='failed' if row['dream_id'] is None else 'completed')
+            for row in rows
+        ]
+
+    def register_blob(self, digest, size):
+        """Record a blob in the store (unreferenced until a dream points at it) and mark it freshly linked."""
+        with self._connection() as conn:
+            conn.execute('''
+                INSERT INTO media_blobs (digest, size) VALUES (?, ?)
+                ON CONFLICT(digest) DO UPDATE SET last_linked_at = CURRENT_TIMESTAMP
+            ''', (digest, int(size)))
+            conn.commit()
+
+    def get_blob(self, digest):
+        """Get a blob's size and reference count, or None if it is not in the store."""
+        with self._connection() as conn:
+            row = conn.execute('SELECT * FROM media_blobs WHERE digest = ?', (digest,)).fetchone()
+            return self._row_to_dict(row) if row else None
+
+    def get_unreferenced_blobs(self, min_age=3600, limit=200):
+        """Digests of blobs no dream has referenced for at least min_age seconds."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT digest FROM media_blobs WHERE refcount <= 0 AND last_linked_at <= datetime('now', ?) "
+                "ORDER BY last_linked_at LIMIT ?",
+                (f"-{int(min_age)} seconds", int(limit))
+            ).fetchall()
+            return [row[0] for row in rows]
+
+    def purge_blob(self, digest):
+        """Drop a blob's row if nothing references it. Returns whether its file may be removed."""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM media_blobs WHERE digest = ? AND refcount <= 0', (digest,))
+            conn.commit()
+            return cursor.rowcount > 0
+
     def _row_to_dict(self, row):
         """Convert a database row to a dictionary."""
         return dict(row) 
\ No newline at end of file
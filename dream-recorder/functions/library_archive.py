@@ -0,0 +1,388 @@
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from functions.blob_store import blob_path, file_digest, store_file, link_or_copy
+from functions.media_gc import touch_media
+from functions.media_backend import dream_media_objects, get_media_backend, publish_dream_media
+from functions.media_layout import MEDIA_COLUMN_DIRS, column_kind, media_path
+from functions.media_writer import staged
+
+# A library export is a ZIP holding:
+#   manifest.json        {"format": ARCHIVE_FORMAT, "exported_at": ...}
+#   dreams.ndjson        one dream row per line, oldest first
+#   media/<kind>/<name>  every media file those rows point at, stored uncompressed
+# It is written straight to the response (no temporary files, memory bounded
+# by one read chunk) and can be imported as a .zip or after unzipping.
+
+# Archive layout version; importers refuse archives newer than they understand
+ARCHIVE_FORMAT = 1
+# Read size when copying media into or out of an archive
+COPY_CHUNK_SIZE = 1024 * 1024
+# Dreams fetched per query while exporting
+EXPORT_BATCH_SIZE = 500
+# Dreams inserted per transaction while importing
+IMPORT_BATCH_SIZE = 200
+# ZIP timestamps cannot predate 1980
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+class _StreamSink(io.RawIOBase):
+    """Unseekable file object collecting what ZipFile writes, so it can be yielded as it is produced.
+
+    ZipFile notices it cannot seek and writes each entry's sizes in a data
+    descriptor after its contents instead of going back to patch the header.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _entry(name, compress_type=zipfile.ZIP_STORED, mtime=None, size=0):
+    info = zipfile.ZipInfo(name, max(time.localtime(mtime)[:6], ZIP_EPOCH))
+    info.compress_type = compress_type
+    info.external_attr = 0o644 << 16
+    # A known size lets ZipFile decide on ZIP64 up front
+    info.file_size = size
+    return info
+
+def _iter_dreams(dream_db, up_to=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield live dreams oldest first, a page at a time, stopping after id up_to."""
+    after_id = 0
+    while True:
+        batch = dream_db.export_dreams(after_id, batch_size)
+        for dream in batch:
+            if up_to is not None and dream['id'] > up_to:
+                return
+            yield dream
+        if len(batch) < batch_size:
+            return
+        after_id = batch[-1]['id']
+
+def _media_files(dream, seen):
+    """Yield (archive name, local path) for a dream's media files not exported yet."""
+    for kind, name, is_dir in dream_media_objects(dream):
+        path = media_path(kind, name)
+        if is_dir:
+            files = [
+                (f"{name}/{os.path.relpath(os.path.join(root, file_name), path).replace(os.sep, '/')}",
+                 os.path.join(root, file_name))
+                for root, _, names in os.walk(path) for file_name in sorted(names)
+            ]
+        else:
+            files = [(name, path)]
+        for member, file_path in files:
+            arcname = f"media/{kind}/{member}"
+            if arcname not in seen:
+                seen.add(arcname)
+                yield arcname, file_path
+
+def iter_export(dream_db, include_media=True, logger=None):
+    """Yield the library as a ZIP archive, chunk by chunk, for a streaming response.
+
+    Rows are paged out of the database and media files are copied in
+    COPY_CHUNK_SIZE reads, so memory stays flat however large the library
+    is. Media shared by several dreams is written once; files that have gone
+    missing are left out.
+    """
+    for chunk in _export_chunks(dream_db, include_media, logger):
+        # Servers may take an empty chunk for the end of the response
+        if chunk:
+            yield chunk
+
+def _export_chunks(dream_db, include_media, logger):
+    sink = _StreamSink()
+    exported = files = 0
+    try:
+        with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+            archive.writestr(_entry('manifest.json', zipfile.ZIP_DEFLATED), json.dumps({
+                'format': ARCHIVE_FORMAT,
+                'exported_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            }))
+            last_id = 0
+            with archive.open(_entry('dreams.ndjson', zipfile.ZIP_DEFLATED), 'w', force_zip64=True) as entry:
+                for dream in _iter_dreams(dream_db):
+                    entry.write((json.dumps(dream, default=str) + '\n').encode('utf-8'))
+                    last_id = dream['id']
+                    exported += 1
+                    yield sink.drain()
+            yield sink.drain()
+            if include_media:
+                seen = set()
+                # Dreams saved after the rows were written are not in this export
+                for dream in _iter_dreams(dream_db, up_to=last_id):
+                    for arcname, path in _media_files(dream, seen):
+                        try:
+                            source = open(path, 'rb')
+                        except FileNotFoundError:
+                            continue
+                        with source:
+                            stat = os.fstat(source.fileno())
+                            with archive.open(_entry(arcname, mtime=stat.st_mtime, size=stat.st_size), 'w') as entry:
+                                for block in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+                                    entry.write(block)
+                                    yield sink.drain()
+                        files += 1
+                        yield sink.drain()
+        yield sink.drain()
+    except Exception as e:
+        if logger:
+            logger.error(f"Error exporting the library: {str(e)}")
+        raise
+    if logger:
+        logger.info(f"Exported {exported} dreams and {files} media files")
+
+# =============================
+# Import
+# =============================
+
+class _ZipSource:
+    """An export read straight from its .zip file; members are copied out."""
+
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path)
+        self.names = set(self.archive.namelist())
+
+    def exists(self, member):
+        return member in self.names
+
+    def members(self, prefix):
+        return sorted(name for name in self.names if name.startswith(prefix) and not name.endswith('/'))
+
+    def open(self, member):
+        return self.archive.open(member)
+
+    def size(self, member):
+        return self.archive.getinfo(member).file_size
+
+    def copy(self, member, dst):
+        # ZipFile serializes reads of its file, so workers can extract concurrently
+        with self.archive.open(member) as source, staged(dst) as (tmp_path,):
+            with open(tmp_path, 'wb') as target:
+                shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+        return 'copy'
+
+    def close(self):
+        self.archive.close()
+
+class _DirectorySource:
+    """An export unzipped into a directory; members are hardlinked (or reflinked) when possible."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, member):
+        return os.path.join(self.path, *member.split('/'))
+
+    def exists(self, member):
+        return os.path.isfile(self._path(member))
+
+    def members(self, prefix):
+        root_dir = self._path(prefix.rstrip('/'))
+        return sorted(
+            f"{prefix}{os.path.relpath(os.path.join(root, name), root_dir).replace(os.sep, '/')}"
+            for root, _, names in os.walk(root_dir) for name in names
+        )
+
+    def open(self, member):
+        return open(self._path(member), 'rb')
+
+    def size(self, member):
+        return os.path.getsize(self._path(member))
+
+    def copy(self, member, dst):
+        return link_or_copy(self._path(member), dst)
+
+    def close(self):
+        pass
+
+def _check_name(name):
+    """Refuse media names that would land outside the media directories."""
+    parts = name.split('/')
+    if not name or name.startswith('/') or '\\' in name or '..' in parts or '' in parts:
+        raise ValueError(f"Unsafe media name in archive: {name!r}")
+
+def _media_members(row, source, exported=None):
+    """Yield (archive member, local path, kind) for each of a row's media files present in the archive.
+
+    exported is the row as it was exported, if _claim_names renamed some of
+    its media: members are read under the exported names.
+    """
+    objects = zip(dream_media_objects(row), dream_media_objects(exported or row))
+    for (kind, name, is_dir), (_, exported_name, _) in objects:
+        _check_name(name)
+        _check_name(exported_name)
+        prefix = f"media/{kind}/"
+        members = source.members(f"{prefix}{exported_name}/") if is_dir else [f"{prefix}{exported_name}"]
+        for member in members:
+            relative = member[len(prefix):]
+            _check_name(relative)
+            if source.exists(member):
+                yield member, media_path(kind, name + relative[len(exported_name):]), kind
+
+def _member_digest(source, member):
+    """SHA-256 hex digest of an archive member, as blob_store.file_digest gives for a file."""
+    digest = hashlib.sha256()
+    with source.open(member) as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _same_file(source, member, path, digest=None):
+    """Whether the local file at path holds the archive member's bytes.
+
+    Sizes settle most cases; a video is then checked against its row's digest
+    (free when the file is the digest's blob), anything else against the member.
+    """
+    if os.path.getsize(path) != source.size(member):
+        return False
+    if digest:
+        stored = blob_path(digest)
+        if os.path.exists(stored) and os.path.samefile(path, stored):
+            return True
+    return file_digest(path) == (digest or _member_digest(source, member))
+
+def _renamed(column, name, row, attempt):
+    """A name for media that collides with an unrelated local file, e.g. 2024/03/x.mp4 -> 2024/03/x_1a2b3c4d.mp4.
+
+    Derived from the exported row, so re-running an import picks the same name
+    (and then skips the dream, as it is already there).
+    """
+    identity = json.dumps([row.get('created_at'), row.get('user_prompt'), name, attempt])
+    token = hashlib.sha256(identity.encode()).hexdigest()[:8]
+    if column == 'stream_manifest':
+        return f"{os.path.dirname(name)}_{token}/{os.path.basename(name)}"
+    stem, ext = os.path.splitext(name)
+    return f"{stem}_{token}{ext}"
+
+def _claim_names(source, row, claimed):
+    """Rename, in row, media whose name is taken here by a different file; return the row as exported.
+
+    Imports skip files already in place, so two libraries whose legacy names
+    (dream_YYYYmmdd_HHMMSS.mp4) collide would otherwise leave the imported
+    dream pointing at unrelated media. claimed maps (kind, exported name) to
+    the name chosen, so dreams sharing media keep sharing it.
+    """
+    exported = dict(row)
+    for column in MEDIA_COLUMN_DIRS:
+        name = exported.get(column)
+        if not name:
+            continue
+        kind = column_kind(column)
+        if (kind, name) not in claimed:
+            _check_name(name)
+            member = f"media/{kind}/{name}"
+            digest = exported.get('video_digest') if column == 'video_filename' else None
+            chosen, attempt = name, 0
+            while source.exists(member) and os.path.exists(media_path(kind, chosen)) \
+                    and not _same_file(source, member, media_path(kind, chosen), digest):
+                attempt += 1
+                chosen = _renamed(column, name, exported, attempt)
+            claimed[(kind, name)] = chosen
+        row[column] = claimed[(kind, name)]
+    return exported
+
+def _import_file(dream_db, source, member, path, kind, logger=None):
+    """Copy one media file into place unless it is already there. Returns (method or None, video digest).
+
+    Either way the file's mtime is set to now: links and copies keep the
+    export's, and the orphan scan must not take the file for an old orphan
+    before the batch's rows are committed.
+    """
+    if os.path.exists(path):
+        touch_media(path)
+        return None, None
+    method = source.copy(member, path)
+    # Deduplication may swap the file for a link to an older blob, so touch it last
+    digest = store_file(dream_db, path, logger=logger) if kind == 'video' else None
+    touch_media(path)
+    return method, digest
+
+def _iter_batches(source, batch_size):
+    with io.TextIOWrapper(source.open('dreams.ndjson'), encoding='utf-8') as lines:
+        batch = []
+        for line in lines:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def import_library(dream_db, path, batch_size=IMPORT_BATCH_SIZE, workers=4, logger=None):
+    """Import an export (a .zip, or the directory it was unzipped into) into the library.
+
+    Works batch by batch: the batch's media is copied into place by a pool of
+    workers (hardlinked from an unzipped directory on the same filesystem),
+    then its rows are inserted in a single transaction, so a dream never
+    appears before its files. Dreams already in the library are skipped and
+    files already in place are kept, so an interrupted import can simply be
+    run again; media whose name is taken by a different file is imported
+    under a new name. Returns a report dict.
+    """
+    source = _DirectorySource(path) if os.path.isdir(path) else _ZipSource(path)
+    report = {'dreams_imported': 0, 'dreams_skipped': 0, 'files_copied': 0, 'files_linked': 0}
+    try:
+        if not (source.exists('manifest.json') and source.exists('dreams.ndjson')):
+            raise ValueError(f"{path} is not a dream library export")
+        with source.open('manifest.json') as f:
+            manifest = json.load(f)
+        if int(manifest.get('format', 0)) > ARCHIVE_FORMAT:
+            raise ValueError(f"Export format {manifest['format']} is newer than this recorder understands")
+        backend = get_media_backend(logger)
+        # Exported ids -> ids in this library, to re-point reused videos at their source dream
+        id_map = {}
+        # (kind, exported name) -> name in this library, see _claim_names
+        claimed = {}
+        with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+            for rows in _iter_batches(source, batch_size):
+                tasks = {}
+                for row in rows:
+                    exported = _claim_names(source, row, claimed)
+                    for member, media_file, kind in _media_members(row, source, exported):
+                        tasks.setdefault(media_file, (member, kind))
+                results = dict(zip(tasks, pool.map(
+                    lambda item: _import_file(dream_db, source, item[1][0], item[0], item[1][1], logger),
+                    tasks.items(),
+                )))
+                for method, _ in results.values():
+                    if method:
+                        report['files_linked' if method in ('hardlink', 'reflink') else 'files_copied'] += 1
+                for row in rows:
+                    _, digest = results.get(media_path('video', row['video_filename']), (None, None))
+                    if digest:
+                        row['video_digest'] = digest
+                    elif row.get('video_digest') and not dream_db.get_blob(row['video_digest']):
+                        # The video was already here but is not in this library's blob store
+                        row['video_digest'] = None
+                    row['source_dream_id'] = id_map.get(row.get('source_dream_id'))
+                for row, (dream_id, inserted) in zip(rows, dream_db.import_dreams(rows)):
+                    id_map[row.get('id')] = dream_id
+                    if inserted:
+                        report['dreams_imported'] += 1
+                        if backend.remote:
+                            publish_dream_media(dict(row, id=dream_id), backend=backend, logger=logger)
+                    else:
+                        report['dreams_skipped'] += 1
+                if logger:
+                    logger.info(f"Imported {report['dreams_imported']} dreams so far")
+    finally:
+        source.close()
+    return report
@@ -0,0 +1,272 @@
+import os
+import hmac
+import hashlib
+import mimetypes
+import requests
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import quote, urlsplit, parse_qsl
+from functions.config_loader import get_config
+from functions.media_layout import MEDIA_KINDS, column_kind, media_path
+from functions.metrics import external_call
+from functions.video import thumbnail_variant_filename
+
+# Payload hash sent with streamed uploads and downloads; S3 then skips body signing
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+# Chunk size used when proxying object reads
+STREAM_CHUNK_SIZE = 64 * 1024
+# Response headers passed through when a media route proxies an object
+PROXY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+# =============================
+# AWS Signature Version 4
+# =============================
+
+def _uri_encode(value, safe='-_.~'):
+    return quote(value, safe=safe)
+
+def _canonical_query(pairs):
+    return '&'.join(f"{_uri_encode(k)}={_uri_encode(v)}" for k, v in sorted(pairs))
+
+def _signing_key(secret_key, date, region):
+    key = f"AWS4{secret_key}".encode('utf-8')
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    return key
+
+def _signature(secret_key, date, region, amz_date, canonical_request):
+    scope = f"{date}/{region}/s3/aws4_request"
+    string_to_sign = '\n'.join((
+        'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ))
+    return hmac.new(_signing_key(secret_key, date, region), string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def sign_headers(method, url, region, access_key, secret_key, headers=None, payload_hash=UNSIGNED_PAYLOAD, now=None):
+    """Return headers (plus x-amz-date, x-amz-content-sha256 and Authorization) signing a request."""
+    now = now or datetime.now(timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    parsed = urlsplit(url)
+    headers = dict(headers or {})
+    headers.update({'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+    signed = {k.lower(): str(v).strip() for k, v in headers.items()}
+    signed['host'] = parsed.netloc
+    names = sorted(signed)
+    canonical_request = '\n'.join((
+        method, parsed.path or '/', _canonical_query(parse_qsl(parsed.query, keep_blank_values=True)),
+        ''.join(f"{name}:{signed[name]}\n" for name in names), ';'.join(names), payload_hash,
+    ))
+    signature = _signature(secret_key, amz_date[:8], region, amz_date, canonical_request)
+    headers['Authorization'] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{amz_date[:8]}/{region}/s3/aws4_request, "
+        f"SignedHeaders={';'.join(names)}, Signature={signature}"
+    )
+    return headers
+
+def presign_url(url, region, access_key, secret_key, expires=3600, now=None):
+    """Return a query-string signed GET URL valid for expires seconds."""
+    now = now or datetime.now(timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    parsed = urlsplit(url)
+    pairs = parse_qsl(parsed.query, keep_blank_values=True) + [
+        ('X-Amz-Algorithm', 'AWS4-HMAC-SHA256'),
+        ('X-Amz-Credential', f"{access_key}/{amz_date[:8]}/{region}/s3/aws4_request"),
+        ('X-Amz-Date', amz_date),
+        ('X-Amz-Expires', str(int(expires))),
+        ('X-Amz-SignedHeaders', 'host'),
+    ]
+    query = _canonical_query(pairs)
+    canonical_request = '\n'.join(('GET', parsed.path or '/', query, f"host:{parsed.netloc}\n", 'host', UNSIGNED_PAYLOAD))
+    signature = _signature(secret_key, amz_date[:8], region, amz_date, canonical_request)
+    return f"{parsed.scheme}://{parsed.netloc}{parsed.path}?{query}&X-Amz-Signature={signature}"
+
+# =============================
+# Backends
+# =============================
+
+class LocalMediaBackend:
+    """Media served straight from the local media directories (the default).
+
+    Pipeline outputs are already in place, so publishing and deleting are
+    no-ops; the media GC owns the local files.
+    """
+    name = 'local'
+    remote = False
+
+    def upload(self, kind, name, local_path):
+        pass
+
+    def delete(self, kind, name, recursive=False):
+        pass
+
+    def url(self, kind, name):
+        return None
+
+class S3MediaBackend:
+    """S3-compatible object storage (AWS S3, MinIO, Garage, R2, ...) over plain HTTP.
+
+    Requests are signed with SigV4 and addressed path-style as
+    <endpoint>/<bucket>/<prefix><kind>/<name>, so any recorder pointing at the
+    same bucket sees the same media. Uploads stream from disk and reads stream
+    back in chunks, so nothing is held in memory.
+    """
+    name = 's3'
+    remote = True
+
+    def __init__(self, endpoint_url, bucket, access_key, secret_key, region='us-east-1', prefix='',
+                 public_url=None, redirect=True, url_expiry=3600, session=None):
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.redirect = redirect
+        self.url_expiry = int(url_expiry)
+        self.session = session or requests.Session()
+
+    def key(self, kind, name):
+        if kind not in MEDIA_KINDS:
+            raise ValueError(f"Unknown media kind: {kind}")
+        return f"{self.prefix}{kind}/{name}"
+
+    def _url(self, key=''):
+        return f"{self.endpoint_url}/{_uri_encode(self.bucket)}/{_uri_encode(key, safe='/-_.~')}"
+
+    def _request(self, method, url, headers=None, **kwargs):
+        headers = sign_headers(method, url, self.region, self.access_key, self.secret_key, headers)
+        with external_call('s3', method.lower()) as call:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            # A missing object is an answer, not an error
+            call['status'] = 200 if response.status_code == 404 else response.status_code
+        return response
+
+    def upload(self, kind, name, local_path):
+        """Stream a local file (or every file under a local directory) to the bucket."""
+        if os.path.isdir(local_path):
+            for root, _, names in os.walk(local_path):
+                for file_name in names:
+                    relative = os.path.relpath(os.path.join(root, file_name), local_path).replace(os.sep, '/')
+                    self.upload(kind, f"{name}/{relative}", os.path.join(root, file_name))
+            return
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        with open(local_path, 'rb') as f:
+            response = self._request('PUT', self._url(self.key(kind, name)), headers={
+                'Content-Type': content_type, 'Content-Length': str(os.fstat(f.fileno()).st_size),
+            }, data=f)
+        response.raise_for_status()
+
+    def get(self, kind, name, byte_range=None):
+        """Open an object for streaming; byte_range is an HTTP Range header value. Returns the response."""
+        headers = {'Range': byte_range} if byte_range else None
+        return self._request('GET', self._url(self.key(kind, name)), headers=headers, stream=True)
+
+    def exists(self, kind, name):
+        return self._request('HEAD', self._url(self.key(kind, name))).status_code == 200
+
+    def _list(self, prefix):
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix}
+            if token:
+                query['continuation-token'] = token
+            url = f"{self._url()}?{_canonical_query(query.items())}"
+            response = self._request('GET', url)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            values = {}
+            for element in root.iter():
+                tag = element.tag.rsplit('}', 1)[-1]
+                if tag == 'Key':
+                    yield element.text
+                elif tag in ('IsTruncated', 'NextContinuationToken'):
+                    values[tag] = element.text
+            if values.get('IsTruncated') != 'true' or not values.get('NextContinuationToken'):
+                return
+            token = values['NextContinuationToken']
+
+    def delete(self, kind, name, recursive=False):
+        """Delete an object, or with recursive=True every object under name/."""
+        keys = list(self._list(self.key(kind, name) + '/')) if recursive else [self.key(kind, name)]
+        for key in keys:
+            response = self._request('DELETE', self._url(key))
+            if response.status_code not in (200, 204, 404):
+                response.raise_for_status()
+
+    def url(self, kind, name):
+        """URL a media route may redirect to, or None to proxy the object instead."""
+        key = _uri_encode(self.key(kind, name), safe='/-_.~')
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        if not self.redirect:
+            return None
+        return presign_url(self._url(self.key(kind, name)), self.region, self.access_key, self.secret_key, self.url_expiry)
+
+@lru_cache(maxsize=4)
+def _build_backend(spec, endpoint_url, bucket, access_key, secret_key, region, prefix, public_url, redirect, url_expiry):
+    if spec == 's3':
+        return S3MediaBackend(endpoint_url, bucket, access_key, secret_key, region, prefix, public_url, redirect, url_expiry)
+    return LocalMediaBackend()
+
+def get_media_backend(logger=None):
+    """Build (and cache) the backend named by MEDIA_BACKEND: 'local' (default) or 's3'."""
+    config = get_config()
+    spec = config.get('MEDIA_BACKEND') or 'local'
+    if spec == 's3' and not (config.get('S3_ENDPOINT_URL') and config.get('S3_BUCKET')):
+        if logger:
+            logger.warning("MEDIA_BACKEND is s3 but S3_ENDPOINT_URL or S3_BUCKET is not set, using local media")
+        spec = 'local'
+    elif spec not in ('local', 's3'):
+        if logger:
+            logger.warning(f"Unknown media backend {spec}, using local media")
+        spec = 'local'
+    return _build_backend(
+        spec, config.get('S3_ENDPOINT_URL'), config.get('S3_BUCKET'), config.get('S3_ACCESS_KEY_ID') or '',
+        config.get('S3_SECRET_ACCESS_KEY') or '', config.get('S3_REGION') or 'us-east-1', config.get('S3_PREFIX') or '',
+        config.get('S3_PUBLIC_URL') or None, str(config.get('MEDIA_REDIRECT', True)).lower() in ('1', 'true', 'yes'),
+        int(config.get('S3_URL_EXPIRY', 3600)),
+    )
+
+# =============================
+# Dream media
+# =============================
+
+def dream_media_objects(dream, shared=True):
+    """(kind, name, is_directory) of the media a dream owns, mirroring media_gc.dream_media_paths."""
+    objects = []
+    if shared:
+        objects.append(('video', dream['video_filename'], False))
+        if dream.get('thumb_filename'):
+            objects.append(('thumbs', dream['thumb_filename'], False))
+            # The largest size is the thumbnail itself
+            for size in (dream.get('thumb_sizes') or '').split(',')[:-1]:
+                objects.append(('thumbs', thumbnail_variant_filename(dream['thumb_filename'], size), False))
+        for column in ('preview_filename', 'sprite_filename'):
+            if dream.get(column):
+                objects.append((column_kind(column), dream[column], False))
+        if dream.get('stream_manifest'):
+            objects.append(('streams', os.path.dirname(dream['stream_manifest']), True))
+    if dream.get('audio_filename'):
+        objects.append(('audio', dream['audio_filename'], False))
+    return objects
+
+def publish_dream_media(dream, shared=True, backend=None, logger=None):
+    """Upload a new dream's media to the backend so every recorder sharing it can serve the dream.
+
+    shared=False uploads only the recording (a reused video is already
+    there). A no-op for local media. Missing files (e.g. a preview that
+    failed) are skipped; upload errors propagate so the pipeline reports them.
+    """
+    backend = backend or get_media_backend(logger)
+    if not backend.remote:
+        return 0
+    uploaded = 0
+    for kind, name, _ in dream_media_objects(dream, shared=shared):
+        path = media_path(kind, name)
+        if os.path.exists(path):
+            backend.upload(kind, name, path)
+            uploaded += 1
+    if logger:
+        logger.info(f"Published {uploaded} media objects to {backend.name}")
+    return uploaded
@@ -0,0 +1,301 @@
+import os
+import re
+import time
+import shutil
+from bisect import bisect_right
+from functions.config_loader import get_config
+from functions.video import thumbnail_variant_filename
+from functions.blob_store import release_blob, reap_unreferenced_blobs
+from functions.media_writer import LEFTOVER_RE, staged
+from functions.media_backend import get_media_backend, dream_media_objects
+
+# Media directories reconciled against the dreams table by the orphan scan
+ORPHAN_SCAN_DIRS = ('VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR')
+# A stream directory is collected whole; the table names it by this master playlist
+STREAM_MANIFEST = 'master.m3u8'
+# Kept in each scanned directory: the shard the incremental scan finished last
+ORPHAN_CURSOR_FILE = '.orphan_scan_cursor'
+# Shards scanned per media directory on each background pass when ORPHAN_SHARDS_PER_PASS is not configured
+DEFAULT_ORPHAN_SHARDS_PER_PASS = 4
+# Smaller thumbnail variants are named after their base thumbnail, e.g. thumb_x_160.webp
+THUMB_VARIANT_RE = re.compile(r'^(?P<stem>.+)_\d+(?P<ext>\.\w+)$')
+
+def _file_paths(path):
+    if os.path.isdir(path):
+        return [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    return [path]
+
+def path_size(path, seen=None):
+    """Bytes used by a file or directory tree (0 if it is gone).
+
+    Hardlinked files (see functions.blob_store) are counted once; pass the
+    same seen set to count them once across several paths.
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    for file_path in _file_paths(path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) not in seen:
+            seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+    return total
+
+def _unlinked_size(path):
+    """Bytes that removing path frees: files still linked elsewhere free nothing."""
+    total = 0
+    for file_path in _file_paths(path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        if stat.st_nlink == 1:
+            total += stat.st_size
+    return total
+
+def remove_path(path):
+    """Remove a file or directory tree and return the bytes reclaimed."""
+    size = _unlinked_size(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    else:
+        return 0
+    return size
+
+def touch_media(path):
+    """Set the mtime of a file, or of every file in a directory tree, to now.
+
+    The orphan scan skips files younger than ORPHAN_MIN_AGE, so media moved or
+    copied in with its old mtime is safe until the row naming it is committed.
+    """
+    for file_path in _file_paths(path):
+        os.utime(file_path)
+
+def dream_media_paths(dream, shared=True):
+    """Paths of the files a dream owns: its recording, plus its video and derived media when shared is True."""
+    config = get_config()
+    paths = []
+    if shared:
+        paths.append(os.path.join(config['VIDEOS_DIR'], dream['video_filename']))
+        if dream.get('thumb_filename'):
+            paths.append(os.path.join(config['THUMBS_DIR'], dream['thumb_filename']))
+            # The largest size is the thumbnail itself
+            for size in (dream.get('thumb_sizes') or '').split(',')[:-1]:
+                paths.append(os.path.join(config['THUMBS_DIR'], thumbnail_variant_filename(dream['thumb_filename'], size)))
+        for key in ('preview_filename', 'sprite_filename'):
+            if dream.get(key):
+                paths.append(os.path.join(config.get('PREVIEWS_DIR', 'media/previews'), dream[key]))
+        if dream.get('stream_manifest'):
+            paths.append(os.path.join(config.get('STREAMS_DIR', 'media/streams'), os.path.dirname(dream['stream_manifest'])))
+    paths.append(os.path.join(config['RECORDINGS_DIR'], dream['audio_filename']))
+    return paths
+
+def reap_deleted_dreams(dream_db, batch_size=100, logger=None):
+    """Remove the files of up to batch_size soft-deleted dreams, then purge their rows.
+
+    Media shared with another dream (live or still awaiting the reaper) is
+    kept, and a video blob is released with its last reference. A dream whose
+    files cannot be removed keeps its row and is retried on the next pass.
+    Returns (dreams purged, bytes reclaimed).
+    """
+    purged = reclaimed = 0
+    backend = get_media_backend(logger)
+    for dream in dream_db.get_deleted_dreams(limit=batch_size):
+        try:
+            shared = not dream_db.video_in_use(dream['video_filename'], exclude_id=dream['id'])
+            for path in dream_media_paths(dream, shared=shared):
+                reclaimed += remove_path(path)
+            # Published copies go too (a no-op for local media)
+            for kind, name, recursive in dream_media_objects(dream, shared=shared):
+                backend.delete(kind, name, recursive=recursive)
+            dream_db.purge_dream(dream['id'])
+            purged += 1
+            # Frees the video's bytes if this row held the blob's last reference
+            reclaimed += release_blob(dream_db, dream.get('video_digest'), logger)
+        except Exception as e:
+            if logger:
+                logger.error(f"Error removing files for deleted dream {dream['id']}: {str(e)}")
+    return purged, reclaimed
+
+def _is_referenced(name, referenced):
+    if name in referenced:
+        return True
+    match = THUMB_VARIANT_RE.match(name)
+    return bool(match) and f"{match['stem']}{match['ext']}" in referenced
+
+def _shards(directory):
+    """A media directory's shards, sorted: '.' (the files at its top) and each year/month or other subdirectory."""
+    shards = ['.']
+    for entry in os.scandir(directory):
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+        if re.fullmatch(r'\d{4}', entry.name):
+            shards.extend(
+                f"{entry.name}/{month.name}" for month in os.scandir(entry.path)
+                if month.is_dir() and not month.name.startswith('.')
+            )
+        else:
+            # Flat-layout stream directories, or anything else left at the top
+            shards.append(entry.name)
+    return sorted(shards)
+
+def _scan_shard(directory, shard, cutoff):
+    """Yield names (relative, "/"-separated, as stored in the table) of a shard's files older than cutoff.
+
+    A directory holding a STREAM_MANIFEST is yielded once, by its manifest's name.
+    """
+    top = directory if shard == '.' else os.path.join(directory, *shard.split('/'))
+    for root, dirs, names in os.walk(top):
+        # Hidden entries (e.g. .gitkeep) are never media
+        dirs[:] = [] if shard == '.' else [d for d in dirs if not d.startswith('.')]
+        relative = os.path.relpath(root, directory).replace(os.sep, '/')
+        if STREAM_MANIFEST in names:
+            dirs[:] = []
+            if os.path.getmtime(os.path.join(root, STREAM_MANIFEST)) < cutoff:
+                yield f"{relative}/{STREAM_MANIFEST}"
+            continue
+        for name in names:
+            # Staging leftovers of crashed writers are collected like orphans
+            if (name.startswith('.') and not LEFTOVER_RE.match(name)) or os.path.getmtime(os.path.join(root, name)) >= cutoff:
+                continue
+            yield name if relative == '.' else f"{relative}/{name}"
+
+def _next_shards(directory, shards, count):
+    """The count shards after the one recorded in the directory's cursor file, wrapping around."""
+    try:
+        with open(os.path.join(directory, ORPHAN_CURSOR_FILE)) as f:
+            cursor = f.read().strip()
+    except OSError:
+        cursor = None
+    start = bisect_right(shards, cursor) if cursor else 0
+    return (shards[start:] + shards[:start])[:count]
+
+def _save_cursor(directory, shard):
+    with staged(os.path.join(directory, ORPHAN_CURSOR_FILE)) as (tmp_path,):
+        with open(tmp_path, 'w') as f:
+            f.write(shard)
+
+def iter_orphan_batches(dream_db, batch_size=200, min_age=3600, dry_run=False, shards_per_pass=None, logger=None):
+    """Scan the media directories in batches, removing files (and stream directories) no dream row points at.
+
+    Each batch is checked against the table with a single query and yields
+    (paths removed, bytes reclaimed), so callers can pause between batches.
+    Files younger than min_age seconds are skipped: a pipeline that is still
+    running has written its media but not yet saved its dream.
+    With shards_per_pass, only that many year/month shards of each directory
+    are scanned, continuing from where the previous pass stopped (a cursor
+    file in the directory), so a pass costs the same however large the
+    library grows. Without it, every shard is scanned.
+    """
+    config = get_config()
+    cutoff = time.time() - min_age
+    for key in ORPHAN_SCAN_DIRS:
+        directory = config.get(key)
+        if not directory or not os.path.isdir(directory):
+            continue
+        shards = _shards(directory)
+        if shards_per_pass:
+            shards = _next_shards(directory, shards, shards_per_pass)
+        for shard in shards:
+            candidates = sorted(_scan_shard(directory, shard, cutoff))
+            for start in range(0, len(candidates), batch_size):
+                names = candidates[start:start + batch_size]
+                # Variants are looked up by their base thumbnail name
+                lookups = set(names)
+                lookups.update(
+                    f"{m['stem']}{m['ext']}" for m in map(THUMB_VARIANT_RE.match, names) if m
+                )
+                referenced = dream_db.referenced_media(sorted(lookups))
+                removed, reclaimed = [], 0
+                for name in names:
+                    if _is_referenced(name, referenced):
+                        continue
+                    path = os.path.join(directory, name)
+                    if name.endswith(f"/{STREAM_MANIFEST}"):
+                        path = os.path.dirname(path)
+                    try:
+                        reclaimed += path_size(path) if dry_run else remove_path(path)
+                        removed.append(path)
+                    except OSError as e:
+                        if logger:
+                            logger.warning(f"Could not remove orphaned file {path}: {str(e)}")
+                yield removed, reclaimed
+            if shards_per_pass and not dry_run:
+                _save_cursor(directory, shard)
+
+def collect_garbage(dream_db, batch_size=100, min_age=3600, pause=0.0, dry_run=False, scan_orphans=True,
+                    shards_per_pass=None, logger=None):
+    """Run one pass: reap every soft-deleted dream, then (if scan_orphans) remove orphaned files and blobs.
+
+    shards_per_pass limits the orphan scan as in iter_orphan_batches.
+
+    Sleeps pause seconds between batches so a background pass stays gentle.
+    Returns a report dict with counts and reclaimed bytes.
+    """
+    report = {'dreams_purged': 0, 'orphans_removed': 0, 'blobs_released': 0, 'bytes_reclaimed': 0}
+    if not dry_run:
+        while True:
+            purged, reclaimed = reap_deleted_dreams(dream_db, batch_size, logger)
+            report['dreams_purged'] += purged
+            report['bytes_reclaimed'] += reclaimed
+            if purged < batch_size:
+                break
+            time.sleep(pause)
+    batches = iter_orphan_batches(
+        dream_db, batch_size, min_age, dry_run, shards_per_pass=shards_per_pass, logger=logger,
+    ) if scan_orphans else ()
+    for removed, reclaimed in batches:
+        report['orphans_removed'] += len(removed)
+        report['bytes_reclaimed'] += reclaimed
+        if logger:
+            for path in removed:
+                logger.info(f"{'Would remove' if dry_run else 'Removed'} orphaned file {path}")
+        time.sleep(pause)
+    if scan_orphans and not dry_run:
+        # Blobs a failed pipeline registered but never saved a dream for
+        released, reclaimed = reap_unreferenced_blobs(dream_db, min_age, logger=logger)
+        report['blobs_released'] += released
+        report['bytes_reclaimed'] += reclaimed
+    if logger and (report['dreams_purged'] or report['orphans_removed'] or report['blobs_released']):
+        logger.info(
+            f"Media GC purged {report['dreams_purged']} dreams, {report['orphans_removed']} orphaned files "
+            f"and {report['blobs_released']} blobs, "
+            f"reclaiming {report['bytes_reclaimed'] / 1048576:.1f} MB"
+        )
+    return report
+
+def run_media_gc(dream_db, wakeup, logger=None):
+    """Background loop: a pass every MEDIA_GC_INTERVAL seconds.
+
+    Each pass's orphan scan covers ORPHAN_SHARDS_PER_PASS shards of every
+    media directory, resuming where the previous pass stopped.
+
+    wakeup is an Event (e.g. gevent.event.Event) that deletions set so their
+    files go promptly; those early passes only reap and skip the orphan scan.
+    """
+    last_scan = None
+    while True:
+        config = get_config()
+        interval = float(config.get('MEDIA_GC_INTERVAL', 600))
+        scan_orphans = last_scan is None or time.monotonic() - last_scan >= interval
+        if scan_orphans:
+            last_scan = time.monotonic()
+        try:
+            collect_garbage(
+                dream_db,
+                batch_size=int(config.get('MEDIA_GC_BATCH_SIZE', 100)),
+                min_age=float(config.get('ORPHAN_MIN_AGE', 3600)),
+                pause=0.05,
+                scan_orphans=scan_orphans,
+                shards_per_pass=int(config.get('ORPHAN_SHARDS_PER_PASS', DEFAULT_ORPHAN_SHARDS_PER_PASS)),
+                logger=logger,
+            )
+        except Exception as e:
+            if logger:
+                logger.error(f"Error collecting media garbage: {str(e)}")
+        wakeup.wait(timeout=interval)
+        wakeup.clear()
@@ -0,0 +1,74 @@
+import os
+import uuid
+from datetime import datetime
+from functions.config_loader import get_config
+
+# Where each media column's files live. Stored names are relative to these
+# directories and use "/" so they double as URL paths.
+MEDIA_COLUMN_DIRS = {
+    'video_filename': 'VIDEOS_DIR',
+    'audio_filename': 'RECORDINGS_DIR',
+    'thumb_filename': 'THUMBS_DIR',
+    'preview_filename': 'PREVIEWS_DIR',
+    'sprite_filename': 'PREVIEWS_DIR',
+    'stream_manifest': 'STREAMS_DIR',
+}
+
+# Columns describing a dream's generated media; a dream reusing another's video copies these
+SHARED_MEDIA_COLUMNS = (
+    'video_filename', 'thumb_filename', 'thumb_sizes', 'thumb_placeholder',
+    'preview_filename', 'sprite_filename', 'stream_manifest',
+    'duration', 'width', 'height', 'bitrate', 'video_codec', 'file_size', 'video_digest',
+)
+
+# URL segment (/media/<kind>/<name>) and storage key prefix of each media directory
+MEDIA_KINDS = {
+    'video': 'VIDEOS_DIR',
+    'audio': 'RECORDINGS_DIR',
+    'thumbs': 'THUMBS_DIR',
+    'previews': 'PREVIEWS_DIR',
+    'streams': 'STREAMS_DIR',
+}
+
+def column_kind(column):
+    """The media kind holding a dreams column's files, e.g. 'sprite_filename' -> 'previews'."""
+    return next(kind for kind, key in MEDIA_KINDS.items() if key == MEDIA_COLUMN_DIRS[column])
+
+def media_path(kind, name):
+    """Local path of a stored media name."""
+    return os.path.join(get_config()[MEDIA_KINDS[kind]], name)
+
+def shard_for(when=None):
+    """Return the year/month shard directory for a datetime (default now), e.g. '2025/06'."""
+    when = when or datetime.now()
+    return f"{when:%Y}/{when:%m}"
+
+def new_media_filename(prefix, ext, when=None):
+    """Return a new collision-free media name in the current shard.
+
+    e.g. 2025/06/generated_20250614_031522_1a2b3c4d.mp4. The random suffix
+    keeps pipelines started in the same second from overwriting each other.
+    """
+    when = when or datetime.now()
+    return f"{shard_for(when)}/{prefix}_{when:%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}{ext}"
+
+def derived_filename(filename, prefix, ext):
+    """Name a file derived from another in the same shard: 2025/06/x.mp4 -> 2025/06/preview_x.webp."""
+    directory, base = os.path.split(filename)
+    name = f"{prefix}_{os.path.splitext(base)[0]}{ext}"
+    return f"{directory}/{name}" if directory else name
+
+def is_sharded(column, value):
+    """Whether a stored media name already lives in a year/month shard."""
+    # Stream manifests are "<stream>/master.m3u8" even before sharding
+    return value.count('/') >= (3 if column == 'stream_manifest' else 2)
+
+def sharded_filename(column, value, created_at):
+    """Return the sharded name for a legacy flat media name, using the dream's creation date."""
+    if is_sharded(column, value):
+        return value
+    try:
+        when = datetime.strptime(str(created_at)[:7], '%Y-%m')
+    except ValueError:
+        when = None
+    return f"{shard_for(when)}/{value}"
@@ -0,0 +1,121 @@
+import os
+import re
+import uuid
+import shutil
+import tempfile
+from contextlib import contextmanager
+from functions.config_loader import get_config
+
+# Media only ever appears under its final name complete: writers produce a
+# hidden staging file next to the target (so the orphan scan and listings skip
+# it, and the final rename never crosses filesystems), fsync it and rename it
+# into place. A crash leaves at most a hidden leftover, never a torn file that
+# the media routes would serve.
+
+# Hidden names left behind by writers that crashed mid-write (see _staging_path, scratch_file)
+LEFTOVER_RE = re.compile(r'^\.(?:scratch_.*|.+\.[0-9a-f]{8}\.tmp(?:\.\w+)?)$')
+
+def _staging_path(final_path):
+    directory, base = os.path.split(final_path)
+    stem, ext = os.path.splitext(base)
+    # Keep the extension last so FFmpeg still picks the right muxer
+    return os.path.join(directory, f".{stem}.{uuid.uuid4().hex[:8]}.tmp{ext}")
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_tree(path):
+    if os.path.isdir(path):
+        for root, _, names in os.walk(path):
+            for name in names:
+                _fsync_path(os.path.join(root, name))
+    else:
+        _fsync_path(path)
+
+def _fsync_dir(directory):
+    """Persist a rename: the directory entry must reach the disk too (not possible on every platform)."""
+    try:
+        _fsync_path(directory or '.')
+    except OSError:
+        pass
+
+def _discard(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+@contextmanager
+def staged(*final_paths):
+    """Yield staging paths for final_paths on their own filesystem; commit them all on success.
+
+    On a clean exit every staged file is fsynced and atomically renamed over
+    its final path; on an exception the staged files are removed and the
+    final paths are left untouched.
+
+        with staged(video_path) as (tmp_path,):
+            ffmpeg.run(ffmpeg.output(..., tmp_path))
+    """
+    for path in final_paths:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_paths = tuple(_staging_path(path) for path in final_paths)
+    try:
+        yield tmp_paths
+        for tmp_path in tmp_paths:
+            if not os.path.exists(tmp_path):
+                raise FileNotFoundError(f"Nothing was written to {tmp_path}")
+            _fsync_path(tmp_path)
+        for tmp_path, final_path in zip(tmp_paths, final_paths):
+            os.replace(tmp_path, final_path)
+        for directory in {os.path.dirname(path) for path in final_paths}:
+            _fsync_dir(directory)
+    except BaseException:
+        for tmp_path in tmp_paths:
+            _discard(tmp_path)
+        raise
+
+@contextmanager
+def staged_dir(final_dir):
+    """Like staged, for a whole directory of outputs (e.g. an HLS stream): yields a staging directory."""
+    parent = os.path.dirname(final_dir.rstrip(os.sep))
+    os.makedirs(parent or '.', exist_ok=True)
+    tmp_dir = _staging_path(final_dir.rstrip(os.sep))
+    os.makedirs(tmp_dir)
+    try:
+        yield tmp_dir
+        _fsync_tree(tmp_dir)
+        # Directories cannot be renamed over non-empty ones, so a previous
+        # version is moved aside first and removed once the new one is live
+        old_dir = None
+        if os.path.exists(final_dir):
+            old_dir = _staging_path(final_dir.rstrip(os.sep))
+            os.replace(final_dir, old_dir)
+        os.replace(tmp_dir, final_dir)
+        _fsync_dir(parent)
+        if old_dir:
+            _discard(old_dir)
+    except BaseException:
+        _discard(tmp_dir)
+        raise
+
+@contextmanager
+def scratch_file(suffix='', near=None):
+    """Yield a path for an intermediate file that is removed afterwards.
+
+    Lives in MEDIA_SCRATCH_DIR when set (e.g. a RAM-backed /dev/shm, so
+    intermediates never touch the SD card); otherwise next to near, so reading
+    it back never crosses filesystems, or in the system temp directory.
+    """
+    directory = get_config().get('MEDIA_SCRATCH_DIR') or (os.path.dirname(near) if near else None)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix='.scratch_', dir=directory)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        _discard(path)
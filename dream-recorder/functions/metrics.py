@@ -0,0 +1,236 @@
+import math
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+import gevent
+
+try:
+    from gevent.monkey import get_original
+    # Metrics are also updated from the database worker threads
+    # (functions.db_threadpool), so their locks must be real OS locks
+    _native_lock = get_original('threading', 'Lock')
+except ImportError:  # pragma: no cover
+    _native_lock = threading.Lock
+
+# A minimal, dependency-free implementation of the Prometheus text exposition
+# format (version 0.0.4). Updates take a lock and touch a dict entry, so they
+# are cheap enough for the socket and database hot paths.
+
+# Content type of the /metrics response
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds between event loop lag probes
+LOOP_LAG_INTERVAL = 1.0
+# Walking the media tree is too slow for every scrape; usage is refreshed at most this often
+STORAGE_REFRESH_SECONDS = 60
+
+# Every metric created below, in exposition order
+REGISTRY = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        # An unlabelled metric is exposed (as zero) before its first update
+        self._values = {} if self.labels else {(): self._zero()}
+        self._lock = _native_lock()
+        REGISTRY.append(self)
+
+    def _zero(self):
+        return 0
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def clear(self):
+        with self._lock:
+            self._values = {} if self.labels else {(): self._zero()}
+
+    def _samples(self):
+        with self._lock:
+            return [(key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._samples():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. requests made."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. connected clients."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, plus their sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labels)
+
+    def _zero(self):
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # Index of the first bucket whose upper bound is >= value; len(buckets) is +Inf
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = self._zero()
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            return [(key, ([*counts], total, count)) for key, (counts, total, count) in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in self._samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(bound))])} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+def render_metrics():
+    """Every registered metric in the Prometheus text format."""
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+# =============================
+# Recorder metrics
+# =============================
+
+PIPELINE_STAGE_SECONDS = Histogram(
+    'dream_recorder_pipeline_stage_seconds', 'Duration of each dream pipeline stage.',
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600), labels=('stage',),
+)
+PIPELINE_RUNS = Counter(
+    'dream_recorder_pipeline_runs_total', 'Dream pipeline runs by outcome (generated, reused or failed).',
+    labels=('outcome',),
+)
+EXTERNAL_REQUESTS = Counter(
+    'dream_recorder_external_requests_total', 'Requests made to external APIs.', labels=('provider', 'operation'),
+)
+EXTERNAL_ERRORS = Counter(
+    'dream_recorder_external_errors_total', 'External API requests that raised or returned a non-2xx status.',
+    labels=('provider', 'operation'),
+)
+LUMA_POLL_ATTEMPTS = Histogram(
+    'dream_recorder_luma_poll_attempts', 'Status polls made per Luma generation.',
+    (1, 2, 3, 5, 10, 20, 30, 60, 120, 240),
+)
+SOCKETIO_CLIENTS = Gauge('dream_recorder_socketio_clients', 'Connected Socket.IO clients.')
+AUDIO_BYTES = Counter('dream_recorder_audio_ingested_bytes_total', 'Recorded audio bytes received from clients.')
+DB_CALL_SECONDS = Histogram(
+    'dream_recorder_db_call_seconds', 'Duration of database calls as seen by the calling greenlet, queueing included.',
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5), labels=('method',),
+)
+MEDIA_BYTES = Gauge('dream_recorder_media_bytes', 'Bytes used by each media directory.', labels=('dir',))
+MEDIA_QUOTA_BYTES = Gauge('dream_recorder_media_quota_bytes', 'Configured media storage quota (0 when unlimited).')
+DISK_FREE_BYTES = Gauge('dream_recorder_disk_free_bytes', 'Free space on the media filesystem.')
+LOOP_LAG_SECONDS = Histogram(
+    'dream_recorder_event_loop_lag_seconds', 'How late the gevent hub woke a sleeping greenlet.',
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+@contextmanager
+def external_call(provider, operation):
+    """Count a request to an external API.
+
+    It counts as an error if it raises, or if the caller sets a non-2xx
+    'status' on the yielded dict.
+    """
+    call = {}
+    EXTERNAL_REQUESTS.inc(provider=provider, operation=operation)
+    try:
+        yield call
+    except Exception:
+        EXTERNAL_ERRORS.inc(provider=provider, operation=operation)
+        raise
+    status = call.get('status')
+    if status is not None and not 200 <= status < 300:
+        EXTERNAL_ERRORS.inc(provider=provider, operation=operation)
+
+_storage_refreshed = None
+
+def update_storage_gauges(storage_usage, max_age=STORAGE_REFRESH_SECONDS):
+    """Refresh the media usage gauges from storage_usage() (see functions.storage) if they are older than max_age seconds.
+
+    storage_usage walks the media tree on the hub's threadpool, so a refresh
+    only delays the scrape that triggers it, never the event loop.
+    """
+    global _storage_refreshed
+    now = time.monotonic()
+    if _storage_refreshed is not None and now - _storage_refreshed < max_age:
+        return
+    _storage_refreshed = now
+    usage = storage_usage()
+    for key, size in usage['dirs'].items():
+        # VIDEOS_DIR -> videos
+        MEDIA_BYTES.set(size, dir=key.lower().removesuffix('_dir'))
+    MEDIA_QUOTA_BYTES.set(usage['quota_bytes'])
+    DISK_FREE_BYTES.set(usage['free_bytes'])
+
+def measure_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """Sleep for interval seconds and record how much later than that the hub resumed us."""
+    started = time.perf_counter()
+    gevent.sleep(interval)
+    lag = max(time.perf_counter() - started - interval, 0.0)
+    LOOP_LAG_SECONDS.observe(lag)
+    return lag
+
+def run_loop_lag_monitor(interval=LOOP_LAG_INTERVAL):
+    """Background loop probing the gevent hub; a blocked hub shows up as lag."""
+    while True:
+        measure_loop_lag(interval)
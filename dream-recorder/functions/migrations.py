@@ -0,0 +1,400 @@
+import time
+
+# Cursor value marking a backfill as finished; every row id is below it
+BACKFILL_DONE = 2 ** 63 - 1
+
+# =============================
+# Migration steps
+# =============================
+# Each step receives a cursor inside an open transaction. Steps must cope with
+# databases created before versioning existed, so they check before altering.
+
+def _create_dreams_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dreams (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_prompt TEXT NOT NULL,
+            generated_prompt TEXT NOT NULL,
+            audio_filename TEXT NOT NULL,
+            video_filename TEXT NOT NULL,
+            thumb_filename TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT
+        )
+    ''')
+
+def _add_media_columns(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(dreams)")}
+    for column, column_type in (
+        ('thumb_sizes', 'TEXT'), ('thumb_placeholder', 'TEXT'), ('preview_filename', 'TEXT'),
+        ('sprite_filename', 'TEXT'), ('stream_manifest', 'TEXT'), ('source_dream_id', 'INTEGER'),
+    ):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE dreams ADD COLUMN {column} {column_type}")
+
+def _add_listing_indexes(cursor):
+    # Newest-first listing and keyset pagination
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_dreams_created_at ON dreams (created_at DESC, id DESC)")
+    # Lets deletes check whether a video is still shared by another dream
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_dreams_video_filename ON dreams (video_filename)")
+
+def _add_full_text_search(cursor):
+    # Replace any index built before versioning; the backfill repopulates it
+    for trigger in ('dreams_fts_insert', 'dreams_fts_delete', 'dreams_fts_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS dreams_fts")
+    # External-content table: the text lives in dreams, the FTS table only holds the index
+    cursor.execute("""
+        CREATE VIRTUAL TABLE dreams_fts USING fts5(
+            user_prompt, generated_prompt,
+            content='dreams', content_rowid='id', tokenize='porter unicode61', prefix='2 3'
+        )
+    """)
+    # While the backfill runs, triggers only touch rows it has already indexed;
+    # it picks up everything past its cursor, including rows written meanwhile
+    indexed = "(SELECT cursor FROM schema_backfills WHERE name = 'dreams_fts')"
+    cursor.execute(f"""
+        CREATE TRIGGER dreams_fts_insert AFTER INSERT ON dreams WHEN new.id <= {indexed} BEGIN
+            INSERT INTO dreams_fts (rowid, user_prompt, generated_prompt)
+            VALUES (new.id, new.user_prompt, new.generated_prompt);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER dreams_fts_delete AFTER DELETE ON dreams WHEN old.id <= {indexed} BEGIN
+            INSERT INTO dreams_fts (dreams_fts, rowid, user_prompt, generated_prompt)
+            VALUES ('delete', old.id, old.user_prompt, old.generated_prompt);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER dreams_fts_update AFTER UPDATE OF user_prompt, generated_prompt ON dreams
+        WHEN old.id <= {indexed} BEGIN
+            INSERT INTO dreams_fts (dreams_fts, rowid, user_prompt, generated_prompt)
+            VALUES ('delete', old.id, old.user_prompt, old.generated_prompt);
+            INSERT INTO dreams_fts (rowid, user_prompt, generated_prompt)
+            VALUES (new.id, new.user_prompt, new.generated_prompt);
+        END
+    """)
+    schedule_backfill(cursor, 'dreams_fts')
+
+def _backfill_full_text_search(cursor, after_id, batch_size):
+    ids = [row[0] for row in cursor.execute(
+        "SELECT id FROM dreams WHERE id > ? ORDER BY id LIMIT ?", (after_id, batch_size)
+    )]
+    if not ids:
+        return after_id
+    cursor.execute("""
+        INSERT INTO dreams_fts (rowid, user_prompt, generated_prompt)
+        SELECT id, user_prompt, generated_prompt FROM dreams WHERE id BETWEEN ? AND ?
+    """, (ids[0], ids[-1]))
+    return ids[-1]
+
+def _add_media_metadata_columns(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(dreams)")}
+    for column, column_type in (
+        ('duration', 'REAL'), ('width', 'INTEGER'), ('height', 'INTEGER'),
+        ('bitrate', 'INTEGER'), ('video_codec', 'TEXT'), ('file_size', 'INTEGER'),
+    ):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE dreams ADD COLUMN {column} {column_type}")
+
+def _add_soft_delete(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(dreams)")}
+    if 'deleted_at' not in columns:
+        cursor.execute("ALTER TABLE dreams ADD COLUMN deleted_at TIMESTAMP")
+    # Listings only ever read live dreams, so the listing index skips deleted ones
+    cursor.execute("DROP INDEX IF EXISTS idx_dreams_created_at")
+    cursor.execute(
+        "CREATE INDEX idx_dreams_created_at ON dreams (created_at DESC, id DESC) WHERE deleted_at IS NULL"
+    )
+    # The reaper's queue of dreams whose files still have to be removed
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_dreams_deleted_at ON dreams (deleted_at) WHERE deleted_at IS NOT NULL"
+    )
+
+def _add_storage_tracking(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(dreams)")}
+    for column in ('last_played_at', 'archived_at'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE dreams ADD COLUMN {column} TIMESTAMP")
+    # Coldest-first order used when freeing space under the least-recently-played policy
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_dreams_last_played ON dreams (COALESCE(last_played_at, created_at), id) "
+        "WHERE deleted_at IS NULL"
+    )
+
+def _add_blob_store(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(dreams)")}
+    if 'video_digest' not in columns:
+        cursor.execute("ALTER TABLE dreams ADD COLUMN video_digest TEXT")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            last_linked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Unreferenced blobs are what the reaper looks for
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_blobs_unreferenced ON media_blobs (last_linked_at) WHERE refcount <= 0")
+    # Every dream row pointing at a blob holds one reference, soft-deleted rows
+    # included, so a blob is only released once its last row is purged
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS media_blobs_ref_insert AFTER INSERT ON dreams
+        WHEN new.video_digest IS NOT NULL BEGIN
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE digest = new.video_digest;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS media_blobs_ref_delete AFTER DELETE ON dreams
+        WHEN old.video_digest IS NOT NULL BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE digest = old.video_digest;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS media_blobs_ref_update AFTER UPDATE OF video_digest ON dreams
+        WHEN old.video_digest IS NOT new.video_digest BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE digest = old.video_digest;
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE digest = new.video_digest;
+        END
+    """)
+
+# Upper bounds (seconds) of the generation time histogram buckets; a final
+# bucket with no bound catches the rest
+GENERATION_TIME_BUCKETS = (30, 60, 90, 120, 180, 240, 300, 600)
+
+def _add_stats_tables(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(dreams)")}
+    if 'pipeline_seconds' not in columns:
+        cursor.execute("ALTER TABLE dreams ADD COLUMN pipeline_seconds REAL")
+    # Live dreams per UTC day, kept current by the triggers below so reading
+    # stats never scans dreams
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dream_stats_daily (
+            day TEXT PRIMARY KEY,
+            dreams INTEGER NOT NULL DEFAULT 0,
+            prompt_chars INTEGER NOT NULL DEFAULT 0,
+            reused INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Pipeline runs per UTC day: fresh generations, reused videos and failures
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_stats_daily (
+            day TEXT PRIMARY KEY,
+            generated INTEGER NOT NULL DEFAULT 0,
+            reused INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            generation_seconds REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_time_histogram (
+            bucket INTEGER PRIMARY KEY,
+            le REAL,
+            runs INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.executemany(
+        "INSERT OR IGNORE INTO generation_time_histogram (bucket, le) VALUES (?, ?)",
+        list(enumerate(GENERATION_TIME_BUCKETS)) + [(len(GENERATION_TIME_BUCKETS), None)]
+    )
+    add_live = """
+        INSERT INTO dream_stats_daily (day, dreams, prompt_chars, reused)
+        SELECT date(new.created_at), 1, length(new.user_prompt), new.source_dream_id IS NOT NULL
+        WHERE new.deleted_at IS NULL
+        ON CONFLICT(day) DO UPDATE SET
+            dreams = dreams + 1, prompt_chars = prompt_chars + excluded.prompt_chars, reused = reused + excluded.reused;
+    """
+    remove_live = """
+        UPDATE dream_stats_daily SET
+            dreams = dreams - 1, prompt_chars = prompt_chars - length(old.user_prompt),
+            reused = reused - (old.source_dream_id IS NOT NULL)
+        WHERE day = date(old.created_at) AND old.deleted_at IS NULL;
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS dream_stats_insert AFTER INSERT ON dreams BEGIN {add_live} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS dream_stats_delete AFTER DELETE ON dreams BEGIN {remove_live} END")
+    # Soft deletes, prompt edits and date changes move a dream's contribution
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS dream_stats_update
+        AFTER UPDATE OF created_at, user_prompt, source_dream_id, deleted_at ON dreams
+        WHEN old.created_at IS NOT new.created_at OR old.user_prompt IS NOT new.user_prompt
+          OR old.source_dream_id IS NOT new.source_dream_id OR old.deleted_at IS NOT new.deleted_at
+        BEGIN {remove_live} {add_live} END
+    """)
+    # A run is counted once, when the pipeline saves its dream; deleting the
+    # dream later does not undo it
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS pipeline_stats_insert AFTER INSERT ON dreams
+        WHEN new.pipeline_seconds IS NOT NULL BEGIN
+            INSERT INTO pipeline_stats_daily (day, generated, reused, generation_seconds)
+            VALUES (
+                date(new.created_at), new.source_dream_id IS NULL, new.source_dream_id IS NOT NULL,
+                CASE WHEN new.source_dream_id IS NULL THEN new.pipeline_seconds ELSE 0 END
+            )
+            ON CONFLICT(day) DO UPDATE SET
+                generated = generated + excluded.generated, reused = reused + excluded.reused,
+                generation_seconds = generation_seconds + excluded.generation_seconds;
+            UPDATE generation_time_histogram SET runs = runs + 1
+            WHERE new.source_dream_id IS NULL AND bucket = (
+                SELECT COALESCE(MIN(bucket), (SELECT MAX(bucket) FROM generation_time_histogram))
+                FROM generation_time_histogram WHERE le >= new.pipeline_seconds
+            );
+        END
+    """)
+    # Summarize the dreams already in the table
+    cursor.execute('''
+        INSERT OR REPLACE INTO dream_stats_daily (day, dreams, prompt_chars, reused)
+        SELECT date(created_at), COUNT(*), COALESCE(SUM(length(user_prompt)), 0), COUNT(source_dream_id)
+        FROM dreams WHERE deleted_at IS NULL GROUP BY date(created_at)
+    ''')
+
+def _add_pipeline_traces(cursor):
+    # One row per span of a pipeline run. dream_id is NULL for runs that failed
+    # before saving a dream; a dream's spans go when its row is purged.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_traces (
+            trace_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            dream_id INTEGER,
+            started_at TIMESTAMP NOT NULL,
+            name TEXT NOT NULL,
+            depth INTEGER NOT NULL DEFAULT 0,
+            start_ms REAL NOT NULL,
+            duration_ms REAL NOT NULL,
+            error TEXT,
+            attrs TEXT,
+            PRIMARY KEY (trace_id, seq)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_traces_dream ON pipeline_traces (dream_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_traces_started ON pipeline_traces (started_at)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pipeline_traces_purge AFTER DELETE ON dreams BEGIN
+            DELETE FROM pipeline_traces WHERE dream_id = old.id;
+        END
+    ''')
+
+def _count_pipeline_runs_on_save(cursor):
+    # Imported rows carry their exported pipeline_seconds, so an insert trigger
+    # counted every import as a new run; DreamDB.save_dream, which only the
+    # pipeline calls with pipeline_seconds, counts runs instead
+    cursor.execute('DROP TRIGGER IF EXISTS pipeline_stats_insert')
+
+# (version, name, step) in the order they are applied. Never renumber or edit a
+# released step; add a new one instead.
+MIGRATIONS = (
+    (1, 'create dreams table', _create_dreams_table),
+    (2, 'add media columns', _add_media_columns),
+    (3, 'add listing indexes', _add_listing_indexes),
+    (4, 'add full-text search', _add_full_text_search),
+    (5, 'add media metadata columns', _add_media_metadata_columns),
+    (6, 'add soft delete', _add_soft_delete),
+    (7, 'add storage tracking', _add_storage_tracking),
+    (8, 'add blob store', _add_blob_store),
+    (9, 'add stats tables', _add_stats_tables),
+    (10, 'add pipeline traces', _add_pipeline_traces),
+    (11, 'count pipeline runs on save', _count_pipeline_runs_on_save),
+)
+
+# Online backfills scheduled by migrations: name -> batch function. A batch
+# function indexes rows with id > after_id (at most batch_size of them) and
+# returns the new cursor.
+BACKFILLS = {
+    'dreams_fts': _backfill_full_text_search,
+}
+
+# =============================
+# Runner
+# =============================
+
+def _ensure_bookkeeping(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            duration_ms REAL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+def schedule_backfill(cursor, name):
+    """Queue (or restart) an online backfill; empty tables are marked done straight away."""
+    has_rows = cursor.execute("SELECT 1 FROM dreams LIMIT 1").fetchone() is not None
+    cursor.execute('''
+        INSERT OR REPLACE INTO schema_backfills (name, cursor, completed_at)
+        VALUES (?, ?, CASE WHEN ? THEN NULL ELSE CURRENT_TIMESTAMP END)
+    ''', (name, 0 if has_rows else BACKFILL_DONE, has_rows))
+
+def current_version(conn):
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def migrate(conn, logger=None):
+    """Apply pending migrations, each in its own transaction, and return [(version, name, ms)]."""
+    _ensure_bookkeeping(conn)
+    applied = []
+    version = current_version(conn)
+    for step_version, name, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        started = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        # Another process (e.g. a script started with the app) may have applied it
+        # while this one waited for the write lock
+        if current_version(conn) >= step_version:
+            conn.rollback()
+            continue
+        try:
+            step(cursor)
+            duration_ms = (time.perf_counter() - started) * 1000
+            cursor.execute(
+                "INSERT INTO schema_version (version, name, duration_ms) VALUES (?, ?, ?)",
+                (step_version, name, duration_ms)
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            if logger:
+                logger.error(f"Migration {step_version} ({name}) failed: {str(e)}")
+            raise
+        applied.append((step_version, name, duration_ms))
+        if logger:
+            logger.info(f"Applied migration {step_version} ({name}) in {duration_ms:.1f} ms")
+    if applied and logger:
+        total = sum(ms for _, _, ms in applied)
+        logger.info(f"Schema now at version {applied[-1][0]}: {len(applied)} migrations in {total:.1f} ms")
+    return applied
+
+def pending_backfills(conn):
+    return [row[0] for row in conn.execute("SELECT name FROM schema_backfills WHERE completed_at IS NULL")]
+
+def run_backfill_batch(conn, name, batch_size=500):
+    """Run one committed batch of a backfill. Returns False once it has finished."""
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        row = cursor.execute("SELECT cursor FROM schema_backfills WHERE name = ? AND completed_at IS NULL", (name,)).fetchone()
+        if row is None:
+            conn.rollback()
+            return False
+        new_cursor = BACKFILLS[name](cursor, row[0], batch_size)
+        last_id = cursor.execute("SELECT MAX(id) FROM dreams").fetchone()[0] or 0
+        done = new_cursor >= last_id
+        cursor.execute(
+            "UPDATE schema_backfills SET cursor = ?, completed_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END WHERE name = ?",
+            (BACKFILL_DONE if done else new_cursor, done, name)
+        )
+        conn.commit()
+        return not done
+    except Exception:
+        conn.rollback()
+        raise
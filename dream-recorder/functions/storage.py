@@ -0,0 +1,168 @@
+import os
+import shutil
+import ffmpeg
+import gevent
+from datetime import datetime, timezone
+from functions.config_loader import get_config
+from functions.media_gc import path_size, remove_path, reap_deleted_dreams
+from functions.video import media_metadata
+from functions.blob_store import store_video, release_blob
+from functions.media_writer import staged
+from functions.media_backend import get_media_backend
+
+MB = 1024 * 1024
+# Media directories counted against STORAGE_QUOTA_MB
+STORAGE_DIRS = ('VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR', 'MEDIA_BLOBS_DIR')
+# Dreams fetched per round while freeing space
+STORAGE_BATCH_SIZE = 20
+# Eviction never deletes the library below this many dreams
+EVICT_KEEP_MINIMUM = 10
+
+def storage_usage():
+    """Return bytes used per media directory, their total, the quota and free disk space.
+
+    Measuring stats every media file, so it runs on the gevent hub's
+    threadpool: only the calling greenlet waits for the walk, not the event
+    loop serving audio and requests.
+    """
+    return gevent.get_hub().threadpool.apply(_measure_usage)
+
+def _measure_usage():
+    config = get_config()
+    # Blobs and the media names linked to them share bytes, which count once
+    seen = set()
+    dirs = {key: path_size(config[key], seen) for key in STORAGE_DIRS if config.get(key)}
+    existing = [config[key] for key in STORAGE_DIRS if config.get(key) and os.path.isdir(config[key])]
+    return {
+        'dirs': dirs,
+        'used_bytes': sum(dirs.values()),
+        'quota_bytes': int(float(config.get('STORAGE_QUOTA_MB', 0)) * MB),
+        'free_bytes': shutil.disk_usage(existing[0] if existing else '.').free,
+    }
+
+def _shortfall(usage, reserve):
+    """Bytes that must be freed so a new generation of reserve bytes fits the quota and the disk."""
+    over_quota = usage['used_bytes'] + reserve - usage['quota_bytes'] if usage['quota_bytes'] else 0
+    return max(over_quota, reserve - usage['free_bytes'], 0)
+
+def _transcode(source, target, logger=None, **options):
+    """Run a single-input FFmpeg encode through a staging file that atomically replaces target."""
+    with staged(target) as (tmp_path,):
+        try:
+            ffmpeg.run(ffmpeg.output(ffmpeg.input(source), tmp_path, **options), overwrite_output=True, capture_stderr=True)
+        except ffmpeg.Error as e:
+            if logger:
+                logger.error(f"FFmpeg error: {e.stderr.decode()}")
+            raise
+
+def archive_dream(dream_db, dream, logger=None):
+    """Move a cold dream's media to the archive tier and return the bytes reclaimed.
+
+    The video is replaced by a low-bitrate rendition (for every dream sharing
+    it), its adaptive stream is dropped (playback falls back to the MP4), and a
+    WAV recording is re-encoded as Opus. A remote media backend gets the same
+    changes. Thumbnails and previews are kept so the library looks the same.
+    """
+    config = get_config()
+    backend = get_media_backend(logger)
+    before = 0
+    video_path = os.path.join(config['VIDEOS_DIR'], dream['video_filename'])
+    # Same UTC format as SQLite's CURRENT_TIMESTAMP
+    updates = {'archived_at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}
+    if os.path.exists(video_path):
+        before += path_size(video_path)
+        height = int(config.get('ARCHIVE_VIDEO_HEIGHT', 360))
+        _transcode(
+            video_path, video_path, logger,
+            vf=f"scale=-2:'min({height},ih)'", vcodec='libx264', preset='veryfast',
+            **{'b:v': config.get('ARCHIVE_VIDEO_BITRATE', '400k')}, pix_fmt='yuv420p', an=None,
+            movflags='+faststart',
+        )
+        updates.update(media_metadata(video_path, logger))
+        updates['video_digest'] = store_video(dream_db, dream['video_filename'], logger)
+        backend.upload('video', dream['video_filename'], video_path)
+    if dream.get('stream_manifest'):
+        before += remove_path(os.path.join(config.get('STREAMS_DIR', 'media/streams'), os.path.dirname(dream['stream_manifest'])))
+        backend.delete('streams', os.path.dirname(dream['stream_manifest']), recursive=True)
+        updates['stream_manifest'] = None
+    dream_db.update_video_dreams(dream['video_filename'], updates)
+    if dream.get('video_digest') != updates.get('video_digest', dream.get('video_digest')):
+        # The original's blob still holds the full-size bytes
+        release_blob(dream_db, dream.get('video_digest'), logger)
+    # The recording belongs to this dream alone
+    audio_path = os.path.join(config['RECORDINGS_DIR'], dream['audio_filename'])
+    if dream['audio_filename'].endswith('.wav') and os.path.exists(audio_path):
+        opus_filename = f"{os.path.splitext(dream['audio_filename'])[0]}.ogg"
+        opus_path = os.path.join(config['RECORDINGS_DIR'], opus_filename)
+        before += path_size(audio_path)
+        _transcode(audio_path, opus_path, logger, acodec='libopus', **{'b:a': config.get('ARCHIVE_AUDIO_BITRATE', '24k')})
+        backend.upload('audio', opus_filename, opus_path)
+        dream_db.update_dream(dream['id'], {'audio_filename': opus_filename})
+        os.remove(audio_path)
+        backend.delete('audio', dream['audio_filename'])
+        before -= path_size(opus_path)
+    reclaimed = max(before - (updates.get('file_size') or 0), 0)
+    if logger:
+        logger.info(f"Archived dream {dream['id']}, reclaiming {reclaimed / MB:.1f} MB")
+    return reclaimed
+
+def ensure_capacity(dream_db, logger=None):
+    """Make room for a new generation before it starts.
+
+    Needs STORAGE_RESERVE_MB free both under STORAGE_QUOTA_MB (0 disables the
+    quota) and on the disk. Cold dreams, ordered by STORAGE_POLICY, are first
+    archived; if STORAGE_EVICT_DELETE is set, the coldest are then deleted
+    (never below EVICT_KEEP_MINIMUM dreams).
+    Returns a report with usage before and after; 'ok' is False when the
+    space could not be found.
+    """
+    config = get_config()
+    reserve = int(float(config.get('STORAGE_RESERVE_MB', 100)) * MB)
+    policy = config.get('STORAGE_POLICY', 'lru')
+    usage = storage_usage()
+    needed = _shortfall(usage, reserve)
+    report = {'usage': usage, 'needed_bytes': needed, 'archived': 0, 'evicted': 0, 'reclaimed_bytes': 0}
+    if needed:
+        if logger:
+            logger.info(f"Storage needs {needed / MB:.1f} MB freed ({usage['used_bytes'] / MB:.1f} MB used)")
+        # Archive first: the dreams stay, only their media gets smaller
+        failed = set()
+        while report['reclaimed_bytes'] < needed:
+            candidates = [
+                d for d in dream_db.get_coldest_dreams(policy, STORAGE_BATCH_SIZE + len(failed), archived=False)
+                if d['id'] not in failed
+            ]
+            if not candidates:
+                break
+            for dream in candidates:
+                try:
+                    report['reclaimed_bytes'] += archive_dream(dream_db, dream, logger)
+                    report['archived'] += 1
+                except Exception as e:
+                    failed.add(dream['id'])
+                    if logger:
+                        logger.warning(f"Could not archive dream {dream['id']}: {str(e)}")
+                if report['reclaimed_bytes'] >= needed:
+                    break
+        # Then, only if allowed, delete the coldest dreams outright
+        evict = str(config.get('STORAGE_EVICT_DELETE', False)).lower() in ('1', 'true', 'yes')
+        while evict and report['reclaimed_bytes'] < needed:
+            candidates = dream_db.get_coldest_dreams(policy, EVICT_KEEP_MINIMUM + 1)
+            if len(candidates) <= EVICT_KEEP_MINIMUM:
+                break
+            dream_db.delete_dream(candidates[0]['id'])
+            _, reclaimed = reap_deleted_dreams(dream_db, logger=logger)
+            report['reclaimed_bytes'] += reclaimed
+            report['evicted'] += 1
+            if logger:
+                logger.info(f"Evicted dream {candidates[0]['id']} to free storage")
+        usage = storage_usage()
+    report['usage_after'] = usage
+    report['ok'] = _shortfall(usage, reserve) == 0
+    if logger:
+        logger.info(
+            f"Storage: {usage['used_bytes'] / MB:.1f} MB used"
+            + (f" of {usage['quota_bytes'] / MB:.0f} MB quota" if usage['quota_bytes'] else '')
+            + f", {usage['free_bytes'] / MB:.0f} MB free on disk"
+        )
+    return report
@@ -0,0 +1,83 @@
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functions.metrics import PIPELINE_STAGE_SECONDS
+
+# The trace collecting spans for the pipeline run in this greenlet, if any.
+# Each greenlet has its own context, so concurrent runs never mix their spans.
+_current_trace = ContextVar('pipeline_trace', default=None)
+
+class Trace:
+    """Timed spans of one pipeline run, kept in memory until the run ends.
+
+    Span offsets and durations are milliseconds on the monotonic clock,
+    relative to the start of the run; started_at is the wall-clock start (UTC,
+    in SQLite's CURRENT_TIMESTAMP format) for display.
+    """
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.started_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        self.spans = []
+        self._origin = time.monotonic()
+        self._open = []
+        self._token = None
+
+    def elapsed_ms(self):
+        return round((time.monotonic() - self._origin) * 1000, 1)
+
+    def start(self):
+        """Make this the current trace, so span() calls below it are recorded here."""
+        self._token = _current_trace.set(self)
+        return self
+
+    def stop(self):
+        if self._token is not None:
+            _current_trace.reset(self._token)
+            self._token = None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        # Spans are listed in the order they start; depth is how many were open then
+        record = {
+            'name': name, 'depth': len(self._open), 'start_ms': self.elapsed_ms(),
+            'duration_ms': None, 'error': None, 'attrs': attrs,
+        }
+        self.spans.append(record)
+        self._open.append(record)
+        try:
+            yield attrs
+        except BaseException as e:
+            record['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            record['duration_ms'] = round(self.elapsed_ms() - record['start_ms'], 1)
+            self._open.remove(record)
+            PIPELINE_STAGE_SECONDS.observe(record['duration_ms'] / 1000, stage=name)
+
+@contextmanager
+def span(name, **attrs):
+    """Time a pipeline stage as a span of the current trace; a no-op when no trace is active.
+
+    Yields the span's attribute dict, which the stage may add to (e.g. a
+    poll's state) until the trace is saved. An exception escaping the block is
+    recorded as the span's error and re-raised.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    with trace.span(name, **attrs) as span_attrs:
+        yield span_attrs
+
+def save_trace(dream_db, trace, dream_id=None, logger=None):
+    """Persist a finished run's spans, keyed by its dream (None for a failed run).
+
+    Tracing is diagnostics only: errors are logged, never raised into the pipeline.
+    """
+    try:
+        dream_db.save_trace(trace.trace_id, dream_id, trace.started_at, trace.spans)
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not save the pipeline trace: {str(e)}")
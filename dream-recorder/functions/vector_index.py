@@ -0,0 +1,299 @@
+import os
+import re
+import json
+import zlib
+import math
+import fcntl
+import heapq
+import logging
+import numpy as np
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Width of the hashed bag-of-words vectors
+HASHING_DIM = 256
+# Slots added to the index file each time it fills up
+INDEX_GROWTH = 1024
+# Words too common to say anything about a dream's imagery
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from had has have he her his i in into is it its me my "
+    "of on or our she so that the their them then there they this to was we were with you your".split()
+)
+
+class HashingEmbedder:
+    """Dependency-free embedder: hashed, sublinear-weighted word unigrams and bigrams.
+
+    It only captures shared vocabulary, not meaning, but it is deterministic,
+    fast on a Raspberry Pi and good enough to group recurring dreams.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim=HASHING_DIM):
+        self.dim = dim
+
+    def _features(self, text):
+        words = [w for w in re.findall(r"[a-z0-9']+", text.lower()) if w not in STOPWORDS]
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for feature in self._features(text):
+                # crc32 is stable across processes, unlike hash()
+                h = zlib.crc32(feature.encode('utf-8'))
+                key = (h % self.dim, 1.0 if h & 0x80000000 else -1.0)
+                counts[key] = counts.get(key, 0) + 1
+            for (column, sign), count in counts.items():
+                vectors[row, column] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+class SentenceTransformerEmbedder:
+    """Local CPU sentence-transformers model (optional dependency)."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.name = f"sentence-transformers:{model_name}"
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        return np.asarray(self.model.encode(list(texts), normalize_embeddings=True), dtype=np.float32)
+
+def get_embedder(spec, logger=None):
+    """Build the embedder named by the EMBEDDER config value.
+
+    'hashing' (the default) needs nothing extra; 'sentence-transformers:<model>'
+    loads a local model and falls back to hashing if it is unavailable.
+    """
+    if spec and spec.startswith('sentence-transformers:'):
+        try:
+            return SentenceTransformerEmbedder(spec.split(':', 1)[1])
+        except Exception as e:
+            if logger:
+                logger.warning(f"Could not load embedder {spec}, falling back to hashing: {e}")
+    elif spec and spec != 'hashing' and logger:
+        logger.warning(f"Unknown embedder {spec}, falling back to hashing")
+    return HashingEmbedder()
+
+def dream_text(dream):
+    """Text embedded for a dream: what was said plus the imagery it produced."""
+    return f"{dream.get('user_prompt') or ''}\n{dream.get('generated_prompt') or ''}"
+
+class VectorIndex:
+    """Memory-mapped matrix of unit vectors keyed by dream ID.
+
+    Vectors live in <base>.vectors.npy and their dream IDs in <base>.ids.npy,
+    both preallocated and grown in INDEX_GROWTH steps so adds are in-place
+    writes. ID 0 marks a free slot; freed slots are reused by later adds. A
+    query is a single matrix-vector product over the mapped rows.
+
+    The app and CLI scripts may open the same index at once. Every operation
+    holds a lock on <base>.vectors.lock (exclusive for writes), and every write
+    rewrites <base>.vectors.json, so a process whose files have changed under
+    it reloads them before going on. The metadata also records the number of
+    dreams indexed and the highest ID, for comparison with the database.
+    """
+
+    def __init__(self, base_path, embedder, logger=None):
+        self.embedder = embedder
+        self.logger = logger
+        self.vectors_path = f"{base_path}.vectors.npy"
+        self.ids_path = f"{base_path}.ids.npy"
+        self.meta_path = f"{base_path}.vectors.json"
+        self.lock_path = f"{base_path}.vectors.lock"
+        self.vectors = None
+        self.ids = None
+        self.slots = {}
+        self.size = 0
+        # Free slots below size, as a heap so adds fill the lowest first
+        self.free = []
+        self._lock_file = None
+        # Identity of the metadata file the mapped state matches
+        self._stamp = None
+
+    @property
+    def exists(self):
+        return all(os.path.exists(p) for p in (self.vectors_path, self.ids_path, self.meta_path))
+
+    def _meta(self):
+        return {'embedder': self.embedder.name, 'dim': self.embedder.dim}
+
+    def watermark(self):
+        """(dreams indexed, highest dream ID) of the mapped index."""
+        return len(self.slots), max(self.slots, default=0)
+
+    def _meta_stamp(self):
+        try:
+            stat = os.stat(self.meta_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _write_meta(self):
+        dreams, max_id = self.watermark()
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(self._meta(), dreams=dreams, max_id=max_id), f)
+        # Replaced rather than rewritten, so other processes see a new file
+        os.replace(tmp_path, self.meta_path)
+        self._stamp = self._meta_stamp()
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            if self.vectors is not None and self._meta_stamp() != self._stamp:
+                # Another process wrote the index since we mapped it
+                if not self.load():
+                    raise RuntimeError("The vector index was replaced by an incompatible one")
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def load(self, watermark=None):
+        """Map the index files.
+
+        Returns False if they are missing, were built by another embedder or,
+        when a (dreams, highest ID) watermark of the database is given, do not
+        match it.
+        """
+        if not self.exists:
+            return False
+        stamp = self._meta_stamp()
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if {key: meta.get(key) for key in ('embedder', 'dim')} != self._meta():
+            return False
+        if watermark is not None and (meta.get('dreams'), meta.get('max_id')) != tuple(watermark):
+            return False
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+        self.ids = np.load(self.ids_path, mmap_mode='r+')
+        used = np.flatnonzero(self.ids)
+        self.size = int(used[-1]) + 1 if len(used) else 0
+        self.slots = {int(self.ids[slot]): int(slot) for slot in used}
+        self.free = [int(slot) for slot in np.flatnonzero(self.ids[:self.size] == 0)]
+        self._stamp = stamp
+        return True
+
+    def open(self, watermark, dreams):
+        """Load the index, rebuilding it from dreams() if it is missing, foreign or out of step with watermark."""
+        with self._locked(exclusive=True):
+            if not self.load(watermark):
+                if self.logger:
+                    self.logger.info("Vector index missing or out of date, rebuilding it")
+                self._rebuild(dreams())
+
+    def _allocate(self, capacity):
+        """(Re)create the index files with room for capacity vectors, keeping current rows."""
+        dim = self.embedder.dim
+        tmp_vectors, tmp_ids = f"{self.vectors_path}.tmp", f"{self.ids_path}.tmp"
+        vectors = np.lib.format.open_memmap(tmp_vectors, mode='w+', dtype=np.float32, shape=(capacity, dim))
+        ids = np.lib.format.open_memmap(tmp_ids, mode='w+', dtype=np.int64, shape=(capacity,))
+        if self.vectors is not None and self.size:
+            vectors[:self.size] = self.vectors[:self.size]
+            ids[:self.size] = self.ids[:self.size]
+        vectors.flush()
+        ids.flush()
+        del vectors, ids
+        self.vectors = self.ids = None
+        os.replace(tmp_vectors, self.vectors_path)
+        os.replace(tmp_ids, self.ids_path)
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+        self.ids = np.load(self.ids_path, mmap_mode='r+')
+
+    def rebuild(self, dreams):
+        """Replace the index contents with embeddings of the given dreams."""
+        with self._locked(exclusive=True):
+            self._rebuild(dreams)
+
+    def _rebuild(self, dreams):
+        dreams = list(dreams)
+        self.vectors = self.ids = None
+        self.slots, self.size, self.free = {}, 0, []
+        self._allocate(max(INDEX_GROWTH, -(-len(dreams) // INDEX_GROWTH) * INDEX_GROWTH))
+        if dreams:
+            self.vectors[:len(dreams)] = self.embedder.embed([dream_text(d) for d in dreams])
+            self.ids[:len(dreams)] = [d['id'] for d in dreams]
+            self.slots = {d['id']: slot for slot, d in enumerate(dreams)}
+            self.size = len(dreams)
+        self.flush()
+        if self.logger:
+            self.logger.info(f"Built vector index for {len(dreams)} dreams")
+
+    def add(self, dream):
+        """Embed a dream and store (or replace) its vector."""
+        vector = self.embedder.embed([dream_text(dream)])[0]
+        with self._locked(exclusive=True):
+            slot = self.slots.get(dream['id'])
+            if slot is None and self.free:
+                slot = heapq.heappop(self.free)
+            elif slot is None:
+                if self.size == len(self.ids):
+                    self._allocate(len(self.ids) + INDEX_GROWTH)
+                slot = self.size
+                self.size += 1
+            self.vectors[slot] = vector
+            self.ids[slot] = dream['id']
+            self.slots[dream['id']] = slot
+            self.flush()
+
+    def remove(self, dream_id):
+        """Free a dream's slot for reuse by later adds."""
+        with self._locked(exclusive=True):
+            slot = self.slots.pop(dream_id, None)
+            if slot is None:
+                return
+            self.vectors[slot] = 0
+            self.ids[slot] = 0
+            heapq.heappush(self.free, slot)
+            while self.size and self.ids[self.size - 1] == 0:
+                self.size -= 1
+            self.free = [free for free in self.free if free < self.size]
+            heapq.heapify(self.free)
+            self.flush()
+
+    def flush(self):
+        self.vectors.flush()
+        self.ids.flush()
+        self._write_meta()
+
+    def query(self, vector, k=10, exclude=()):
+        """Return [(dream_id, cosine)] for the k nearest vectors, best first."""
+        with self._locked():
+            return self._query(vector, k, exclude)
+
+    def _query(self, vector, k, exclude):
+        if not self.size:
+            return []
+        scores = self.vectors[:self.size] @ vector
+        ids = self.ids[:self.size]
+        # Free slots and excluded dreams can never be returned
+        scores[ids == 0] = -np.inf
+        for dream_id in exclude:
+            slot = self.slots.get(dream_id)
+            if slot is not None and slot < self.size:
+                scores[slot] = -np.inf
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[slot]), float(scores[slot])) for slot in top if np.isfinite(scores[slot])]
+
+    def similar(self, dream_id, k=10):
+        """Dreams nearest to an indexed dream, excluding itself."""
+        with self._locked():
+            slot = self.slots.get(dream_id)
+            if slot is None:
+                return []
+            return self._query(np.array(self.vectors[slot]), k, (dream_id,))
+
+    def close(self):
+        """Release the mapped files and the lock file."""
+        self.vectors = self.ids = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
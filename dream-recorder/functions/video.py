@@ -1,19 +1,81 @@
-import tempfile
 import requests
 import time
 import os
 import ffmpeg
-import shutil
+import numpy as np
 
-from datetime import datetime
+from functools import lru_cache
 from functions.config_loader import get_config
+from functions.media_layout import new_media_filename, derived_filename
+from functions.media_writer import staged, staged_dir, scratch_file
+from functions.tracing import span
+from functions.metrics import LUMA_POLL_ATTEMPTS, external_call
 
-def process_video(input_path, logger=None):
-    """Process the video using FFmpeg with specific filters from environment variables."""
+# Side length of the frame sampled for BlurHash placeholders
+PLACEHOLDER_SAMPLE_SIZE = 32
+BASE83_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+# Side length of the frames decoded when scoring thumbnail candidates
+FRAME_SAMPLE_SIZE = 96
+# Relative weights of sharpness, exposure and colorfulness in the frame score
+FRAME_SCORE_WEIGHTS = (0.5, 0.3, 0.2)
+# Layout and tile size of the hover-scrub sprite sheet
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 2
+SPRITE_TILE_SIZE = 160
+
+@lru_cache(maxsize=32)
+def _cached_probe(video_path, mtime_ns, size):
+    return ffmpeg.probe(video_path)
+
+def probe_video(video_path):
+    """Return ffprobe output for a video, probing each version of the file only once.
+
+    Results are cached by path, modification time and size, so the thumbnail,
+    preview, stream and metadata steps of one pipeline run share a single probe.
+    """
+    try:
+        stat = os.stat(video_path)
+    except OSError:
+        return ffmpeg.probe(video_path)
+    return _cached_probe(video_path, stat.st_mtime_ns, stat.st_size)
+
+def media_metadata(video_path, logger=None):
+    """Return the duration, resolution, bitrate, codec and size columns stored with a dream.
+
+    Best effort: values that cannot be determined are None.
+    """
+    metadata = {'duration': None, 'width': None, 'height': None, 'bitrate': None, 'video_codec': None, 'file_size': None}
+    try:
+        metadata['file_size'] = os.path.getsize(video_path)
+        probe = probe_video(video_path)
+        fmt = probe.get('format', {})
+        video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+        duration = video_info.get('duration') or fmt.get('duration')
+        bitrate = fmt.get('bit_rate') or video_info.get('bit_rate')
+        metadata.update(
+            duration=float(duration) if duration else None,
+            width=int(video_info['width']) if video_info.get('width') else None,
+            height=int(video_info['height']) if video_info.get('height') else None,
+            bitrate=int(bitrate) if bitrate else None,
+            video_codec=video_info.get('codec_name'),
+        )
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not read metadata for {video_path}: {str(e)}")
+    return metadata
+
+def video_metadata(video_filename, logger=None):
+    """Return the metadata columns for a stored video (all None if it is missing)."""
+    return media_metadata(os.path.join(get_config()['VIDEOS_DIR'], video_filename or ''), logger)
+
+def process_video(input_path, logger=None, output_path=None):
+    """Process the video using FFmpeg with specific filters from environment variables.
+
+    The result is staged next to output_path (default: over input_path) and
+    renamed into place once complete, so a half-written video is never served.
+    """
     try:
-        # Create a temporary file for the processed video
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
-            temp_path = temp_file.name
+        output_path = output_path or input_path
         # Apply FFmpeg filters using environment variables
         stream = ffmpeg.input(input_path)
         stream = ffmpeg.filter(stream, 'eq', brightness=float(get_config()['FFMPEG_BRIGHTNESS']))
@@ -21,24 +83,95 @@ def process_video(input_path, logger=None):
         stream = ffmpeg.filter(stream, 'vaguedenoiser', threshold=float(get_config()['FFMPEG_DENOISE_THRESHOLD']))
         stream = ffmpeg.filter(stream, 'bilateral', sigmaS=float(get_config()['FFMPEG_BILATERAL_SIGMA']))
         stream = ffmpeg.filter(stream, 'noise', all_strength=float(get_config()['FFMPEG_NOISE_STRENGTH']))
-        stream = ffmpeg.output(stream, temp_path)
-        # Run FFmpeg
-        ffmpeg.run(stream, overwrite_output=True, quiet=True)
-        # Replace the original file with the processed one
-        shutil.move(temp_path, input_path)
-        if logger:
-            logger.info(f"Processed video saved to {input_path}")
-        return input_path
+        with staged(output_path) as (temp_path,):
+            # Run FFmpeg
+            ffmpeg.run(ffmpeg.output(stream, temp_path), overwrite_output=True, quiet=True)
+        if logger:
+            logger.info(f"Processed video saved to {output_path}")
+        return output_path
     except Exception as e:
         if logger:
             logger.error(f"Error processing video: {str(e)}")
         raise
 
-def process_thumbnail(video_path, logger=None):
-    """Create a square thumbnail from the video at 1 second in."""
+def _thumbnail_sizes(crop_size):
+    """Return the configured thumbnail widths (ascending), capped at the crop size."""
+    sizes = str(get_config().get('THUMBNAIL_SIZES', '160,320,540'))
+    widths = sorted({min(int(s), crop_size) for s in sizes.split(',') if s.strip()})
+    return widths or [crop_size]
+
+def score_frames(frames):
+    """Score an (n, h, w, 3) uint8 stack of frames; higher is a better thumbnail.
+
+    Combines sharpness (variance of the Laplacian), exposure (closeness of mean
+    luma to mid-grey, minus clipped pixels) and colorfulness (Hasler & Suesstrunk),
+    each normalised across the batch.
+    """
+    rgb = frames.astype(np.float32) / 255.0
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    luma = 0.299 * r + 0.587 * g + 0.114 * b
+    laplacian = (luma[:, :-2, 1:-1] + luma[:, 2:, 1:-1] + luma[:, 1:-1, :-2] + luma[:, 1:-1, 2:]
+                 - 4 * luma[:, 1:-1, 1:-1])
+    sharpness = laplacian.var(axis=(1, 2))
+    clipped = ((luma < 0.02) | (luma > 0.98)).mean(axis=(1, 2))
+    exposure = np.clip(1 - 2 * np.abs(luma.mean(axis=(1, 2)) - 0.5) - clipped, 0, 1)
+    rg = r - g
+    yb = 0.5 * (r + g) - b
+    colorfulness = (np.hypot(rg.std(axis=(1, 2)), yb.std(axis=(1, 2)))
+                    + 0.3 * np.hypot(rg.mean(axis=(1, 2)), yb.mean(axis=(1, 2))))
+    def normalise(values):
+        peak = values.max()
+        return values / peak if peak > 0 else values
+    w_sharp, w_exposure, w_color = FRAME_SCORE_WEIGHTS
+    return w_sharp * normalise(sharpness) + w_exposure * exposure + w_color * normalise(colorfulness)
+
+def select_thumbnail_time(video_path, duration, crop, logger=None):
+    """Pick the best thumbnail timestamp (seconds) by scoring a low-resolution sample of frames.
+
+    Frames are decoded through a single FFmpeg pipe, already cropped to the
+    thumbnail square. Returns None if the video cannot be sampled.
+    """
+    start = time.perf_counter()
+    samples = int(get_config().get('THUMBNAIL_SAMPLE_FRAMES', 12))
+    if not duration or duration <= 0 or samples < 1:
+        return None
+    crop_size, x_offset, y_offset = crop
+    fps = samples / duration
+    out, _ = (
+        ffmpeg.input(video_path)
+        .filter('fps', fps)
+        .filter('crop', crop_size, crop_size, x_offset, y_offset)
+        .filter('scale', FRAME_SAMPLE_SIZE, FRAME_SAMPLE_SIZE)
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    frame_bytes = FRAME_SAMPLE_SIZE * FRAME_SAMPLE_SIZE * 3
+    count = len(out) // frame_bytes
+    if count == 0:
+        return None
+    frames = np.frombuffer(out, np.uint8, count * frame_bytes).reshape(count, FRAME_SAMPLE_SIZE, FRAME_SAMPLE_SIZE, 3)
+    scores = score_frames(frames)
+    best = int(scores.argmax())
+    best_time = min(best / fps, max(duration - 0.1, 0))
+    if logger:
+        logger.info(f"Selected thumbnail frame {best + 1}/{count} at {best_time:.2f}s "
+                    f"(score {scores[best]:.3f}) in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return best_time
+
+def thumbnail_variant_filename(thumb_filename, size):
+    """Return the filename of a smaller thumbnail variant, e.g. thumb_x_160.webp."""
+    stem, ext = os.path.splitext(thumb_filename)
+    return f"{stem}_{size}{ext}"
+
+def process_thumbnail(video_path, logger=None, thumb_filename=None):
+    """Create square WebP thumbnails at each configured size from the best-scoring frame of the video.
+
+    The largest size is written to thumb_filename, smaller sizes alongside it
+    (see thumbnail_variant_filename). All sizes are encoded in a single FFmpeg pass.
+    """
     try:
         # Get video dimensions using ffprobe
-        probe = ffmpeg.probe(video_path)
+        probe = probe_video(video_path)
         video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
         width = int(video_info['width'])
         height = int(video_info['height'])
@@ -47,30 +180,50 @@ def process_thumbnail(video_path, logger=None):
         # Calculate offsets to center the crop
         x_offset = (width - crop_size) // 2
         y_offset = (height - crop_size) // 2
-        # Create output directory if it doesn't exist
         thumbs_dir = get_config()['THUMBS_DIR']
-        os.makedirs(thumbs_dir, exist_ok=True)
-        # Generate simple timestamp-based filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        thumb_filename = f"thumb_{timestamp}.png"
+        if thumb_filename is None:
+            thumb_filename = new_media_filename('thumb', '.webp')
         thumb_path = os.path.join(thumbs_dir, thumb_filename)
+        sizes = _thumbnail_sizes(crop_size)
+        quality = int(get_config().get('THUMBNAIL_QUALITY', 80))
         # Log the FFmpeg command for debugging
         if logger:
             logger.info(f"Generating thumbnail for video: {video_path}")
             logger.info(f"Video dimensions: {width}x{height}")
             logger.info(f"Output path: {thumb_path}")
             logger.info(f"Crop dimensions: {crop_size}x{crop_size} at offset ({x_offset}, {y_offset})")
-        # Use FFmpeg to extract frame at 1 second and crop to square
-        stream = ffmpeg.input(video_path, ss=1)
+            logger.info(f"Thumbnail sizes: {sizes}")
+        # Pick the best-scoring frame, falling back to 1 second in
+        seek = 1
+        if str(get_config().get('THUMBNAIL_BEST_FRAME', True)).lower() in ('1', 'true', 'yes'):
+            try:
+                duration = float(video_info.get('duration') or probe.get('format', {}).get('duration') or 0)
+                best_time = select_thumbnail_time(video_path, duration, (crop_size, x_offset, y_offset), logger)
+                if best_time is not None:
+                    seek = best_time
+            except Exception as e:
+                if logger:
+                    logger.warning(f"Best-frame selection failed, using 1s: {str(e)}")
+        # Use FFmpeg to extract the frame, crop to square and split into one branch per size
+        stream = ffmpeg.input(video_path, ss=seek)
         stream = ffmpeg.filter(stream, 'crop', crop_size, crop_size, x_offset, y_offset)
-        stream = ffmpeg.output(stream, thumb_path, vframes=1)
-        # Run FFmpeg with stderr capture
-        try:
-            ffmpeg.run(stream, overwrite_output=True, capture_stderr=True)
-        except ffmpeg.Error as e:
-            if logger:
-                logger.error(f"FFmpeg error: {e.stderr.decode()}")
-            raise
+        branches = ffmpeg.filter_multi_output(stream, 'split', len(sizes))
+        paths = [
+            thumb_path if size == sizes[-1] else os.path.join(thumbs_dir, thumbnail_variant_filename(thumb_filename, size))
+            for size in sizes
+        ]
+        with staged(*paths) as staged_paths:
+            outputs = []
+            for i, size in enumerate(sizes):
+                branch = ffmpeg.filter(branches[i], 'scale', size, size)
+                outputs.append(ffmpeg.output(branch, staged_paths[i], vframes=1, quality=quality))
+            # Run FFmpeg with stderr capture
+            try:
+                ffmpeg.run(ffmpeg.merge_outputs(*outputs), overwrite_output=True, capture_stderr=True)
+            except ffmpeg.Error as e:
+                if logger:
+                    logger.error(f"FFmpeg error: {e.stderr.decode()}")
+                raise
         if logger:
             logger.info(f"Generated thumbnail saved to {thumb_path}")
         return thumb_filename
@@ -79,6 +232,222 @@ def process_thumbnail(video_path, logger=None):
             logger.error(f"Error generating thumbnail: {str(e)}")
         raise
 
+def preview_filenames(video_filename):
+    """Return the (preview loop, sprite sheet) filenames derived from a video filename, in its shard."""
+    return derived_filename(video_filename, 'preview', '.mp4'), derived_filename(video_filename, 'sprite', '.webp')
+
+def process_previews(video_path, preview_filename, sprite_filename, logger=None):
+    """Create a short low-bitrate preview loop and a frame sprite sheet from the video in one FFmpeg pass.
+
+    Both are cropped to the same centred square as the thumbnail. The sprite sheet
+    holds SPRITE_COLUMNS x SPRITE_ROWS frames sampled evenly across the video.
+    """
+    try:
+        probe = probe_video(video_path)
+        video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+        duration = float(video_info.get('duration') or probe.get('format', {}).get('duration') or 0)
+        if duration <= 0:
+            raise Exception(f"Could not determine duration of {video_path}")
+        previews_dir = get_config().get('PREVIEWS_DIR', 'media/previews')
+        preview_path = os.path.join(previews_dir, preview_filename)
+        sprite_path = os.path.join(previews_dir, sprite_filename)
+        preview_size = int(get_config().get('PREVIEW_SIZE', 240))
+        stream = ffmpeg.input(video_path)
+        stream = ffmpeg.filter(stream, 'crop', 'min(iw,ih)', 'min(iw,ih)')
+        branches = ffmpeg.filter_multi_output(stream, 'split', 2)
+        with staged(preview_path, sprite_path) as (staged_preview, staged_sprite):
+            # Preview loop: first few seconds, small and heavily compressed, no audio
+            preview = ffmpeg.filter(branches[0], 'trim', duration=float(get_config().get('PREVIEW_DURATION', 3)))
+            preview = ffmpeg.filter(preview, 'setpts', 'PTS-STARTPTS')
+            preview = ffmpeg.filter(preview, 'scale', preview_size, preview_size)
+            preview_out = ffmpeg.output(preview, staged_preview, vcodec='libx264', preset='veryfast',
+                                        crf=int(get_config().get('PREVIEW_CRF', 32)), pix_fmt='yuv420p',
+                                        movflags='+faststart')
+            # Sprite sheet: evenly spaced frames tiled into a single image
+            frames = SPRITE_COLUMNS * SPRITE_ROWS
+            sprite = ffmpeg.filter(branches[1], 'fps', frames / duration)
+            sprite = ffmpeg.filter(sprite, 'scale', SPRITE_TILE_SIZE, SPRITE_TILE_SIZE)
+            sprite = ffmpeg.filter(sprite, 'tile', f"{SPRITE_COLUMNS}x{SPRITE_ROWS}")
+            sprite_out = ffmpeg.output(sprite, staged_sprite, vframes=1, quality=int(get_config().get('THUMBNAIL_QUALITY', 80)))
+            try:
+                ffmpeg.run(ffmpeg.merge_outputs(preview_out, sprite_out), overwrite_output=True, capture_stderr=True)
+            except ffmpeg.Error as e:
+                if logger:
+                    logger.error(f"FFmpeg error: {e.stderr.decode()}")
+                raise
+        if logger:
+            logger.info(f"Generated preview loop {preview_path} and sprite sheet {sprite_path}")
+        return preview_filename, sprite_filename
+    except Exception as e:
+        if logger:
+            logger.error(f"Error generating previews: {str(e)}")
+        raise
+
+def generate_previews(video_filename, logger=None):
+    """Generate hover previews for a stored video and return the columns to save with the dream.
+
+    Best effort: failures are logged and yield empty values rather than failing the pipeline.
+    """
+    details = {'preview_filename': None, 'sprite_filename': None}
+    video_path = os.path.join(get_config()['VIDEOS_DIR'], video_filename or '')
+    if not video_filename or not os.path.exists(video_path):
+        return details
+    try:
+        preview_filename, sprite_filename = process_previews(video_path, *preview_filenames(video_filename), logger=logger)
+        details.update(preview_filename=preview_filename, sprite_filename=sprite_filename)
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not generate previews for {video_filename}: {str(e)}")
+    return details
+
+def _stream_renditions(source_height):
+    """Return the configured (height, kbps) HLS renditions that fit the source, highest first."""
+    spec = str(get_config().get('STREAMING_RENDITIONS', '540:1500,360:700,240:350'))
+    configured = sorted({tuple(int(v) for v in entry.split(':', 1)) for entry in spec.split(',') if ':' in entry}, reverse=True)
+    renditions = [(height, kbps) for height, kbps in configured if height <= source_height]
+    # A source smaller than every rendition is packaged once at its own height
+    if not renditions and configured:
+        renditions = [(source_height, configured[-1][1])]
+    return renditions
+
+def package_stream(video_path, stream_name, logger=None):
+    """Package the video as segmented adaptive HLS renditions plus a master playlist.
+
+    Renditions are encoded in one FFmpeg pass with aligned keyframes and written to
+    STREAMS_DIR/<stream_name>/. Returns the master playlist path relative to STREAMS_DIR.
+    """
+    try:
+        probe = probe_video(video_path)
+        video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+        renditions = _stream_renditions(int(video_info['height']))
+        segment_seconds = int(get_config().get('STREAMING_SEGMENT_SECONDS', 2))
+        stream_dir = os.path.join(get_config().get('STREAMS_DIR', 'media/streams'), stream_name)
+        stream = ffmpeg.input(video_path)
+        branches = ffmpeg.filter_multi_output(stream, 'split', len(renditions))
+        scaled = [ffmpeg.filter(branches[i], 'scale', -2, height) for i, (height, _) in enumerate(renditions)]
+        # The playlists and segments only go live together, once all are written
+        with staged_dir(stream_dir) as staging_dir:
+            options = {
+                'vcodec': 'libx264',
+                'preset': 'veryfast',
+                'pix_fmt': 'yuv420p',
+                'sc_threshold': 0,
+                'force_key_frames': f"expr:gte(t,n_forced*{segment_seconds})",
+                'f': 'hls',
+                'hls_time': segment_seconds,
+                'hls_playlist_type': 'vod',
+                'hls_flags': 'independent_segments',
+                'hls_segment_filename': os.path.join(staging_dir, 'v%v', 'seg_%03d.ts'),
+                'master_pl_name': 'master.m3u8',
+                'var_stream_map': ' '.join(f"v:{i}" for i in range(len(renditions))),
+            }
+            for i, (_, kbps) in enumerate(renditions):
+                options[f"b:v:{i}"] = f"{kbps}k"
+                options[f"maxrate:v:{i}"] = f"{int(kbps * 1.1)}k"
+                options[f"bufsize:v:{i}"] = f"{kbps * 2}k"
+            out = ffmpeg.output(*scaled, os.path.join(staging_dir, 'v%v', 'index.m3u8'), **options)
+            try:
+                ffmpeg.run(out, overwrite_output=True, capture_stderr=True)
+            except ffmpeg.Error as e:
+                if logger:
+                    logger.error(f"FFmpeg error: {e.stderr.decode()}")
+                raise
+        if logger:
+            logger.info(f"Packaged HLS stream {stream_dir} with renditions {renditions}")
+        return f"{stream_name}/master.m3u8"
+    except Exception as e:
+        if logger:
+            logger.error(f"Error packaging stream: {str(e)}")
+        raise
+
+def generate_stream(video_filename, logger=None):
+    """Package a stored video for adaptive streaming if STREAMING_ENABLED is set.
+
+    Best effort: returns the manifest path to save with the dream, or None.
+    """
+    if str(get_config().get('STREAMING_ENABLED', False)).lower() not in ('1', 'true', 'yes'):
+        return None
+    video_path = os.path.join(get_config()['VIDEOS_DIR'], video_filename or '')
+    if not video_filename or not os.path.exists(video_path):
+        return None
+    try:
+        return package_stream(video_path, os.path.splitext(video_filename)[0], logger)
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not package stream for {video_filename}: {str(e)}")
+        return None
+
+def thumbnail_details(thumb_filename, logger=None):
+    """Return the stored thumbnail metadata (available sizes and BlurHash placeholder) for a thumbnail.
+
+    Best effort: missing files or decode errors yield empty values rather than failing the pipeline.
+    """
+    details = {'thumb_sizes': None, 'thumb_placeholder': None}
+    thumbs_dir = get_config()['THUMBS_DIR']
+    thumb_path = os.path.join(thumbs_dir, thumb_filename or '')
+    if not thumb_filename or not os.path.exists(thumb_path):
+        return details
+    try:
+        probe = ffmpeg.probe(thumb_path)
+        full_size = int(next(s for s in probe['streams'] if s['codec_type'] == 'video')['width'])
+        sizes = [s for s in _thumbnail_sizes(full_size)
+                 if s == full_size or os.path.exists(os.path.join(thumbs_dir, thumbnail_variant_filename(thumb_filename, s)))]
+        details['thumb_sizes'] = ','.join(str(s) for s in sizes)
+        # Decode a tiny copy of the smallest variant for the placeholder
+        smallest = thumb_path if sizes[0] == full_size else os.path.join(thumbs_dir, thumbnail_variant_filename(thumb_filename, sizes[0]))
+        out, _ = (
+            ffmpeg.input(smallest)
+            .filter('scale', PLACEHOLDER_SAMPLE_SIZE, PLACEHOLDER_SAMPLE_SIZE)
+            .output('pipe:', format='rawvideo', pix_fmt='rgb24', vframes=1)
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+        pixels = np.frombuffer(out, np.uint8).reshape(PLACEHOLDER_SAMPLE_SIZE, PLACEHOLDER_SAMPLE_SIZE, 3)
+        details['thumb_placeholder'] = blurhash_encode(pixels)
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not compute thumbnail details for {thumb_filename}: {str(e)}")
+    return details
+
+def _srgb_to_linear(values):
+    v = values / 255.0
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+def _linear_to_srgb(value):
+    v = min(max(value, 0.0), 1.0)
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def _base83(value, length):
+    return ''.join(BASE83_CHARS[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+def blurhash_encode(pixels, components_x=4, components_y=4):
+    """Encode an (h, w, 3) uint8 RGB array as a BlurHash string (https://blurha.sh)."""
+    height, width = pixels.shape[:2]
+    linear = _srgb_to_linear(pixels.astype(np.float64))
+    basis_x = np.cos(np.pi * np.outer(np.arange(components_x), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(components_y), np.arange(height)) / height)
+    # factors[j, i] = mean over pixels of basis_y[j, y] * basis_x[i, x] * linear[y, x]
+    factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, linear) / (width * height)
+    factors[1:, :] *= 2
+    factors[0, 1:] *= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+    result = _base83((components_x - 1) + (components_y - 1) * 9, 1)
+    if len(ac):
+        quantised_max = int(max(0, min(82, np.floor(np.abs(ac).max() * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += _base83(0, 1)
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+    scaled = np.sign(ac / max_value) * np.abs(ac / max_value) ** 0.5
+    quant = np.clip(np.floor(scaled * 9 + 9.5), 0, 18).astype(int)
+    for r, g, b in quant:
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
 def generate_video(prompt, filename=None, luma_extend=False, logger=None, config=None):
     """Generate a video using Luma Labs API, with optional extension if LUMA_EXTEND is set."""
     try:
@@ -89,23 +458,25 @@ def generate_video(prompt, filename=None, luma_extend=False, logger=None, config
             initial_prompt = prompt
             extension_prompt = 'Continue on with this video'  # fallback
         # Step 1: Create the initial generation request
-        response = requests.post(
-            get_config()['LUMA_GENERATIONS_ENDPOINT'],
-            headers={
-                'accept': 'application/json',
-                'authorization': f"Bearer {get_config()['LUMALABS_API_KEY']}",
-                'content-type': 'application/json'
-            },
-            json={
-                'prompt': initial_prompt,
-                'model': get_config()['LUMA_MODEL'],
-                'resolution': get_config()['LUMA_RESOLUTION'],
-                'duration': get_config()['LUMA_DURATION'],
-                "aspect_ratio": get_config()['LUMA_ASPECT_RATIO'],
-            }
-        )
-        if response.status_code not in [200, 201]:
-            raise Exception(f"Luma API error: {response.text}")
+        with span('luma_submit') as submit, external_call('luma', 'submit') as call:
+            response = requests.post(
+                get_config()['LUMA_GENERATIONS_ENDPOINT'],
+                headers={
+                    'accept': 'application/json',
+                    'authorization': f"Bearer {get_config()['LUMALABS_API_KEY']}",
+                    'content-type': 'application/json'
+                },
+                json={
+                    'prompt': initial_prompt,
+                    'model': get_config()['LUMA_MODEL'],
+                    'resolution': get_config()['LUMA_RESOLUTION'],
+                    'duration': get_config()['LUMA_DURATION'],
+                    "aspect_ratio": get_config()['LUMA_ASPECT_RATIO'],
+                }
+            )
+            submit['status_code'] = call['status'] = response.status_code
+            if response.status_code not in [200, 201]:
+                raise Exception(f"Luma API error: {response.text}")
         response_data = response.json()
         if logger:
             logger.info(f"API response: {response_data}")
@@ -118,75 +489,87 @@ def generate_video(prompt, filename=None, luma_extend=False, logger=None, config
             """Poll the Luma API for video generation completion."""
             max_attempts = int(get_config()['LUMA_MAX_POLL_ATTEMPTS'])
             poll_interval = float(get_config()['LUMA_POLL_INTERVAL'])
-            for attempt in range(max_attempts):
-                status_response = requests.get(
-                    f"{get_config()['LUMA_API_URL']}/generations/{generation_id}",
-                    headers={
-                        'accept': 'application/json',
-                        'authorization': f"Bearer {get_config()['LUMALABS_API_KEY']}"
-                    }
-                )
-                if status_response.status_code not in [200, 201]:
+            # Recorded however polling ends: done, failed, timed out or errored
+            attempts = 0
+            try:
+                for attempt in range(max_attempts):
+                    attempts = attempt + 1
+                    # Only the request is timed; the sleeps show as gaps between polls
+                    with span('luma_poll', attempt=attempt + 1) as poll, external_call('luma', 'poll') as call:
+                        status_response = requests.get(
+                            f"{get_config()['LUMA_API_URL']}/generations/{generation_id}",
+                            headers={
+                                'accept': 'application/json',
+                                'authorization': f"Bearer {get_config()['LUMALABS_API_KEY']}"
+                            }
+                        )
+                    poll['status_code'] = call['status'] = status_response.status_code
+                    if status_response.status_code not in [200, 201]:
+                        if logger:
+                            logger.error(f"Status check failed with code {status_response.status_code}: {status_response.text}")
+                        time.sleep(poll_interval)
+                        continue
+                    status_data = status_response.json()
+                    if attempt == 0 or attempt % 10 == 0:
+                        if logger:
+                            logger.info(f"Full status response: {status_data}")
+                    state = status_data.get('state')
+                    poll['state'] = state
                     if logger:
-                        logger.error(f"Status check failed with code {status_response.status_code}: {status_response.text}")
+                        logger.info(f"Generation state: {state} (attempt {attempt+1}/{max_attempts})")
+                    if state in ['completed', 'succeeded']:
+                        assets = status_data.get('assets') or {}
+                        video_url = None
+                        if isinstance(assets, dict):
+                            video_url = (assets.get('video') or 
+                                       assets.get('url') or 
+                                       (assets.get('videos', {}) or {}).get('url'))
+                        if not video_url and 'result' in status_data:
+                            result = status_data.get('result', {})
+                            if isinstance(result, dict):
+                                video_url = result.get('url')
+                        if not video_url:
+                            raise Exception("Video URL not found in completed response")
+                        if logger:
+                            logger.info(f"Video generation completed: {video_url}")
+                        return video_url
+                    elif state in ['failed', 'error']:
+                        error_msg = status_data.get('failure_reason') or status_data.get('error') or "Unknown error"
+                        raise Exception(f"Video generation failed: {error_msg}")
                     time.sleep(poll_interval)
-                    continue
-                status_data = status_response.json()
-                if attempt == 0 or attempt % 10 == 0:
-                    if logger:
-                        logger.info(f"Full status response: {status_data}")
-                state = status_data.get('state')
-                if logger:
-                    logger.info(f"Generation state: {state} (attempt {attempt+1}/{max_attempts})")
-                if state in ['completed', 'succeeded']:
-                    assets = status_data.get('assets') or {}
-                    video_url = None
-                    if isinstance(assets, dict):
-                        video_url = (assets.get('video') or 
-                                   assets.get('url') or 
-                                   (assets.get('videos', {}) or {}).get('url'))
-                    if not video_url and 'result' in status_data:
-                        result = status_data.get('result', {})
-                        if isinstance(result, dict):
-                            video_url = result.get('url')
-                    if not video_url:
-                        raise Exception("Video URL not found in completed response")
-                    if logger:
-                        logger.info(f"Video generation completed: {video_url}")
-                    return video_url
-                elif state in ['failed', 'error']:
-                    error_msg = status_data.get('failure_reason') or status_data.get('error') or "Unknown error"
-                    raise Exception(f"Video generation failed: {error_msg}")
-                time.sleep(poll_interval)
-            raise Exception(f"Timed out waiting for video generation after {max_attempts} attempts")
+                raise Exception(f"Timed out waiting for video generation after {max_attempts} attempts")
+            finally:
+                LUMA_POLL_ATTEMPTS.observe(attempts)
         # Step 2: If luma_extend is set, extend the video
         if luma_extend:
             if logger:
                 logger.info("LUMA_EXTEND is set. Requesting video extension.")
             _ = poll_for_completion(generation_id)  # Wait for completion
-            extend_response = requests.post(
-                get_config()['LUMA_GENERATIONS_ENDPOINT'],
-                headers={
-                    'accept': 'application/json',
-                    'authorization': f"Bearer {get_config()['LUMALABS_API_KEY']}",
-                    'content-type': 'application/json'
-                },
-                json={
-                    'model': get_config()['LUMA_MODEL'],
-                    'resolution': get_config()['LUMA_RESOLUTION'],
-                    'duration': get_config()['LUMA_DURATION'],
-                    "aspect_ratio": get_config()['LUMA_ASPECT_RATIO'],
-                    'prompt': extension_prompt,
-                    'keyframes': {
-                        'frame0': {
-                            'type': 'generation',
-                            'id': generation_id
+            with span('luma_extend_submit') as submit, external_call('luma', 'submit') as call:
+                extend_response = requests.post(
+                    get_config()['LUMA_GENERATIONS_ENDPOINT'],
+                    headers={
+                        'accept': 'application/json',
+                        'authorization': f"Bearer {get_config()['LUMALABS_API_KEY']}",
+                        'content-type': 'application/json'
+                    },
+                    json={
+                        'model': get_config()['LUMA_MODEL'],
+                        'resolution': get_config()['LUMA_RESOLUTION'],
+                        'duration': get_config()['LUMA_DURATION'],
+                        "aspect_ratio": get_config()['LUMA_ASPECT_RATIO'],
+                        'prompt': extension_prompt,
+                        'keyframes': {
+                            'frame0': {
+                                'type': 'generation',
+                                'id': generation_id
+                            }
                         }
                     }
-                }
-            )
-            if extend_response.status_code not in [200, 201]:
-                raise Exception(f"Luma API error (extend): {extend_response.text}")
+                )
+                submit['status_code'] = call['status'] = extend_response.status_code
+                if extend_response.status_code not in [200, 201]:
+                    raise Exception(f"Luma API error (extend): {extend_response.text}")
             extend_data = extend_response.json()
             if logger:
                 logger.info(f"Extend API response: {extend_data}")
@@ -198,24 +581,28 @@ def generate_video(prompt, filename=None, luma_extend=False, logger=None, config
             video_url = poll_for_completion(extend_id)
         else:
             video_url = poll_for_completion(generation_id)
-        # Download the generated video
-        video_response = requests.get(video_url, stream=True)
-        video_response.raise_for_status()
         if filename is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"generated_{timestamp}.mp4"
-        os.makedirs(get_config()['VIDEOS_DIR'], exist_ok=True)
+            filename = new_media_filename('generated', '.mp4')
         video_path = os.path.join(get_config()['VIDEOS_DIR'], filename)
-        with open(video_path, 'wb') as f:
-            for chunk in video_response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        if logger:
-            logger.info(f"Saved video to {video_path}")
-        # Post-process the video and generate a thumbnail
-        processed_video_path = process_video(video_path, logger)
+        # The raw download is only an intermediate: filtering writes the stored video
+        with scratch_file('.mp4', near=video_path) as download_path:
+            # Download the generated video
+            with span('download') as download, external_call('luma', 'download'):
+                video_response = requests.get(video_url, stream=True)
+                video_response.raise_for_status()
+                with open(download_path, 'wb') as f:
+                    for chunk in video_response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+                download['bytes'] = os.path.getsize(download_path)
+            if logger:
+                logger.info(f"Downloaded video to {download_path}")
+            # Post-process the video and generate a thumbnail
+            with span('filter'):
+                processed_video_path = process_video(download_path, logger, video_path)
         if logger:
             logger.info(f"Processed video saved to {processed_video_path}")
-        thumb_filename = process_thumbnail(processed_video_path, logger)
+        with span('thumbnail'):
+            thumb_filename = process_thumbnail(processed_video_path, logger, derived_filename(filename, 'thumb', '.webp'))
         return filename, thumb_filename
     except Exception as e:
         if logger:
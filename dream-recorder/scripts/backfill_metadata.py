@@ -0,0 +1,56 @@
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.config_loader import get_config
+from functions.dream_db import DreamDB
+from functions.video import media_metadata
+
+def read_metadata(video_path):
+    """Probe one video in a worker process and return the metadata columns to store."""
+    metadata = media_metadata(video_path)
+    if metadata['width'] is None:
+        raise Exception(f"Could not probe {video_path}")
+    return metadata
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Store duration, resolution, bitrate, codec and size for existing dreams.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='Number of parallel ffprobe processes')
+    parser.add_argument('--force', action='store_true', help='Re-probe dreams that already have metadata')
+    args = parser.parse_args(argv)
+
+    db = DreamDB()
+    videos_dir = get_config()['VIDEOS_DIR']
+    # Dreams that reuse a video share one probe
+    pending = {}
+    for dream in db.get_all_dreams():
+        if (args.force or dream.get('duration') is None) and os.path.exists(os.path.join(videos_dir, dream['video_filename'])):
+            pending.setdefault(dream['video_filename'], []).append(dream['id'])
+    print(f"Backfilling metadata for {sum(len(ids) for ids in pending.values())} dreams "
+          f"({len(pending)} videos) with {args.workers} workers")
+
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(read_metadata, os.path.join(videos_dir, name)): name for name in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                metadata = future.result()
+            except Exception as e:
+                failed += len(pending[name])
+                print(f"Failed to probe {name}: {e}")
+                continue
+            # DB writes stay in the main process
+            for dream_id in pending[name]:
+                db.update_dream(dream_id, metadata)
+                done += 1
+            print(f"Backfilled {name}: {metadata['duration']}s {metadata['width']}x{metadata['height']}")
+    print(f"Done: {done} updated, {failed} failed")
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
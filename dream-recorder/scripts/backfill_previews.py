@@ -0,0 +1,55 @@
+import os
+import sys
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.config_loader import get_config
+from functions.dream_db import DreamDB
+from functions.video import process_previews, preview_filenames
+
+logger = logging.getLogger(__name__)
+
+def regenerate_previews(dream):
+    """Generate the hover preview loop and sprite sheet for a dream and return the columns to update."""
+    video_path = os.path.join(get_config()['VIDEOS_DIR'], dream['video_filename'])
+    preview_filename, sprite_filename = process_previews(video_path, *preview_filenames(dream['video_filename']), logger=logger)
+    return {'preview_filename': preview_filename, 'sprite_filename': sprite_filename}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate hover preview loops and sprite sheets for existing dreams.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='Number of parallel FFmpeg workers')
+    parser.add_argument('--force', action='store_true', help='Regenerate previews that already exist')
+    args = parser.parse_args(argv)
+
+    db = DreamDB()
+    dreams = [
+        d for d in db.get_all_dreams()
+        if (args.force or not d.get('preview_filename') or not d.get('sprite_filename'))
+        and os.path.exists(os.path.join(get_config()['VIDEOS_DIR'], d['video_filename']))
+    ]
+    print(f"Backfilling previews for {len(dreams)} dreams with {args.workers} workers")
+
+    done = failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(regenerate_previews, d): d for d in dreams}
+        for future in as_completed(futures):
+            dream = futures[future]
+            try:
+                updates = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to backfill dream {dream['id']}: {e}")
+                continue
+            # DB writes stay on the main thread
+            db.update_dream(dream['id'], updates)
+            done += 1
+            print(f"Backfilled dream {dream['id']} -> {updates['preview_filename']}, {updates['sprite_filename']}")
+    print(f"Done: {done} updated, {failed} failed")
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
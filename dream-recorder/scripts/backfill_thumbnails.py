@@ -0,0 +1,74 @@
+import os
+import sys
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.config_loader import get_config
+from functions.dream_db import DreamDB
+from functions.media_layout import derived_filename
+from functions.video import process_thumbnail, thumbnail_details, thumbnail_variant_filename
+
+logger = logging.getLogger(__name__)
+
+def regenerate_thumbnail(dream):
+    """Regenerate the WebP thumbnail set for a dream and return the columns to update."""
+    video_path = os.path.join(get_config()['VIDEOS_DIR'], dream['video_filename'])
+    # Name the thumbnail after its video (in its shard) so parallel workers never collide
+    thumb_filename = derived_filename(dream['video_filename'], 'thumb', '.webp')
+    process_thumbnail(video_path, logger, thumb_filename=thumb_filename)
+    updates = {'thumb_filename': thumb_filename}
+    updates.update(thumbnail_details(thumb_filename, logger))
+    return updates
+
+def remove_old_thumbnail(dream, updates):
+    """Remove the previous thumbnail file (and its variants) once the dream points at the new one."""
+    old = dream.get('thumb_filename')
+    if not old or old == updates['thumb_filename']:
+        return
+    thumbs_dir = get_config()['THUMBS_DIR']
+    paths = [os.path.join(thumbs_dir, old)]
+    if dream.get('thumb_sizes'):
+        paths += [os.path.join(thumbs_dir, thumbnail_variant_filename(old, s)) for s in dream['thumb_sizes'].split(',')]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Regenerate multi-size WebP thumbnails and placeholders for existing dreams.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='Number of parallel FFmpeg workers')
+    parser.add_argument('--force', action='store_true', help='Regenerate thumbnails that are already up to date')
+    args = parser.parse_args(argv)
+
+    db = DreamDB()
+    dreams = [
+        d for d in db.get_all_dreams()
+        if (args.force or not d.get('thumb_sizes'))
+        and os.path.exists(os.path.join(get_config()['VIDEOS_DIR'], d['video_filename']))
+    ]
+    print(f"Backfilling thumbnails for {len(dreams)} dreams with {args.workers} workers")
+
+    done = failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(regenerate_thumbnail, d): d for d in dreams}
+        for future in as_completed(futures):
+            dream = futures[future]
+            try:
+                updates = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to backfill dream {dream['id']}: {e}")
+                continue
+            # DB writes stay on the main thread
+            db.update_dream(dream['id'], updates)
+            remove_old_thumbnail(dream, updates)
+            done += 1
+            print(f"Backfilled dream {dream['id']} -> {updates['thumb_filename']}")
+    print(f"Done: {done} updated, {failed} failed")
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import os
+import sys
+import argparse
+import logging
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.config_loader import get_config
+from functions.backup import create_backup, list_snapshots, load_manifest, restore_backup, verify_backup
+
+logger = logging.getLogger(__name__)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Incremental backups of the dream database and media.')
+    parser.add_argument('--target', default=None, help='Backup directory (default: BACKUP_DIR)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='Take a snapshot, copying only new or changed files')
+    create.add_argument('--keep', type=int, default=None, help='Snapshots to keep, 0 for all (default: BACKUP_KEEP)')
+    commands.add_parser('list', help='List snapshots, oldest first')
+    verify = commands.add_parser('verify', help="Check that a snapshot's files are all present")
+    verify.add_argument('--snapshot', default=None, help='Snapshot to check (default: the latest)')
+    verify.add_argument('--deep', action='store_true', help='Also re-hash every file and check the database')
+    restore = commands.add_parser('restore', help='Restore a snapshot over the current library (stop the app first)')
+    restore.add_argument('--snapshot', default=None, help='Snapshot to restore (default: the latest)')
+    restore.add_argument('--yes', action='store_true', help='Confirm replacing the current database')
+    args = parser.parse_args(argv)
+
+    config = get_config()
+    target = args.target or config.get('BACKUP_DIR', 'backups')
+    try:
+        if args.command == 'create':
+            keep = args.keep if args.keep is not None else int(config.get('BACKUP_KEEP', 14))
+            report = create_backup(target, keep=keep, logger=logger)
+            print(f"Snapshot {report['snapshot']}: {report['files']} files, {report['files_hashed']} new or changed, "
+                  f"{report['bytes_copied'] / 1048576:.1f} MB copied in {report['seconds']} s")
+        elif args.command == 'list':
+            for snapshot in list_snapshots(target):
+                manifest = load_manifest(target, snapshot)
+                print(f"{snapshot}  {len(manifest['files'])} files")
+        elif args.command == 'verify':
+            report = verify_backup(target, args.snapshot, deep=args.deep, logger=logger)
+            for kind in ('missing', 'corrupt'):
+                for path in report[kind]:
+                    print(f"{kind}: {path}")
+            if report['missing'] or report['corrupt']:
+                print(f"Snapshot {report['snapshot']} is damaged")
+                return 1
+            print(f"Snapshot {report['snapshot']} is complete ({report['files']} files)")
+        elif args.command == 'restore':
+            if not args.yes:
+                print("Restoring replaces the current database and refuses to run while the app is up. "
+                      "Stop the app (docker compose stop app) and run again with --yes")
+                return 1
+            report = restore_backup(target, args.snapshot, logger=logger)
+            print(f"Restored snapshot {report['snapshot']}: {report['files_restored']} files restored, "
+                  f"{report['files_kept']} already in place. Start the app again (docker compose start app)")
+    except Exception as e:
+        print(f"Backup {args.command} failed: {e}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+import os
+import sys
+import argparse
+import logging
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.config_loader import get_config
+from functions.dream_db import DreamDB
+from functions.media_gc import collect_garbage
+
+logger = logging.getLogger(__name__)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove deleted dreams' files and media files no dream refers to.")
+    parser.add_argument('--dry-run', action='store_true', help='Only report orphaned files; remove nothing')
+    parser.add_argument('--min-age', type=float, default=None, help='Skip files newer than this many seconds (default: ORPHAN_MIN_AGE)')
+    args = parser.parse_args(argv)
+
+    config = get_config()
+    min_age = args.min_age if args.min_age is not None else float(config.get('ORPHAN_MIN_AGE', 3600))
+    db = DreamDB()
+    try:
+        report = collect_garbage(
+            db, batch_size=int(config.get('MEDIA_GC_BATCH_SIZE', 100)), min_age=min_age, dry_run=args.dry_run
+        )
+    except Exception as e:
+        print(f"Garbage collection failed: {e}")
+        return 1
+    verb = 'Would reclaim' if args.dry_run else 'Reclaimed'
+    print(f"Purged {report['dreams_purged']} deleted dreams, {report['orphans_removed']} orphaned files, "
+          f"{report['blobs_released']} unreferenced blobs. "
+          f"{verb} {report['bytes_reclaimed'] / 1048576:.1f} MB")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+import os
+import sys
+import argparse
+import logging
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.dream_db import DreamDB
+from functions.library_archive import import_library, IMPORT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import a library exported from /api/export (a .zip or its unzipped directory).')
+    parser.add_argument('source', help='Path to the export .zip, or the directory it was unzipped into')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Dreams inserted per transaction')
+    parser.add_argument('--workers', type=int, default=4, help='Media files copied in parallel')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.source):
+        print(f"No such file or directory: {args.source}")
+        return 1
+    db = DreamDB()
+    try:
+        report = import_library(db, args.source, batch_size=args.batch_size, workers=args.workers, logger=logger)
+    except Exception as e:
+        print(f"Import failed: {e}")
+        return 1
+    finally:
+        db.close()
+    print(f"Imported {report['dreams_imported']} dreams ({report['dreams_skipped']} already present). "
+          f"Media files: {report['files_linked']} linked, {report['files_copied']} copied")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
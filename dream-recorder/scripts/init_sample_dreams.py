@@ -1,11 +1,11 @@
 import os
 import sys
-import shutil
 
 # Ensure parent directory is in sys.path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from functions.dream_db import DreamDB, DreamData
+from functions.blob_store import store_file, link_or_copy
 
 # Paths
 SAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'dream_samples')
@@ -26,17 +26,18 @@ def main():
     existing_videos = {d['video_filename'] for d in existing}
 
     for i, sample in enumerate(SAMPLES, 1):
-        # Copy video
+        # Link video through the blob store (hardlink, reflink or copy)
         src_video = os.path.join(SAMPLES_DIR, sample['video'])
         dst_video = os.path.join(VIDEO_DEST, sample['video_dest'])
-        if not os.path.exists(dst_video):
-            shutil.copy2(src_video, dst_video)
+        video_digest = None
+        if sample['video_dest'] not in existing_videos or not os.path.exists(dst_video):
+            video_digest = store_file(db, src_video, dst_video)
 
-        # Copy thumb
+        # Link thumb
         src_thumb = os.path.join(SAMPLES_DIR, sample['thumb'])
         dst_thumb = os.path.join(THUMB_DEST, sample['thumb_dest'])
         if not os.path.exists(dst_thumb):
-            shutil.copy2(src_thumb, dst_thumb)
+            link_or_copy(src_thumb, dst_thumb)
 
         # Insert into DB if not present
         if sample['video_dest'] not in existing_videos:
@@ -46,6 +47,7 @@ def main():
                 audio_filename='',
                 video_filename=sample['video_dest'],
                 thumb_filename=sample['thumb_dest'],
+                video_digest=video_digest,
                 status='completed',
             )
             db.save_dream(dream_data.model_dump())
@@ -0,0 +1,102 @@
+import os
+import sys
+import argparse
+
+# Ensure parent directory is in sys.path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from functions.config_loader import get_config
+from functions.dream_db import DreamDB
+from functions.media_gc import touch_media
+from functions.media_layout import MEDIA_COLUMN_DIRS, is_sharded, sharded_filename
+from functions.video import thumbnail_variant_filename
+
+def plan_batch(dreams):
+    """Return the (column, old, new) renames that move a batch of dreams into year/month shards."""
+    renames = {}
+    for dream in dreams:
+        for column in MEDIA_COLUMN_DIRS:
+            value = dream.get(column)
+            if value and not is_sharded(column, value) and (column, value) not in renames:
+                renames[(column, value)] = sharded_filename(column, value, dream['created_at'])
+    return [(column, old, new) for (column, old), new in renames.items()]
+
+def file_moves(dreams, renames):
+    """Return the (source, target) paths to move for a batch's renames, thumbnail variants included."""
+    config = get_config()
+    sizes = {dream['thumb_filename']: dream.get('thumb_sizes') for dream in dreams if dream.get('thumb_filename')}
+    moves = []
+    for column, old, new in renames:
+        directory = config[MEDIA_COLUMN_DIRS[column]]
+        if column == 'stream_manifest':
+            # The whole stream directory moves with its manifest
+            old, new = os.path.dirname(old), os.path.dirname(new)
+        moves.append((os.path.join(directory, old), os.path.join(directory, new)))
+        if column == 'thumb_filename':
+            for size in (sizes.get(old) or '').split(',')[:-1]:
+                moves.append((
+                    os.path.join(directory, thumbnail_variant_filename(old, size)),
+                    os.path.join(directory, thumbnail_variant_filename(new, size)),
+                ))
+    return moves
+
+def apply_batch(db, dreams):
+    """Move a batch's files, then rewrite its names in one transaction; files move back if that fails.
+
+    Moved files get a fresh mtime, so the app's orphan scan does not remove
+    them in the moment before their new names are committed.
+    """
+    renames = plan_batch(dreams)
+    moved = []
+    try:
+        for source, target in file_moves(dreams, renames):
+            # A target without a source was moved by an interrupted earlier run
+            if os.path.exists(source):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Until the new names commit, the app's orphan scan sees an unknown
+                # name; a fresh mtime keeps it out of the scan for ORPHAN_MIN_AGE
+                touch_media(source)
+                os.replace(source, target)
+                moved.append((source, target))
+        db.rename_media(renames)
+    except Exception:
+        for source, target in reversed(moved):
+            os.replace(target, source)
+        raise
+    return len(renames), len(moved)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move media from the flat layout into year/month shards.')
+    parser.add_argument('--batch-size', type=int, default=100, help='Dreams moved per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='Print the planned renames without moving anything')
+    args = parser.parse_args(argv)
+
+    db = DreamDB()
+    if args.dry_run:
+        renames = plan_batch(db.get_unsharded_dreams(limit=args.batch_size))
+        for column, old, new in renames:
+            print(f"{column}: {old} -> {new}")
+        print(f"First batch: {len(renames)} renames")
+        return 0
+
+    total_renames = total_files = batches = 0
+    while True:
+        dreams = db.get_unsharded_dreams(limit=args.batch_size)
+        if not dreams:
+            break
+        try:
+            renames, files = apply_batch(db, dreams)
+        except Exception as e:
+            print(f"Failed to shard batch starting at dream {dreams[0]['id']}: {e}")
+            return 1
+        if not renames:
+            break
+        batches += 1
+        total_renames += renames
+        total_files += files
+        print(f"Batch {batches}: {renames} names rewritten, {files} files moved (through dream {dreams[-1]['id']})")
+    print(f"Done: {total_renames} names rewritten, {total_files} files moved in {batches} batches")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+// Minimal BlurHash decoder (https://blurha.sh) used to paint thumbnail placeholders
+class Blurhash {
+    static CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+
+    static decode83(str) {
+        let value = 0;
+        for (const c of str) {
+            value = value * 83 + this.CHARS.indexOf(c);
+        }
+        return value;
+    }
+
+    static srgbToLinear(value) {
+        const v = value / 255;
+        return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4);
+    }
+
+    static linearToSrgb(value) {
+        const v = Math.max(0, Math.min(1, value));
+        return v <= 0.0031308
+            ? Math.round(v * 12.92 * 255 + 0.5)
+            : Math.round((1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255 + 0.5);
+    }
+
+    static signPow(value, exp) {
+        return Math.sign(value) * Math.pow(Math.abs(value), exp);
+    }
+
+    // Decode a hash into RGBA pixels of the given size
+    static decode(hash, width, height) {
+        const sizeFlag = this.decode83(hash[0]);
+        const numY = Math.floor(sizeFlag / 9) + 1;
+        const numX = (sizeFlag % 9) + 1;
+        const maxValue = (this.decode83(hash[1]) + 1) / 166;
+
+        const colors = [];
+        const dc = this.decode83(hash.substring(2, 6));
+        colors.push([this.srgbToLinear(dc >> 16), this.srgbToLinear((dc >> 8) & 255), this.srgbToLinear(dc & 255)]);
+        for (let i = 1; i < numX * numY; i++) {
+            const ac = this.decode83(hash.substring(4 + i * 2, 6 + i * 2));
+            colors.push([
+                this.signPow((Math.floor(ac / 361) - 9) / 9, 2) * maxValue,
+                this.signPow((Math.floor(ac / 19) % 19 - 9) / 9, 2) * maxValue,
+                this.signPow((ac % 19 - 9) / 9, 2) * maxValue
+            ]);
+        }
+
+        const pixels = new Uint8ClampedArray(width * height * 4);
+        for (let y = 0; y < height; y++) {
+            for (let x = 0; x < width; x++) {
+                let r = 0, g = 0, b = 0;
+                for (let j = 0; j < numY; j++) {
+                    const basisY = Math.cos(Math.PI * y * j / height);
+                    for (let i = 0; i < numX; i++) {
+                        const basis = Math.cos(Math.PI * x * i / width) * basisY;
+                        const color = colors[i + j * numX];
+                        r += color[0] * basis;
+                        g += color[1] * basis;
+                        b += color[2] * basis;
+                    }
+                }
+                const offset = 4 * (x + y * width);
+                pixels[offset] = this.linearToSrgb(r);
+                pixels[offset + 1] = this.linearToSrgb(g);
+                pixels[offset + 2] = this.linearToSrgb(b);
+                pixels[offset + 3] = 255;
+            }
+        }
+        return pixels;
+    }
+
+    // Paint every <canvas data-blurhash="..."> below root
+    static paintAll(root = document) {
+        root.querySelectorAll('canvas[data-blurhash]').forEach(canvas => {
+            const hash = canvas.dataset.blurhash;
+            if (!hash || hash.length < 6) return;
+            try {
+                const ctx = canvas.getContext('2d');
+                const imageData = ctx.createImageData(canvas.width, canvas.height);
+                imageData.data.set(this.decode(hash, canvas.width, canvas.height));
+                ctx.putImageData(imageData, 0, 0);
+            } catch (error) {
+                console.error('Error decoding blurhash:', error);
+            }
+        });
+    }
+}
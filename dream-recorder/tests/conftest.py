@@ -16,5 +16,6 @@ def socketio_client():
 @pytest.fixture(autouse=True)
 def mock_dream_db(monkeypatch):
     mock_db = MagicMock()
+    mock_db.video_in_use.return_value = False
     monkeypatch.setattr('dream_recorder.dream_db', mock_db)
     return mock_db 
\ No newline at end of file
@@ -1,4 +1,5 @@
 import pytest
+from functions.dream_db import LIST_COLUMNS
 
 def test_index_page(test_client):
     resp = test_client.get('/')
@@ -58,12 +59,15 @@ def test_delete_dream_success(test_client, mocker, mock_dream_db):
         'id': 1, 'video_filename': 'dream1.mp4', 'thumb_filename': 'thumb1.jpg', 'audio_filename': 'audio1.wav'
     }
     mock_dream_db.delete_dream.return_value = True
-    mocker.patch('os.path.exists', return_value=True)
     mock_remove = mocker.patch('os.remove')
+    wakeup = mocker.patch('dream_recorder.media_gc_wakeup')
     resp = test_client.delete('/api/dreams/1')
     assert resp.status_code == 200
     assert resp.get_json()['success'] is True
-    assert mock_remove.call_count == 3  # video, thumb, audio
+    mock_dream_db.delete_dream.assert_called_once_with(1)
+    # Files are left to the background reaper, which is woken up
+    mock_remove.assert_not_called()
+    wakeup.set.assert_called_once()
 
 def test_delete_dream_not_found(test_client, mock_dream_db):
     mock_dream_db.get_dream.return_value = None
@@ -94,30 +98,6 @@ def test_serve_thumbnail_not_found(test_client, mocker):
     resp = test_client.get('/media/thumbs/missingthumb.jpg')
     assert resp.status_code == 404
 
-def test_delete_dream_removes_files(test_client, mocker, mock_dream_db, tmp_path):
-    video = tmp_path / "dream1.mp4"
-    thumb = tmp_path / "thumb1.jpg"
-    audio = tmp_path / "audio1.wav"
-    for f in (video, thumb, audio):
-        f.write_text("data")
-    # Patch get_config in the dream_recorder module
-    mocker.patch('dream_recorder.get_config', return_value={
-        'VIDEOS_DIR': str(tmp_path),
-        'THUMBS_DIR': str(tmp_path),
-        'RECORDINGS_DIR': str(tmp_path)
-    })
-    mock_dream_db.get_dream.return_value = {
-        'id': 1, 'video_filename': video.name, 'thumb_filename': thumb.name, 'audio_filename': audio.name
-    }
-    mock_dream_db.delete_dream.return_value = True
-    mock_remove = mocker.patch('os.remove')
-    resp = test_client.delete('/api/dreams/1')
-    assert resp.status_code == 200
-    mock_remove.assert_any_call(str(video))
-    mock_remove.assert_any_call(str(thumb))
-    mock_remove.assert_any_call(str(audio))
-    assert mock_remove.call_count == 3
-
 def test_404_page(test_client):
     resp = test_client.get('/nonexistent')
     assert resp.status_code == 404
@@ -126,4 +106,172 @@ def test_notify_config_reload_multiple_clients(test_client, mocker):
     mock_emit = mocker.patch('dream_recorder.socketio.emit')
     resp = test_client.post('/api/notify_config_reload')
     assert resp.status_code == 200
-    mock_emit.assert_any_call('reload_config') 
\ No newline at end of file
+    mock_emit.assert_any_call('reload_config') 
+def test_thumb_srcset_filter():
+    from dream_recorder import thumb_srcset
+    dream = {'thumb_filename': 'thumb_1.webp', 'thumb_sizes': '160,320,540'}
+    assert thumb_srcset(dream) == (
+        '/media/thumbs/thumb_1_160.webp 160w, /media/thumbs/thumb_1_320.webp 320w, /media/thumbs/thumb_1.webp 540w'
+    )
+    assert thumb_srcset({'thumb_filename': 'dream_1.png', 'thumb_sizes': None}) == ''
+
+def test_dreams_page_renders_placeholder(test_client, mock_dream_db):
+    mock_dream_db.list_dreams.return_value = [{
+        'id': 1, 'user_prompt': 'u', 'generated_prompt': 'g', 'created_at': 'now',
+        'video_filename': 'v.mp4', 'audio_filename': 'a.wav', 'thumb_filename': 'thumb_1.webp',
+        'thumb_sizes': '160,540', 'thumb_placeholder': 'LEHV6nWB2yk8'
+    }]
+    resp = test_client.get('/dreams')
+    assert b'data-blurhash="LEHV6nWB2yk8"' in resp.data
+    assert b'/media/thumbs/thumb_1_160.webp 160w' in resp.data
+
+def test_serve_preview(test_client, mocker):
+    mock_send = mocker.patch('dream_recorder.send_file', return_value='previewdata')
+    test_client.get('/media/previews/preview_1.mp4')
+    assert mock_send.call_args[0][0].endswith('preview_1.mp4')
+    mocker.patch('dream_recorder.send_file', side_effect=FileNotFoundError)
+    resp = test_client.get('/media/previews/missing.mp4')
+    assert resp.status_code == 404
+
+def test_serve_stream_cache_headers(test_client, mocker, tmp_path):
+    (tmp_path / 'dream').mkdir()
+    (tmp_path / 'dream' / 'master.m3u8').write_text('#EXTM3U\n')
+    (tmp_path / 'dream' / 'seg_000.ts').write_bytes(b'ts')
+    mocker.patch('dream_recorder.get_config', return_value={'STREAMS_DIR': str(tmp_path)})
+    resp = test_client.get('/media/streams/dream/master.m3u8')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/vnd.apple.mpegurl'
+    assert resp.headers['Cache-Control'] == 'public, max-age=3600'
+    resp = test_client.get('/media/streams/dream/seg_000.ts')
+    assert resp.mimetype == 'video/mp2t'
+    assert 'immutable' in resp.headers['Cache-Control']
+    resp = test_client.get('/media/streams/dream/missing.ts')
+    assert resp.status_code == 404
+
+def test_api_list_dreams_pages(test_client, mock_dream_db):
+    mock_dream_db.list_dreams.return_value = [
+        {'id': 9, 'created_at': '2024-03-02 10:00:00', 'thumb_filename': 'thumb_9.webp', 'thumb_sizes': '160'},
+        {'id': 8, 'created_at': '2024-03-01 10:00:00', 'thumb_filename': None},
+    ]
+    resp = test_client.get('/api/dreams?limit=2&before_created_at=2024-03-03+10:00:00&before_id=10')
+    assert resp.status_code == 200
+    mock_dream_db.list_dreams.assert_called_with(
+        limit=2, before_id=10, before_created_at='2024-03-03 10:00:00', columns=LIST_COLUMNS,
+    )
+    data = resp.get_json()
+    assert data['next_before_id'] == 8 and data['next_before_created_at'] == '2024-03-01 10:00:00'
+    assert data['dreams'][0]['thumb_srcset'] == '/media/thumbs/thumb_9.webp 160w'
+    # A short page means there is nothing left to load
+    mock_dream_db.list_dreams.return_value = [{'id': 1, 'thumb_filename': None}]
+    data = test_client.get('/api/dreams?limit=2').get_json()
+    assert data['next_before_id'] is None and data['next_before_created_at'] is None
+
+def test_api_list_dreams_error(test_client, mock_dream_db):
+    mock_dream_db.list_dreams.side_effect = Exception('db down')
+    resp = test_client.get('/api/dreams')
+    assert resp.status_code == 500
+
+def test_get_dream_details(test_client, mock_dream_db):
+    mock_dream_db.get_dream.return_value = {'id': 3, 'user_prompt': 'long prompt', 'generated_prompt': 'g'}
+    resp = test_client.get('/api/dreams/3')
+    assert resp.status_code == 200
+    assert resp.get_json()['user_prompt'] == 'long prompt'
+    mock_dream_db.get_dream.return_value = None
+    assert test_client.get('/api/dreams/4').status_code == 404
+    mock_dream_db.get_dream.side_effect = Exception('db down')
+    assert test_client.get('/api/dreams/5').status_code == 500
+
+def test_dreams_page_does_not_embed_full_prompts(test_client, mock_dream_db):
+    mock_dream_db.list_dreams.return_value = [{
+        'id': 1, 'created_at': 'now', 'video_filename': 'v.mp4', 'audio_filename': 'a.wav',
+        'thumb_filename': 'thumb_1.webp', 'prompt_excerpt': 'a dream about...'
+    }]
+    resp = test_client.get('/dreams')
+    assert mock_dream_db.list_dreams.call_args.kwargs['columns'] == LIST_COLUMNS
+    assert b'a dream about...' in resp.data
+    assert b'data-user-prompt' not in resp.data
+
+def test_api_search_dreams(test_client, mock_dream_db):
+    mock_dream_db.search_dreams.return_value = [
+        {'id': 2, 'thumb_filename': None, 'snippet': '<b>a</b> \x02whale\x03'},
+    ]
+    resp = test_client.get('/api/dreams/search?q=whale&limit=1&offset=3')
+    mock_dream_db.search_dreams.assert_called_with('whale', limit=1, offset=3)
+    data = resp.get_json()
+    assert data['next_offset'] == 4
+    # Prompt text is escaped; only the hit markers become markup
+    assert data['results'][0]['snippet_html'] == '&lt;b&gt;a&lt;/b&gt; <mark>whale</mark>'
+    assert 'snippet' not in data['results'][0]
+
+def test_api_search_dreams_empty_query(test_client, mock_dream_db):
+    resp = test_client.get('/api/dreams/search?q=%20')
+    assert resp.get_json() == {'results': [], 'next_offset': None}
+    mock_dream_db.search_dreams.assert_not_called()
+    mock_dream_db.search_dreams.side_effect = Exception('fts down')
+    assert test_client.get('/api/dreams/search?q=x').status_code == 500
+
+def test_api_similar_dreams(test_client, mock_dream_db):
+    mock_dream_db.similar_dreams.return_value = [{'id': 4, 'thumb_filename': 't.webp', 'score': 0.8}]
+    resp = test_client.get('/api/dreams/3/similar?k=500')
+    mock_dream_db.similar_dreams.assert_called_with(3, k=50)
+    assert resp.get_json()['dreams'][0]['score'] == 0.8
+    mock_dream_db.similar_dreams.side_effect = Exception('index broken')
+    assert test_client.get('/api/dreams/3/similar').status_code == 500
+
+
+def test_api_mark_played_and_storage(test_client, mocker, mock_dream_db):
+    assert test_client.post('/api/dreams/4/played').get_json()['success'] is True
+    mock_dream_db.mark_played.assert_called_once_with(4)
+    usage = {'dirs': {'VIDEOS_DIR': 10}, 'used_bytes': 10, 'quota_bytes': 0, 'free_bytes': 99}
+    mocker.patch('dream_recorder.storage_usage', return_value=usage)
+    assert test_client.get('/api/storage').get_json() == usage
+    mocker.patch('dream_recorder.storage_usage', side_effect=OSError('gone'))
+    assert test_client.get('/api/storage').status_code == 500
+
+def test_api_stats(test_client, mock_dream_db):
+    stats = {'totals': {'dreams': 3}, 'daily': [], 'generation_time_histogram': []}
+    mock_dream_db.get_stats.return_value = stats
+    assert test_client.get('/api/stats?days=9999').get_json() == stats
+    mock_dream_db.get_stats.assert_called_once_with(days=366)
+    mock_dream_db.get_stats.side_effect = Exception('locked')
+    assert test_client.get('/api/stats').status_code == 500
+
+def test_api_traces(test_client, mock_dream_db):
+    trace = {'trace_id': 'abc', 'dream_id': 3, 'total_ms': 10.0, 'spans': []}
+    mock_dream_db.get_dream_trace.return_value = trace
+    assert test_client.get('/api/dreams/3/trace').get_json() == trace
+    mock_dream_db.get_dream_trace.return_value = None
+    assert test_client.get('/api/dreams/4/trace').status_code == 404
+    mock_dream_db.get_trace.return_value = trace
+    assert test_client.get('/api/traces/abc').get_json() == trace
+    mock_dream_db.get_trace.assert_called_once_with('abc')
+    mock_dream_db.list_traces.return_value = [trace]
+    assert test_client.get('/api/traces?failed=1&limit=500').get_json() == {'traces': [trace]}
+    mock_dream_db.list_traces.assert_called_once_with(limit=200, failed=True)
+
+def test_metrics_endpoint(test_client, monkeypatch):
+    import dream_recorder
+    monkeypatch.setattr(dream_recorder, 'storage_usage', lambda: {
+        'dirs': {'VIDEOS_DIR': 2048}, 'quota_bytes': 0, 'free_bytes': 4096,
+    })
+    monkeypatch.setattr('functions.metrics._storage_refreshed', None)
+    resp = test_client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.content_type == 'text/plain; version=0.0.4; charset=utf-8'
+    text = resp.get_data(as_text=True)
+    assert 'dream_recorder_media_bytes{dir="videos"} 2048\n' in text
+    assert '# TYPE dream_recorder_pipeline_stage_seconds histogram' in text
+    assert 'dream_recorder_socketio_clients ' in text
+
+def test_metrics_scrape_walks_media_off_the_hub(test_client, monkeypatch):
+    import threading
+    from functions import storage
+    walkers = []
+    def path_size(path, seen=None):
+        walkers.append(threading.get_ident())
+        return 0
+    monkeypatch.setattr(storage, 'path_size', path_size)
+    monkeypatch.setattr(storage, 'get_config', lambda: {'VIDEOS_DIR': 'media/video'})
+    monkeypatch.setattr('functions.metrics._storage_refreshed', None)
+    assert test_client.get('/metrics').status_code == 200
+    assert walkers and threading.get_ident() not in walkers
@@ -1,3 +1,4 @@
+import re
 import io
 import os
 import tempfile
@@ -34,14 +35,23 @@ def test_create_wav_file(mock_config):
     assert wav.getframerate() == 44100
     wav.close()
 
+def fake_convert(stream, **kwargs):
+    # Writes the (staged) output path that ffmpeg.output was given
+    with open(stream[1], 'wb') as f:
+        f.write(b'RIFF')
+
 def test_save_wav_file_creates_file(monkeypatch, mock_config, mock_logger):
     # Patch ffmpeg to avoid real conversion
     monkeypatch.setattr(audio.ffmpeg, 'input', lambda x: x)
     monkeypatch.setattr(audio.ffmpeg, 'output', lambda x, y, **kwargs: (x, y))
-    monkeypatch.setattr(audio.ffmpeg, 'run', lambda *a, **k: None)
+    monkeypatch.setattr(audio.ffmpeg, 'run', fake_convert)
     audio_data = b'RIFF....'  # fake webm data
     filename = audio.save_wav_file(audio_data, filename='test.wav', logger=mock_logger)
     assert filename.endswith('.wav')
+    # Only the finished WAV is left behind: no staging or scratch files
+    directory = audio.get_config()['RECORDINGS_DIR']
+    assert os.path.exists(os.path.join(directory, 'test.wav'))
+    assert not [name for name in os.listdir(directory) if name.startswith(('.test.', '.scratch_'))]
     mock_logger.info.assert_called()
 
 def test_save_wav_file_handles_tempfile_cleanup(monkeypatch, mock_config, mock_logger):
@@ -58,7 +68,7 @@ def test_save_wav_file_handles_tempfile_cleanup(monkeypatch, mock_config, mock_l
 def test_save_wav_file_handles_os_unlink(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(audio.ffmpeg, 'input', lambda x: x)
     monkeypatch.setattr(audio.ffmpeg, 'output', lambda x, y, **kwargs: (x, y))
-    monkeypatch.setattr(audio.ffmpeg, 'run', lambda *a, **k: None)
+    monkeypatch.setattr(audio.ffmpeg, 'run', fake_convert)
     # Patch os.unlink to raise
     monkeypatch.setattr(os, 'unlink', lambda x: (_ for _ in ()).throw(Exception('unlink fail')))
     audio_data = b'RIFF....'
@@ -68,10 +78,12 @@ def test_save_wav_file_handles_os_unlink(monkeypatch, mock_config, mock_logger):
 def test_save_wav_file_timestamp(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(audio.ffmpeg, 'input', lambda x: x)
     monkeypatch.setattr(audio.ffmpeg, 'output', lambda x, y, **kwargs: (x, y))
-    monkeypatch.setattr(audio.ffmpeg, 'run', lambda *a, **k: None)
+    monkeypatch.setattr(audio.ffmpeg, 'run', fake_convert)
     audio_data = b'RIFF....'
     filename = audio.save_wav_file(audio_data, filename=None, logger=mock_logger)
-    assert filename.startswith('recording_') and filename.endswith('.wav')
+    # Sharded by year/month, with a unique suffix so recordings in the same second never collide
+    assert re.fullmatch(r'\d{4}/\d{2}/recording_\d{8}_\d{6}_[0-9a-f]{8}\.wav', filename)
+    assert filename != audio.save_wav_file(audio_data, filename=None, logger=mock_logger)
     mock_logger.info.assert_called()
 
 def test_process_audio_no_sid(monkeypatch, mock_config, mock_logger):
@@ -187,4 +199,107 @@ def test_process_audio_emit_sid_and_no_sid(monkeypatch, mock_config, mock_logger
     # Check that emit was called with and without room
     calls = [c for c in fake_socketio.emit.call_args_list]
     assert any('room' in c[1] for c in calls)  # with sid
-    assert any('room' not in c[1] for c in calls)  # without sid 
\ No newline at end of file
+    assert any('room' not in c[1] for c in calls)  # without sid 
+def test_process_audio_reuses_cached_video(monkeypatch, mock_config, mock_logger):
+    config = audio.get_config()
+    config.update({'PROMPT_CACHE_ENABLED': True, 'PROMPT_CACHE_THRESHOLD': 0.9, 'VIDEOS_DIR': '/videos'})
+    monkeypatch.setattr(audio, 'get_config', lambda: config)
+    monkeypatch.setattr(audio, 'save_wav_file', lambda *a, **k: 'file.wav')
+    monkeypatch.setattr(audio.client.audio.transcriptions, 'create', lambda **kwargs: mock.Mock(text='the same dream'))
+    monkeypatch.setattr(audio, 'generate_video_prompt', lambda *a, **k: 'video prompt')
+    generate = mock.Mock()
+    monkeypatch.setattr(audio, 'generate_video', generate)
+    monkeypatch.setattr(audio.os.path, 'exists', lambda path: path != '/videos/gone.mp4')
+    cached = {
+        'id': 7, 'video_filename': 'old.mp4', 'thumb_filename': 'thumb_old.webp', 'thumb_sizes': '160',
+        'thumb_placeholder': 'LEHV6nWB2yk8', 'preview_filename': 'p.mp4', 'sprite_filename': 's.webp',
+        'stream_manifest': 'old/master.m3u8', 'duration': 5.0, 'width': 1280, 'height': 720,
+    }
+    fake_db = mock.Mock()
+    # The best match lost its video file, so the next one is reused
+    fake_db.find_similar_prompts.return_value = [(dict(cached, id=8, video_filename='gone.mp4'), 0.99), (cached, 0.95)]
+    recording_state = {}
+    audio.process_audio(None, mock.Mock(), fake_db, recording_state, [b'audio'], logger=mock_logger)
+    generate.assert_not_called()
+    fake_db.find_similar_prompts.assert_called_once_with('the same dream', 'video prompt', 0.9)
+    saved = fake_db.save_dream.call_args[0][0]
+    assert saved['source_dream_id'] == 7
+    assert saved['audio_filename'] == 'file.wav'
+    assert {k: saved[k] for k in cached if k != 'id'} == {k: v for k, v in cached.items() if k != 'id'}
+    assert recording_state['video_url'] == '/media/video/old.mp4'
+
+def test_process_audio_saves_video_metadata(monkeypatch, mock_config, mock_logger):
+    monkeypatch.setattr(audio, 'save_wav_file', lambda *a, **k: 'file.wav')
+    monkeypatch.setattr(audio.client.audio.transcriptions, 'create', lambda **kwargs: mock.Mock(text='hello'))
+    monkeypatch.setattr(audio, 'generate_video_prompt', lambda *a, **k: 'video prompt')
+    monkeypatch.setattr(audio, 'generate_video', lambda *a, **k: ('video.mp4', 'thumb.webp'))
+    metadata = {'duration': 5.0, 'width': 1280, 'height': 720, 'bitrate': 4000000, 'video_codec': 'h264', 'file_size': 1024}
+    monkeypatch.setattr(audio, 'video_metadata', lambda name, logger=None: metadata if name == 'video.mp4' else {})
+    fake_db = mock.Mock()
+    audio.process_audio(None, mock.Mock(), fake_db, {}, [b'audio'], logger=mock_logger)
+    saved = fake_db.save_dream.call_args[0][0]
+    assert {k: saved[k] for k in metadata} == metadata
+    assert saved['pipeline_seconds'] >= 0
+
+def test_process_audio_stops_before_generation_without_storage(monkeypatch, mock_config, mock_logger):
+    monkeypatch.setattr(audio, 'save_wav_file', lambda *a, **k: 'file.wav')
+    monkeypatch.setattr(audio.client.audio.transcriptions, 'create', lambda **kwargs: mock.Mock(text='hello'))
+    monkeypatch.setattr(audio, 'generate_video_prompt', lambda *a, **k: 'video prompt')
+    monkeypatch.setattr(audio, 'ensure_capacity', lambda db, logger=None: {'ok': False})
+    generate = mock.Mock()
+    monkeypatch.setattr(audio, 'generate_video', generate)
+    fake_db, fake_socketio, recording_state = mock.Mock(), mock.Mock(), {}
+    audio.process_audio(None, fake_socketio, fake_db, recording_state, [b'audio'], logger=mock_logger)
+    generate.assert_not_called()
+    fake_db.save_dream.assert_not_called()
+    assert recording_state['status'] == 'error'
+    fake_socketio.emit.assert_any_call('error', {'message': 'Not enough storage space for a new dream'})
+    fake_db.record_pipeline_failure.assert_called_once_with()
+
+def test_find_reusable_dream_disabled_or_failing(monkeypatch, mock_config, mock_logger):
+    fake_db = mock.Mock()
+    assert audio.find_reusable_dream(fake_db, 'u', 'g') is None
+    disabled = dict(audio.get_config(), PROMPT_CACHE_ENABLED='false')
+    monkeypatch.setattr(audio, 'get_config', lambda: disabled)
+    assert audio.find_reusable_dream(fake_db, 'u', 'g') is None
+    fake_db.find_similar_prompts.assert_not_called()
+    config = dict(audio.get_config(), PROMPT_CACHE_ENABLED=True, VIDEOS_DIR='/videos')
+    monkeypatch.setattr(audio, 'get_config', lambda: config)
+    fake_db.find_similar_prompts.side_effect = Exception('index broken')
+    assert audio.find_reusable_dream(fake_db, 'u', 'g', logger=mock_logger) is None
+    mock_logger.warning.assert_called()
+
+def test_process_audio_saves_trace(monkeypatch, mock_config, mock_logger):
+    monkeypatch.setattr(audio, 'save_wav_file', lambda *a, **k: 'file.wav')
+    monkeypatch.setattr(audio.client.audio.transcriptions, 'create', lambda **kwargs: mock.Mock(text='hello'))
+    monkeypatch.setattr(audio, 'generate_video_prompt', lambda *a, **k: 'video prompt')
+    def generate(*a, **k):
+        with audio.span('luma_submit'):
+            pass
+        return 'video.mp4', 'thumb.webp'
+    monkeypatch.setattr(audio, 'generate_video', generate)
+    fake_db = mock.Mock()
+    fake_db.save_dream.return_value = 12
+    audio.process_audio(None, mock.Mock(), fake_db, {}, [b'audio'], logger=mock_logger)
+    trace_id, dream_id, _, spans = fake_db.save_trace.call_args[0]
+    assert dream_id == 12
+    names = [(span['depth'], span['name']) for span in spans]
+    assert names[:5] == [(0, 'decode'), (0, 'whisper'), (0, 'gpt'), (0, 'reuse_lookup'), (0, 'capacity')]
+    assert names[5:7] == [(0, 'generate_video'), (1, 'luma_submit')]
+    assert names[-1] == (0, 'db_save')
+    assert all(span['duration_ms'] >= 0 and span['error'] is None for span in spans)
+    # Outside a pipeline run spans are not recorded anywhere
+    with audio.span('luma_submit') as attrs:
+        attrs['ignored'] = True
+
+def test_process_audio_saves_failed_trace(monkeypatch, mock_config, mock_logger):
+    monkeypatch.setattr(audio, 'save_wav_file', lambda *a, **k: 'file.wav')
+    monkeypatch.setattr(audio.client.audio.transcriptions, 'create', lambda **kwargs: mock.Mock(text='hello'))
+    monkeypatch.setattr(audio, 'generate_video_prompt', lambda *a, **k: None)
+    fake_db = mock.Mock()
+    fake_db.save_trace.side_effect = Exception('locked')
+    audio.process_audio(None, mock.Mock(), fake_db, {}, [b'audio'], logger=mock_logger)
+    _, dream_id, _, spans = fake_db.save_trace.call_args[0]
+    assert dream_id is None
+    assert (spans[-1]['name'], spans[-1]['error']) == ('gpt', 'Failed to generate video prompt')
+    mock_logger.warning.assert_called()
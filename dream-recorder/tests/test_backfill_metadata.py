@@ -0,0 +1,46 @@
+import pytest
+import builtins
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import scripts.backfill_metadata as mod
+
+@pytest.fixture
+def fake_env(monkeypatch, tmp_path):
+    videos = tmp_path / 'video'
+    videos.mkdir()
+    monkeypatch.setattr(mod, 'get_config', lambda: {'VIDEOS_DIR': str(videos)})
+    fake_db = mock.Mock()
+    monkeypatch.setattr(mod, 'DreamDB', lambda: fake_db)
+    # Worker processes would not see the patched probe; threads do
+    monkeypatch.setattr(mod, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(builtins, 'print', lambda *a, **kw: None)
+    return fake_db, videos
+
+def test_backfills_missing_metadata_once_per_video(monkeypatch, fake_env):
+    fake_db, videos = fake_env
+    (videos / 'dream_1.mp4').write_bytes(b'v')
+    (videos / 'dream_2.mp4').write_bytes(b'v')
+    fake_db.get_all_dreams.return_value = [
+        {'id': 1, 'video_filename': 'dream_1.mp4', 'duration': None},
+        {'id': 2, 'video_filename': 'dream_2.mp4', 'duration': 5.0},
+        {'id': 3, 'video_filename': 'dream_1.mp4', 'duration': None},
+        {'id': 4, 'video_filename': 'missing.mp4', 'duration': None},
+    ]
+    metadata = {'duration': 5.0, 'width': 1280, 'height': 720, 'bitrate': 4000000, 'video_codec': 'h264', 'file_size': 1}
+    probed = []
+    def fake_metadata(path):
+        probed.append(path)
+        return metadata
+    monkeypatch.setattr(mod, 'media_metadata', fake_metadata)
+    assert mod.main(['--workers', '2']) == 0
+    assert probed == [str(videos / 'dream_1.mp4')]
+    assert fake_db.update_dream.call_args_list == [mock.call(1, metadata), mock.call(3, metadata)]
+
+def test_backfill_metadata_probe_failure(monkeypatch, fake_env):
+    fake_db, videos = fake_env
+    (videos / 'dream_2.mp4').write_bytes(b'v')
+    fake_db.get_all_dreams.return_value = [{'id': 2, 'video_filename': 'dream_2.mp4', 'duration': 5.0}]
+    monkeypatch.setattr(mod, 'media_metadata', lambda path: {'width': None})
+    assert mod.main(['--force']) == 1
+    fake_db.update_dream.assert_not_called()
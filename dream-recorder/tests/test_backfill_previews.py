@@ -0,0 +1,46 @@
+import pytest
+import builtins
+from unittest import mock
+
+import scripts.backfill_previews as mod
+
+@pytest.fixture
+def fake_env(monkeypatch, tmp_path):
+    videos = tmp_path / 'video'
+    videos.mkdir()
+    monkeypatch.setattr(mod, 'get_config', lambda: {'VIDEOS_DIR': str(videos)})
+    fake_db = mock.Mock()
+    monkeypatch.setattr(mod, 'DreamDB', lambda: fake_db)
+    monkeypatch.setattr(builtins, 'print', lambda *a, **kw: None)
+    return fake_db, videos
+
+def test_backfills_missing_previews(monkeypatch, fake_env):
+    fake_db, videos = fake_env
+    (videos / 'dream_1.mp4').write_bytes(b'v')
+    (videos / 'dream_2.mp4').write_bytes(b'v')
+    fake_db.get_all_dreams.return_value = [
+        {'id': 1, 'video_filename': 'dream_1.mp4', 'preview_filename': None, 'sprite_filename': None},
+        {'id': 2, 'video_filename': 'dream_2.mp4', 'preview_filename': 'p.mp4', 'sprite_filename': 's.webp'},
+        {'id': 3, 'video_filename': 'missing.mp4', 'preview_filename': None, 'sprite_filename': None},
+    ]
+    calls = []
+    def fake_process(path, preview, sprite, logger=None):
+        calls.append(path)
+        return preview, sprite
+    monkeypatch.setattr(mod, 'process_previews', fake_process)
+    assert mod.main(['--workers', '2']) == 0
+    assert calls == [str(videos / 'dream_1.mp4')]
+    fake_db.update_dream.assert_called_once_with(1, {
+        'preview_filename': 'preview_dream_1.mp4', 'sprite_filename': 'sprite_dream_1.webp'
+    })
+
+def test_backfill_previews_failure(monkeypatch, fake_env):
+    fake_db, videos = fake_env
+    (videos / 'dream_2.mp4').write_bytes(b'v')
+    fake_db.get_all_dreams.return_value = [
+        {'id': 2, 'video_filename': 'dream_2.mp4', 'preview_filename': 'p.mp4', 'sprite_filename': 's.webp'},
+    ]
+    def raise_exc(*a, **k): raise Exception('ffmpeg fail')
+    monkeypatch.setattr(mod, 'process_previews', raise_exc)
+    assert mod.main(['--force']) == 1
+    fake_db.update_dream.assert_not_called()
@@ -0,0 +1,56 @@
+import pytest
+import builtins
+from unittest import mock
+
+import scripts.backfill_thumbnails as mod
+
+@pytest.fixture
+def fake_env(monkeypatch, tmp_path):
+    videos = tmp_path / 'video'
+    thumbs = tmp_path / 'thumbs'
+    videos.mkdir()
+    thumbs.mkdir()
+    monkeypatch.setattr(mod, 'get_config', lambda: {'VIDEOS_DIR': str(videos), 'THUMBS_DIR': str(thumbs)})
+    fake_db = mock.Mock()
+    monkeypatch.setattr(mod, 'DreamDB', lambda: fake_db)
+    monkeypatch.setattr(builtins, 'print', lambda *a, **kw: None)
+    return fake_db, videos, thumbs
+
+def test_backfills_missing_thumbnails(monkeypatch, fake_env):
+    fake_db, videos, thumbs = fake_env
+    (videos / 'dream_1.mp4').write_bytes(b'v')
+    (videos / 'dream_2.mp4').write_bytes(b'v')
+    (thumbs / 'dream_1.png').write_bytes(b't')
+    fake_db.get_all_dreams.return_value = [
+        {'id': 1, 'video_filename': 'dream_1.mp4', 'thumb_filename': 'dream_1.png', 'thumb_sizes': None},
+        {'id': 2, 'video_filename': 'dream_2.mp4', 'thumb_filename': 'thumb_dream_2.webp', 'thumb_sizes': '160,540'},
+        {'id': 3, 'video_filename': 'missing.mp4', 'thumb_filename': None, 'thumb_sizes': None},
+    ]
+    generated = []
+    monkeypatch.setattr(mod, 'process_thumbnail', lambda path, logger, thumb_filename: generated.append(thumb_filename))
+    monkeypatch.setattr(mod, 'thumbnail_details', lambda name, logger: {'thumb_sizes': '160,540', 'thumb_placeholder': 'HASH'})
+    assert mod.main(['--workers', '2']) == 0
+    # Only dream 1 is missing sizes and has a video on disk
+    assert generated == ['thumb_dream_1.webp']
+    fake_db.update_dream.assert_called_once_with(1, {
+        'thumb_filename': 'thumb_dream_1.webp', 'thumb_sizes': '160,540', 'thumb_placeholder': 'HASH'
+    })
+    assert not (thumbs / 'dream_1.png').exists()
+
+def test_backfill_force_and_failure(monkeypatch, fake_env):
+    fake_db, videos, thumbs = fake_env
+    (videos / 'dream_2.mp4').write_bytes(b'v')
+    fake_db.get_all_dreams.return_value = [
+        {'id': 2, 'video_filename': 'dream_2.mp4', 'thumb_filename': 'thumb_dream_2.webp', 'thumb_sizes': '540'},
+    ]
+    def raise_exc(*a, **k): raise Exception('ffmpeg fail')
+    monkeypatch.setattr(mod, 'process_thumbnail', raise_exc)
+    assert mod.main(['--force']) == 1
+    fake_db.update_dream.assert_not_called()
+
+def test_remove_old_thumbnail_variants(fake_env):
+    _, _, thumbs = fake_env
+    for name in ('old.webp', 'old_160.webp'):
+        (thumbs / name).write_bytes(b't')
+    mod.remove_old_thumbnail({'thumb_filename': 'old.webp', 'thumb_sizes': '160,540'}, {'thumb_filename': 'new.webp'})
+    assert list(thumbs.iterdir()) == []
@@ -0,0 +1,189 @@
+import os
+import pytest
+import sqlite3
+import builtins
+import threading
+from functions import backup, blob_store
+from functions.app_lock import acquire_app_lock
+from functions.dream_db import DreamDB, DreamData
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    config = {key: str(tmp_path / 'media' / key.lower()) for key in (
+        'VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR', 'MEDIA_BLOBS_DIR',
+    )}
+    for directory in config.values():
+        os.makedirs(directory)
+    config['DB_PATH'] = str(tmp_path / 'dreams.sqlite3')
+    config['BACKUP_DIR'] = str(tmp_path / 'backups')
+    monkeypatch.setattr(backup, 'get_config', lambda: config)
+    monkeypatch.setattr(blob_store, 'get_config', lambda: config)
+    return config
+
+@pytest.fixture
+def dream_db(media, monkeypatch):
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    db = DreamDB(db_path=media['DB_PATH'])
+    yield db
+    db.close()
+
+def write(directory, name, data):
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def populate(db, media):
+    write(media['VIDEOS_DIR'], '2024/03/v.mp4', b'video' * 100)
+    write(media['RECORDINGS_DIR'], '2024/03/a.wav', b'audio')
+    write(media['STREAMS_DIR'], '2024/03/v/master.m3u8', b'#EXTM3U')
+    # A crashed writer's leftover is not backed up
+    write(media['THUMBS_DIR'], '.t.0123abcd.tmp.webp', b'partial')
+    # Links the video into the blob store, so two names share one inode
+    digest = blob_store.store_video(db, '2024/03/v.mp4')
+    db.save_dream(DreamData(
+        user_prompt='u', generated_prompt='g', audio_filename='2024/03/a.wav', video_filename='2024/03/v.mp4',
+        stream_manifest='2024/03/v/master.m3u8', video_digest=digest,
+    ).model_dump())
+    return digest
+
+def objects(target):
+    return sorted(name for _, _, names in os.walk(os.path.join(target, 'objects')) for name in names)
+
+def test_backups_only_copy_what_changed(media, dream_db):
+    digest = populate(dream_db, media)
+    target = media['BACKUP_DIR']
+    first = backup.create_backup(target)
+    assert first['files'] == 4
+    # The video and its blob store link are read once
+    assert first['files_hashed'] == 3
+    manifest = backup.load_manifest(target)
+    assert manifest['files']['video/2024/03/v.mp4']['digest'] == digest
+    assert manifest['files'][f"blobs/{digest[:2]}/{digest}"]['digest'] == digest
+    assert len(objects(target)) == 4
+    second = backup.create_backup(target)
+    assert second['files_hashed'] == 0 and second['snapshot'] != first['snapshot']
+    path = write(media['RECORDINGS_DIR'], '2024/03/a.wav', b'louder')
+    os.utime(path, ns=(1, 1))
+    third = backup.create_backup(target, keep=2)
+    assert third['files_hashed'] == 1
+    assert backup.list_snapshots(target) == [second['snapshot'], third['snapshot']]
+    # The old recording is only pruned once no kept snapshot refers to it
+    assert backup.prune_backups(target, keep=1) == (1, 1)
+    assert backup.verify_backup(target, deep=True)['missing'] == []
+
+def test_prune_waits_for_a_running_backup(media, dream_db, monkeypatch):
+    populate(dream_db, media)
+    target = media['BACKUP_DIR']
+    backup.create_backup(target)
+    write(media['RECORDINGS_DIR'], '2024/03/b.wav', b'new recording')
+    ingested, resume = threading.Event(), threading.Event()
+    ingest = backup._ingest
+    def slow_ingest(target, path):
+        result = ingest(target, path)
+        if path.endswith('b.wav'):
+            # Stored, but in no snapshot until this backup writes its manifest
+            ingested.set()
+            resume.wait(5)
+        return result
+    monkeypatch.setattr(backup, '_ingest', slow_ingest)
+    running = threading.Thread(target=backup.create_backup, args=(target,))
+    running.start()
+    assert ingested.wait(5)
+    prune = threading.Thread(target=backup.prune_backups, args=(target, 1))
+    prune.start()
+    prune.join(0.2)
+    assert prune.is_alive()
+    resume.set()
+    running.join(5)
+    prune.join(5)
+    assert len(backup.list_snapshots(target)) == 1
+    assert backup.verify_backup(target)['missing'] == []
+
+def test_database_snapshot_is_consistent(media, dream_db):
+    populate(dream_db, media)
+    target = media['BACKUP_DIR']
+    backup.create_backup(target)
+    # Written after the snapshot, so it is not in it
+    dream_db.save_dream(DreamData(user_prompt='later', generated_prompt='g', audio_filename='b.wav', video_filename='w.mp4').model_dump())
+    copy = sqlite3.connect(f"file:{backup._object_path(target, backup.load_manifest(target)['database'])}?immutable=1", uri=True)
+    try:
+        assert copy.execute('SELECT user_prompt FROM dreams').fetchall() == [('u',)]
+    finally:
+        copy.close()
+
+def test_verify_reports_damage(media, dream_db):
+    digest = populate(dream_db, media)
+    target = media['BACKUP_DIR']
+    backup.create_backup(target)
+    audio = backup.load_manifest(target)['files']['audio/2024/03/a.wav']['digest']
+    os.remove(backup._object_path(target, audio))
+    write(backup._object_path(target, digest).rsplit(os.sep, 1)[0], digest, b'oediv' * 100)
+    shallow = backup.verify_backup(target)
+    assert shallow['missing'] == ['audio/2024/03/a.wav'] and shallow['corrupt'] == []
+    deep = backup.verify_backup(target, deep=True)
+    assert sorted(deep['corrupt']) == [f"blobs/{digest[:2]}/{digest}", 'video/2024/03/v.mp4']
+    with pytest.raises(ValueError, match='incomplete'):
+        backup.restore_backup(target)
+
+def test_restore_puts_media_and_database_back(media, dream_db):
+    digest = populate(dream_db, media)
+    target = media['BACKUP_DIR']
+    backup.create_backup(target)
+    manifest = backup.load_manifest(target)
+    video = os.path.join(media['VIDEOS_DIR'], '2024/03/v.mp4')
+    stream = os.path.join(media['STREAMS_DIR'], '2024/03/v/master.m3u8')
+    os.remove(video)
+    os.remove(blob_store.blob_path(digest))
+    write(media['STREAMS_DIR'], '2024/03/v/master.m3u8', b'changed')
+    dream_db.delete_dream(dream_db.get_all_dreams()[0]['id'])
+    report = backup.restore_backup(target)
+    assert report['files_restored'] == 3 and report['files_kept'] == 1
+    assert read(video) == b'video' * 100 and read(stream) == b'#EXTM3U'
+    assert os.stat(video).st_mtime_ns == manifest['files']['video/2024/03/v.mp4']['mtime_ns']
+    # Restored as one inode again, as the blob store had them, and not shared with the backup
+    assert os.path.samefile(video, blob_store.blob_path(digest))
+    assert not os.path.samefile(video, backup._object_path(target, digest))
+    # Loaded through SQLite, so connections left open (and their WAL) see the restored rows
+    assert len(dream_db.get_all_dreams()) == 1
+    dream_db.close()
+    restored = DreamDB(db_path=media['DB_PATH'])
+    try:
+        assert len(restored.get_all_dreams()) == 1
+    finally:
+        restored.close()
+
+def test_restore_refuses_to_run_under_the_app(media, dream_db):
+    populate(dream_db, media)
+    target = media['BACKUP_DIR']
+    backup.create_backup(target)
+    dream_db.delete_dream(dream_db.get_all_dreams()[0]['id'])
+    app_lock = acquire_app_lock(media['DB_PATH'])
+    try:
+        with pytest.raises(RuntimeError, match='stop it first'):
+            backup.restore_backup(target)
+        assert dream_db.get_all_dreams() == []
+    finally:
+        app_lock.close()
+    backup.restore_backup(target)
+    assert len(dream_db.get_all_dreams()) == 1
+    # The restore let go of the lock, so the app can start again
+    acquire_app_lock(media['DB_PATH']).close()
+
+def test_backup_script(media, dream_db, monkeypatch):
+    import scripts.backup as script
+    monkeypatch.setattr(script, 'get_config', lambda: media)
+    output = []
+    monkeypatch.setattr(builtins, 'print', lambda *a, **kw: output.append(' '.join(map(str, a))))
+    populate(dream_db, media)
+    assert script.main(['create']) == 0
+    assert script.main(['list']) == 0 and output[-1].endswith('4 files')
+    assert script.main(['verify', '--deep']) == 0
+    assert script.main(['restore']) == 1 and '--yes' in output[-1]
+    assert script.main(['--target', str(media['BACKUP_DIR']) + '-empty', 'verify']) == 1
+    assert output[-1].startswith('Backup verify failed: No backups')
@@ -0,0 +1,79 @@
+import os
+import pytest
+from unittest import mock
+from functions import blob_store, media_gc
+from functions.dream_db import DreamDB, DreamData
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    config = {key: str(tmp_path / key.lower()) for key in (
+        'VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR', 'MEDIA_BLOBS_DIR',
+    )}
+    for directory in config.values():
+        os.makedirs(directory)
+    monkeypatch.setattr(blob_store, 'get_config', lambda: config)
+    monkeypatch.setattr(media_gc, 'get_config', lambda: config)
+    return config
+
+@pytest.fixture
+def dream_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    db = DreamDB(db_path=str(tmp_path / 'dreams.sqlite3'))
+    yield db
+    db.close()
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def save(db, video_filename, digest):
+    data = DreamData(user_prompt='u', generated_prompt='g', audio_filename='a.wav', video_filename=video_filename, video_digest=digest)
+    return db.save_dream(data.model_dump())
+
+def test_identical_files_share_one_blob(media, dream_db, tmp_path):
+    source = write(tmp_path / 'sample.mp4', b'v' * 100)
+    first = blob_store.store_file(dream_db, str(source), os.path.join(media['VIDEOS_DIR'], 'a.mp4'))
+    # A freshly generated duplicate is swapped for a link in place
+    duplicate = write(os.path.join(media['VIDEOS_DIR'], 'b.mp4'), b'v' * 100)
+    second = blob_store.store_file(dream_db, duplicate)
+    assert first == second == blob_store.file_digest(str(source))
+    stored = blob_store.blob_path(first)
+    assert os.path.samefile(stored, os.path.join(media['VIDEOS_DIR'], 'a.mp4'))
+    assert os.path.samefile(stored, duplicate)
+    # Bytes shared by several names count once
+    assert media_gc.path_size(media['VIDEOS_DIR']) == 100
+    assert dream_db.get_blob(first) == {'digest': first, 'size': 100, 'refcount': 0, 'last_linked_at': mock.ANY}
+
+def test_falls_back_to_copy_across_filesystems(media, tmp_path, monkeypatch):
+    source = write(tmp_path / 'sample.mp4', b'data')
+    monkeypatch.setattr(os, 'link', mock.Mock(side_effect=OSError(18, 'Invalid cross-device link')))
+    monkeypatch.setattr(blob_store, 'fcntl', None)
+    target = os.path.join(media['VIDEOS_DIR'], 'copy.mp4')
+    assert blob_store.link_or_copy(str(source), target) == 'copy'
+    assert open(target, 'rb').read() == b'data' and not os.path.samefile(source, target)
+
+def test_blob_is_released_with_its_last_reference(media, dream_db):
+    write(os.path.join(media['VIDEOS_DIR'], 'a.mp4'), b'v' * 100)
+    write(os.path.join(media['VIDEOS_DIR'], 'b.mp4'), b'v' * 100)
+    digest = blob_store.store_video(dream_db, 'a.mp4')
+    assert blob_store.store_video(dream_db, 'b.mp4') == digest
+    first, second = save(dream_db, 'a.mp4', digest), save(dream_db, 'b.mp4', digest)
+    assert dream_db.get_blob(digest)['refcount'] == 2
+    dream_db.delete_dream(first)
+    # Other names still link the bytes, so nothing is freed yet
+    assert media_gc.reap_deleted_dreams(dream_db) == (1, 0)
+    assert os.path.exists(blob_store.blob_path(digest))
+    dream_db.delete_dream(second)
+    assert media_gc.reap_deleted_dreams(dream_db) == (1, 100)
+    assert not os.path.exists(blob_store.blob_path(digest))
+    assert dream_db.get_blob(digest) is None
+
+def test_unreferenced_blobs_are_reaped_after_min_age(media, dream_db):
+    write(os.path.join(media['VIDEOS_DIR'], 'failed.mp4'), b'v' * 10)
+    digest = blob_store.store_video(dream_db, 'failed.mp4')
+    # A pipeline that is still running has not saved its dream yet
+    assert blob_store.reap_unreferenced_blobs(dream_db, min_age=3600) == (0, 0)
+    os.remove(os.path.join(media['VIDEOS_DIR'], 'failed.mp4'))
+    assert blob_store.reap_unreferenced_blobs(dream_db, min_age=0) == (1, 10)
+    assert dream_db.get_blob(digest) is None
@@ -0,0 +1,26 @@
+import pytest
+import builtins
+from unittest import mock
+
+import scripts.collect_garbage as mod
+
+@pytest.fixture
+def fake_env(monkeypatch):
+    monkeypatch.setattr(mod, 'get_config', lambda: {'ORPHAN_MIN_AGE': 3600, 'MEDIA_GC_BATCH_SIZE': 50})
+    fake_db = mock.Mock()
+    monkeypatch.setattr(mod, 'DreamDB', lambda: fake_db)
+    printed = []
+    monkeypatch.setattr(builtins, 'print', lambda *a, **kw: printed.append(' '.join(map(str, a))))
+    return fake_db, printed
+
+def test_collect_garbage_reports_reclaimed_space(monkeypatch, fake_env):
+    fake_db, printed = fake_env
+    collect = mock.Mock(return_value={'dreams_purged': 2, 'orphans_removed': 3, 'blobs_released': 1, 'bytes_reclaimed': 5 * 1048576})
+    monkeypatch.setattr(mod, 'collect_garbage', collect)
+    assert mod.main(['--dry-run', '--min-age', '60']) == 0
+    collect.assert_called_once_with(fake_db, batch_size=50, min_age=60.0, dry_run=True)
+    assert 'Would reclaim 5.0 MB' in printed[-1]
+
+def test_collect_garbage_failure(monkeypatch, fake_env):
+    monkeypatch.setattr(mod, 'collect_garbage', mock.Mock(side_effect=Exception('db locked')))
+    assert mod.main([]) == 1
@@ -1,7 +1,7 @@
+import sqlite3
 import pytest
-import tempfile
-import os
-from functions.dream_db import DreamDB, DreamData
+from contextlib import contextmanager
+from functions.dream_db import DreamDB, DreamData, LIST_COLUMNS, SNIPPET_START, SNIPPET_END
 
 def test_get_all_dreams(mock_dream_db):
     mock_dream_db.get_all_dreams.return_value = [
@@ -34,15 +34,15 @@ def test_delete_dream_not_found(mock_dream_db):
     assert result is False
 
 @pytest.fixture
-def temp_db_path():
-    fd, path = tempfile.mkstemp(suffix='.sqlite3')
-    os.close(fd)
-    yield path
-    os.remove(path)
+def temp_db_path(tmp_path):
+    # A fresh directory also holds the -wal/-shm files and the vector index
+    return str(tmp_path / 'dreams.sqlite3')
 
 @pytest.fixture
 def dream_db(temp_db_path):
-    return DreamDB(db_path=temp_db_path)
+    db = DreamDB(db_path=temp_db_path)
+    yield db
+    db.close()
 
 def test_save_and_get_dream(dream_db):
     data = DreamData(
@@ -119,4 +119,369 @@ def test_update_dream_outer_exception(dream_db, caplog):
     with caplog.at_level('ERROR'):
         with pytest.raises(RuntimeError):
             dream_db.update_dream(dream_id, BadUpdates())
-    assert "Error updating dream" in caplog.text 
\ No newline at end of file
+    assert "Error updating dream" in caplog.text 
+def test_save_dream_thumbnail_details(dream_db):
+    data = DreamData(
+        user_prompt='u', generated_prompt='g', audio_filename='a', video_filename='v',
+        thumb_filename='t.webp', thumb_sizes='160,540', thumb_placeholder='LEHV6nWB2yk8'
+    ).model_dump()
+    dream = dream_db.get_dream(dream_db.save_dream(data))
+    assert dream['thumb_sizes'] == '160,540'
+    assert dream['thumb_placeholder'] == 'LEHV6nWB2yk8'
+
+def test_save_dream_media_metadata(dream_db):
+    data = DreamData(
+        user_prompt='u', generated_prompt='g', audio_filename='a', video_filename='v',
+        duration=5.04, width=1280, height=720, bitrate=4000000, video_codec='h264', file_size=2520000
+    ).model_dump()
+    dream_id = dream_db.save_dream(data)
+    dream = dream_db.get_dream(dream_id)
+    assert (dream['duration'], dream['width'], dream['height']) == (5.04, 1280, 720)
+    assert (dream['bitrate'], dream['video_codec'], dream['file_size']) == (4000000, 'h264', 2520000)
+    # Listing cards show the duration without probing the file
+    assert dream_db.list_dreams()[0]['duration'] == 5.04
+
+def test_init_db_adds_missing_columns(temp_db_path):
+    import sqlite3
+    with sqlite3.connect(temp_db_path) as conn:
+        conn.execute('''
+            CREATE TABLE dreams (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_prompt TEXT NOT NULL, generated_prompt TEXT NOT NULL,
+                audio_filename TEXT NOT NULL, video_filename TEXT NOT NULL, thumb_filename TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, status TEXT
+            )
+        ''')
+    DreamDB(db_path=temp_db_path)
+    with sqlite3.connect(temp_db_path) as conn:
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(dreams)')}
+    assert {'thumb_sizes', 'thumb_placeholder'} <= columns
+
+def test_connections_are_pooled_with_pragmas(dream_db):
+    with dream_db._connection() as conn:
+        first = conn
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    with dream_db._connection() as conn:
+        assert conn is first
+
+def test_connection_pool_is_bounded(dream_db, monkeypatch):
+    import functions.dream_db as dream_db_module
+    monkeypatch.setattr(dream_db_module, 'POOL_SIZE', 1)
+    dream_db.close()
+    with dream_db._connection() as a:
+        with dream_db._connection() as b:
+            assert a is not b
+    assert len(dream_db._pool) == 1
+
+def test_connection_rolls_back_on_error(dream_db):
+    data = DreamData(user_prompt='u', generated_prompt='g', audio_filename='a', video_filename='v').model_dump()
+    with pytest.raises(RuntimeError):
+        with dream_db._connection() as conn:
+            conn.execute("INSERT INTO dreams (user_prompt, generated_prompt, audio_filename, video_filename) VALUES ('x', 'x', 'x', 'x')")
+            raise RuntimeError('fail')
+    before = len(dream_db.get_all_dreams())
+    dream_db.save_dream(data)
+    assert len(dream_db.get_all_dreams()) == before + 1
+    assert not any(d['user_prompt'] == 'x' for d in dream_db.get_all_dreams())
+
+def test_close_and_context_manager(temp_db_path):
+    with DreamDB(db_path=temp_db_path) as db:
+        db.get_all_dreams()
+        assert db._pool
+    assert db._pool == []
+    # Closing twice is harmless and the DB is still usable afterwards
+    db.close()
+    assert isinstance(db.get_all_dreams(), list)
+    db.close()
+
+def test_list_dreams_keyset_pagination(dream_db):
+    ids = []
+    for i in range(5):
+        data = DreamData(user_prompt=f'u{i}', generated_prompt='g', audio_filename='a', video_filename='v').model_dump()
+        ids.append(dream_db.save_dream(data))
+    # Two dreams sharing a timestamp are ordered by id
+    dream_db.update_dream(ids[3], {'created_at': '2020-01-01 00:00:00'})
+    dream_db.update_dream(ids[4], {'created_at': '2020-01-01 00:00:00'})
+    page = dream_db.list_dreams(limit=2)
+    paged = [d['id'] for d in page]
+    while True:
+        page = dream_db.list_dreams(limit=2, before_created_at=page[-1]['created_at'], before_id=page[-1]['id'])
+        if not page:
+            break
+        assert len(page) <= 2
+        paged += [d['id'] for d in page]
+    assert paged == [d['id'] for d in dream_db.get_all_dreams()]
+    assert paged[-2:] == [ids[4], ids[3]]
+    assert [d['id'] for d in dream_db.list_dreams(before_id=ids[4])] == [ids[3]]
+    assert [d['id'] for d in dream_db.list_dreams(before_created_at='2021-01-01')] == [ids[4], ids[3]]
+    # The cursor carries its own timestamp, so it outlives the dream it points at
+    dream_db.purge_dream(ids[4])
+    assert [d['id'] for d in dream_db.list_dreams(before_created_at='2020-01-01 00:00:00', before_id=ids[4])] == [ids[3]]
+
+def test_list_dreams_uses_created_at_index(dream_db):
+    with dream_db._connection() as conn:
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM dreams WHERE deleted_at IS NULL ORDER BY created_at DESC, id DESC LIMIT 50"
+        ).fetchall()
+    assert any('idx_dreams_created_at' in row[-1] for row in plan)
+
+def test_adjacent_dream_id_wraps_and_tracks_writes(dream_db):
+    def add(prompt):
+        data = DreamData(user_prompt=prompt, generated_prompt='g', audio_filename='a', video_filename='v').model_dump()
+        return dream_db.save_dream(data)
+    ids = [d['id'] for d in dream_db.get_all_dreams()]
+    newest = add('new')
+    ids.insert(0, newest)
+    assert dream_db.get_latest_dream_id() == newest
+    # Stepping older walks the newest-first order and wraps to the newest
+    walk = [newest]
+    for _ in range(len(ids)):
+        walk.append(dream_db.get_adjacent_dream_id(walk[-1]))
+    assert walk == ids + [newest]
+    assert dream_db.get_adjacent_dream_id(newest, step=-1) == ids[-1]
+    # Inserts and deletes invalidate the cached order
+    newer = add('newer')
+    assert dream_db.get_adjacent_dream_id(newer) == newest
+    dream_db.delete_dream(newest)
+    assert dream_db.get_adjacent_dream_id(newer) == ids[1]
+    # A deleted cursor restarts at the newest dream
+    assert dream_db.get_adjacent_dream_id(newest) == newer
+
+def test_adjacent_dream_id_sees_other_writers(dream_db, temp_db_path):
+    def add(db, prompt):
+        return db.save_dream(DreamData(user_prompt=prompt, generated_prompt='g', audio_filename='a', video_filename='v').model_dump())
+    first = add(dream_db, 'first')
+    assert dream_db.get_latest_dream_id() == first
+    # Another process (e.g. an import) adds a dream; the cache notices without a local write
+    other = DreamDB(db_path=temp_db_path)
+    try:
+        imported = add(other, 'imported')
+    finally:
+        other.close()
+    assert dream_db.get_latest_dream_id() == imported
+    assert dream_db.get_adjacent_dream_id(imported) == first
+
+def test_adjacent_dream_id_drops_rebuilds_that_raced_a_write(dream_db):
+    def add(prompt):
+        return dream_db.save_dream(DreamData(user_prompt=prompt, generated_prompt='g', audio_filename='a', video_filename='v').model_dump())
+    first = add('first')
+    second = add('second')
+    connection = dream_db._connection
+    @contextmanager
+    def racing_connection():
+        with connection() as conn:
+            yield conn
+        # A delete commits while the rebuild still holds the list it read
+        dream_db._connection = connection
+        dream_db.delete_dream(second)
+    dream_db._connection = racing_connection
+    assert dream_db._dream_id_index()[0][0] == second
+    assert dream_db._id_index is None
+    assert dream_db.get_latest_dream_id() == first
+
+def test_list_dreams_projection(dream_db):
+    long_prompt = 'x' * 80
+    data = DreamData(user_prompt=long_prompt, generated_prompt='g' * 500, audio_filename='a', video_filename='v').model_dump()
+    dream_id = dream_db.save_dream(data)
+    dream = dream_db.list_dreams(limit=1, columns=LIST_COLUMNS)[0]
+    assert set(dream) == set(LIST_COLUMNS)
+    assert dream['id'] == dream_id
+    assert dream['prompt_excerpt'] == 'x' * 50 + '...'
+    with pytest.raises(ValueError):
+        dream_db.list_dreams(columns=('id', 'id; DROP TABLE dreams'))
+    # Detail fetch still returns the full prompts
+    assert dream_db.get_dream(dream_id)['user_prompt'] == long_prompt
+
+def test_search_dreams_tracks_writes(dream_db):
+    def add(user_prompt, generated_prompt='g'):
+        data = DreamData(user_prompt=user_prompt, generated_prompt=generated_prompt, audio_filename='a', video_filename='v').model_dump()
+        return dream_db.save_dream(data)
+    whale = add('I was flying over the ocean', 'a whale in a cosmic sea')
+    forest = add('running through a forest')
+    results = dream_db.search_dreams('whal')
+    assert [d['id'] for d in results] == [whale]
+    assert results[0]['snippet'] == f'a {SNIPPET_START}whale{SNIPPET_END} in a cosmic sea'
+    assert 'user_prompt' not in results[0]
+    # Every word has to match; quotes and operators are treated as text
+    assert dream_db.search_dreams('ocean forest') == []
+    assert [d['id'] for d in dream_db.search_dreams('"ocean AND')] == []
+    assert [d['id'] for d in dream_db.search_dreams('ocean fly')] == [whale]
+    assert dream_db.search_dreams('   ') == []
+    dream_db.update_dream(forest, {'user_prompt': 'swimming with a whale'})
+    assert {d['id'] for d in dream_db.search_dreams('whale')} == {whale, forest}
+    assert dream_db.search_dreams('forest') == []
+    dream_db.delete_dream(whale)
+    assert [d['id'] for d in dream_db.search_dreams('whale', limit=1)] == [forest]
+    assert dream_db.search_dreams('whale', offset=1) == []
+
+def test_search_dreams_pages_skip_deleted_matches(dream_db):
+    ids = [
+        dream_db.save_dream(DreamData(user_prompt='a lighthouse', generated_prompt='g', audio_filename='a', video_filename='v').model_dump())
+        for _ in range(4)
+    ]
+    # Equal ranks come newest first, so the deleted dream heads the first page
+    dream_db.delete_dream(ids[-1])
+    assert [d['id'] for d in dream_db.search_dreams('lighthouse', limit=2)] == [ids[2], ids[1]]
+    assert [d['id'] for d in dream_db.search_dreams('lighthouse', limit=2, offset=2)] == [ids[0]]
+
+def test_init_db_backfills_search_index(temp_db_path):
+    import sqlite3
+    with sqlite3.connect(temp_db_path) as conn:
+        conn.execute('''
+            CREATE TABLE dreams (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_prompt TEXT NOT NULL, generated_prompt TEXT NOT NULL,
+                audio_filename TEXT NOT NULL, video_filename TEXT NOT NULL, thumb_filename TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, status TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO dreams (user_prompt, generated_prompt, audio_filename, video_filename) VALUES ('a purple lighthouse', 'g', 'a', 'v')")
+    with DreamDB(db_path=temp_db_path) as db:
+        # Existing rows are indexed by the online backfill, not at startup
+        assert db.search_dreams('lighthouse') == []
+        db.run_backfills(pause=0)
+        assert [d['prompt_excerpt'] for d in db.search_dreams('lighthouse')] == ['a purple lighthouse']
+
+def test_similar_dreams_follow_writes(dream_db, temp_db_path):
+    def add(user_prompt, generated_prompt='g'):
+        data = DreamData(user_prompt=user_prompt, generated_prompt=generated_prompt, audio_filename='a', video_filename='v').model_dump()
+        return dream_db.save_dream(data)
+    ocean = add('flying over the ocean', 'whales under a violet sky above the ocean')
+    whales = add('swimming with whales', 'whales in a violet ocean')
+    school = add('late for an exam', 'an endless school hallway')
+    similar = dream_db.similar_dreams(ocean, k=2)
+    assert similar[0]['id'] == whales
+    assert similar[0]['score'] > similar[1]['score']
+    assert 'user_prompt' not in similar[0]
+    dream_db.update_dream(school, {'generated_prompt': 'whales over a violet ocean'})
+    dream_db.delete_dream(whales)
+    assert dream_db.similar_dreams(ocean, k=1)[0]['id'] == school
+    # The index lives next to the database and survives a restart
+    with DreamDB(db_path=temp_db_path) as reopened:
+        assert reopened.similar_dreams(ocean, k=1)[0]['id'] == school
+    # Rows written behind the index's back (e.g. by a restore) trigger a rebuild on open
+    with sqlite3.connect(temp_db_path) as conn:
+        conn.execute(
+            "INSERT INTO dreams (user_prompt, generated_prompt, audio_filename, video_filename) "
+            "VALUES ('flying over the ocean', 'whales under a violet sky above the ocean', 'b', 'w')"
+        )
+    with DreamDB(db_path=temp_db_path) as reopened:
+        assert reopened.similar_dreams(ocean, k=1)[0]['prompt_excerpt'] == 'flying over the ocean'
+
+def test_find_similar_prompts_and_shared_videos(dream_db):
+    data = DreamData(
+        user_prompt='I keep dreaming my teeth fall out', generated_prompt='teeth falling into a silver sea',
+        audio_filename='a', video_filename='teeth.mp4'
+    ).model_dump()
+    original = dream_db.save_dream(data)
+    matches = dream_db.find_similar_prompts('I keep dreaming my teeth fall out!', 'Teeth falling into a silver sea', 0.9)
+    assert [(dream['id'], round(score, 3)) for dream, score in matches] == [(original, 1.0)]
+    assert dream_db.find_similar_prompts('a red balloon', 'a red balloon over a city', 0.9) == []
+    # A reusing dream shares the video; the file stays in use until both are gone
+    reuse = dream_db.save_dream(dict(data, audio_filename='b', source_dream_id=original))
+    assert dream_db.get_dream(reuse)['source_dream_id'] == original
+    dream_db.delete_dream(original)
+    assert dream_db.video_in_use('teeth.mp4', exclude_id=original)
+    dream_db.delete_dream(reuse)
+    # Deleted dreams keep their files referenced until the reaper purges them
+    assert dream_db.video_in_use('teeth.mp4', exclude_id=original)
+    assert dream_db.purge_dream(reuse)
+    assert not dream_db.video_in_use('teeth.mp4', exclude_id=original)
+
+def test_soft_delete_hides_dream_until_purged(dream_db):
+    data = DreamData(
+        user_prompt='a lighthouse in fog', generated_prompt='g', audio_filename='gone.wav', video_filename='gone.mp4'
+    ).model_dump()
+    dream_id = dream_db.save_dream(data)
+    keep = dream_db.save_dream(dict(data, user_prompt='another lighthouse', audio_filename='keep.wav'))
+    assert dream_db.delete_dream(dream_id)
+    assert not dream_db.delete_dream(dream_id)
+    assert dream_db.get_dream(dream_id) is None
+    assert dream_id not in [d['id'] for d in dream_db.list_dreams()]
+    assert dream_id not in [d['id'] for d in dream_db.get_all_dreams()]
+    assert [d['id'] for d in dream_db.search_dreams('lighthouse')] == [keep]
+    assert dream_id not in dream_db._dream_id_index()[1]
+    # Live dreams cannot be purged; deleted ones wait in the reaper queue
+    assert not dream_db.purge_dream(keep)
+    assert [d['id'] for d in dream_db.get_deleted_dreams()] == [dream_id]
+    assert dream_db.referenced_media(['gone.wav', 'keep.wav', 'stray.wav']) == {'gone.wav', 'keep.wav'}
+    assert dream_db.purge_dream(dream_id)
+    assert dream_db.get_deleted_dreams() == []
+    assert dream_db.referenced_media(['gone.wav', 'keep.wav']) == {'keep.wav'}
+
+def test_stats_tables_follow_writes(dream_db):
+    def save(prompt, seconds=None, source=None, video='v'):
+        return dream_db.save_dream(DreamData(
+            user_prompt=prompt, generated_prompt='g', audio_filename=prompt, video_filename=video,
+            pipeline_seconds=seconds, source_dream_id=source,
+        ).model_dump())
+    before = dream_db.get_stats()['totals']['dreams']
+    first = save('dream one', seconds=75)
+    save('dream two!', seconds=4, source=first)
+    slow = save('slow', seconds=900, video='w')
+    dream_db.record_pipeline_failure()
+    stats = dream_db.get_stats()
+    totals = stats['totals']
+    assert totals['dreams'] == before + 3
+    assert (totals['generated'], totals['reused'], totals['failed'], totals['reused_dreams']) == (2, 1, 1, 1)
+    assert totals['failure_rate'] == 0.25 and totals['average_generation_seconds'] == 487.5
+    assert (totals['generation_seconds_p50'], totals['generation_seconds_p90']) == (90, None)
+    assert [bucket['runs'] for bucket in stats['generation_time_histogram'] if bucket['runs']] == [1, 1]
+    assert stats['daily'][-1]['dreams'] == totals['dreams'] and stats['daily'][-1]['failed'] == 1
+    # Deletes, prompt edits and date changes move the library counts; finished runs stay counted
+    dream_db.delete_dream(slow)
+    dream_db.update_dream(first, {'user_prompt': 'dream 1', 'created_at': '2024-03-05 10:00:00'})
+    stats = dream_db.get_stats(days=7)
+    assert stats['totals']['dreams'] == before + 2 and stats['totals']['generated'] == 2
+    assert stats['daily'][-1]['dreams'] == before + 1
+    assert stats['daily'][-1]['average_prompt_chars'] == round(
+        (sum(len(d['user_prompt']) for d in dream_db.get_all_dreams()) - len('dream 1')) / (before + 1), 1
+    )
+    assert '2024-03-05' in [day['day'] for day in dream_db.get_stats(days=10000)['daily']]
+
+def test_imported_dreams_are_not_counted_as_pipeline_runs(dream_db):
+    before = dream_db.get_stats()
+    rows = [
+        dict(DreamData(user_prompt=f'imported {i}', generated_prompt='g', audio_filename=f'{i}.wav',
+                       video_filename=f'{i}.mp4', pipeline_seconds=60).model_dump(), created_at='2024-03-05 10:00:00')
+        for i in range(2)
+    ]
+    assert [inserted for _, inserted in dream_db.import_dreams(rows)] == [True, True]
+    after = dream_db.get_stats()
+    # They join the library, but no generation ran here
+    assert after['totals']['dreams'] == before['totals']['dreams'] + 2
+    for key in ('generated', 'reused', 'failed', 'average_generation_seconds'):
+        assert after['totals'][key] == before['totals'][key]
+    assert after['generation_time_histogram'] == before['generation_time_histogram']
+
+def test_pipeline_traces(dream_db, monkeypatch):
+    from functions import dream_db as dream_db_module
+    monkeypatch.setattr(dream_db_module, 'FAILED_TRACES_KEPT', 2)
+    spans = [
+        {'name': 'whisper', 'depth': 0, 'start_ms': 0.0, 'duration_ms': 800.0, 'error': None, 'attrs': {}},
+        {'name': 'luma_poll', 'depth': 1, 'start_ms': 900.0, 'duration_ms': 120.5, 'error': None, 'attrs': {'state': 'completed'}},
+    ]
+    dream_id = dream_db.save_dream(DreamData(
+        user_prompt='u', generated_prompt='g', audio_filename='a', video_filename='v',
+    ).model_dump())
+    dream_db.save_trace('t1', dream_id, '2025-06-01 10:00:00', spans)
+    trace = dream_db.get_dream_trace(dream_id)
+    assert trace['trace_id'] == 't1' and trace['status'] == 'completed' and trace['total_ms'] == 1020.5
+    assert trace['spans'] == spans
+    assert dream_db.get_dream_trace(dream_id + 1) is None
+    # Only the newest failed runs are kept
+    for n in range(3):
+        dream_db.save_trace(f"f{n}", None, f"2025-06-0{n + 2} 10:00:00", [dict(spans[0], error='boom')])
+    assert [t['trace_id'] for t in dream_db.list_traces(failed=True)] == ['f2', 'f1']
+    assert dream_db.get_trace('f0') is None
+    summary = dream_db.list_traces()[0]
+    assert (summary['status'], summary['failed_stage'], summary['error'], summary['spans']) == ('failed', 'whisper', 'boom', 1)
+    assert [t['trace_id'] for t in dream_db.list_traces(failed=False)] == ['t1']
+    # A dream's trace goes when its row is purged
+    dream_db.delete_dream(dream_id)
+    dream_db.purge_dream(dream_id)
+    assert dream_db.get_trace('t1') is None
+
+def test_similarity_flag_accepts_strings(monkeypatch):
+    for value, enabled in (('false', False), ('0', False), (False, False), ('true', True), (True, True)):
+        monkeypatch.setattr('functions.dream_db.get_config', lambda: {'SIMILAR_DREAMS_ENABLED': value})
+        assert DreamDB._similarity_enabled() is enabled
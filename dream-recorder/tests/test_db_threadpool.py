@@ -0,0 +1,63 @@
+import threading
+import pytest
+import gevent
+from gevent.monkey import get_original
+from functions.db_threadpool import ThreadedDreamDB
+from functions.dream_db import DreamDB, DreamData
+
+native_sleep = get_original('time', 'sleep')
+
+class FakeDB:
+    name = 'fake'
+
+    def __init__(self):
+        self.closed = False
+
+    def slow(self, seconds):
+        # Blocks the calling OS thread the way a long sqlite3 call does
+        native_sleep(seconds)
+        return threading.get_ident()
+
+    def fail(self):
+        raise ValueError('query failed')
+
+    def close(self):
+        self.closed = True
+
+def test_calls_run_off_the_hub_and_keep_it_responsive():
+    db = ThreadedDreamDB(FakeDB(), threads=2)
+    ticks = []
+    def ticker():
+        while True:
+            ticks.append(1)
+            gevent.sleep(0.01)
+    ticking = gevent.spawn(ticker)
+    try:
+        worker = db.slow(0.2)
+    finally:
+        ticking.kill()
+    assert worker != threading.get_ident()
+    # The hub kept scheduling other greenlets while the call was blocked
+    assert len(ticks) >= 5
+    db.close()
+
+def test_results_exceptions_and_attributes_pass_through():
+    fake = FakeDB()
+    db = ThreadedDreamDB(fake, threads=2)
+    assert db.name == 'fake'
+    with pytest.raises(ValueError):
+        db.fail()
+    pending = [db.spawn('slow', 0.1) for _ in range(2)]
+    assert all(result.get(timeout=5) for result in pending)
+    db.close()
+    assert fake.closed
+
+def test_threaded_dream_db_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    monkeypatch.setattr('functions.dream_db.get_config', lambda: {'SIMILAR_DREAMS_ENABLED': True})
+    db = ThreadedDreamDB(DreamDB(db_path=str(tmp_path / 'dreams.db')), threads=2)
+    data = DreamData(user_prompt='flying over the sea', generated_prompt='g', audio_filename='a', video_filename='v')
+    dream_id = db.save_dream(data.model_dump())
+    assert db.get_dream(dream_id)['user_prompt'] == 'flying over the sea'
+    assert [d['id'] for d in db.list_dreams()] == [dream_id]
+    db.close()
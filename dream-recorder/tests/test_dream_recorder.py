@@ -83,8 +83,9 @@ def test_handle_stop_recording_error(monkeypatch, mocker):
 
 def test_handle_show_previous_dream_error(monkeypatch, mocker):
     import dream_recorder
-    # Patch dream_db.get_all_dreams to raise
-    monkeypatch.setattr(dream_recorder.dream_db, 'get_all_dreams', lambda: (_ for _ in ()).throw(Exception('fail')))
+    # Patch the dream lookups to raise
+    monkeypatch.setattr(dream_recorder.dream_db, 'get_latest_dream_id', lambda: (_ for _ in ()).throw(Exception('fail')))
+    monkeypatch.setattr(dream_recorder.dream_db, 'get_adjacent_dream_id', lambda dream_id: (_ for _ in ()).throw(Exception('fail')))
     # Patch logger
     logs = []
     class FakeLogger:
@@ -101,8 +102,8 @@ def test_handle_show_previous_dream_error(monkeypatch, mocker):
 
 def test_handle_show_previous_dream_no_dream(monkeypatch, mocker):
     import dream_recorder
-    # Patch dream_db.get_all_dreams to return an empty list
-    monkeypatch.setattr(dream_recorder.dream_db, 'get_all_dreams', lambda: [])
+    # No neighbouring dream to step to
+    monkeypatch.setattr(dream_recorder.dream_db, 'get_adjacent_dream_id', lambda dream_id: None)
     # Patch logger to record warnings
     logs = []
     class FakeLogger:
@@ -112,14 +113,15 @@ def test_handle_show_previous_dream_no_dream(monkeypatch, mocker):
     monkeypatch.setattr(dream_recorder, 'logger', FakeLogger())
     # Set video_playback_state to simulate playing
     dream_recorder.video_playback_state['is_playing'] = True
-    dream_recorder.video_playback_state['current_index'] = 0
+    dream_recorder.video_playback_state['current_dream_id'] = 1
     dream_recorder.handle_show_previous_dream()
     assert any('No dreams found to cycle through.' in msg for msg in logs)
 
 def test_handle_show_previous_dream_dream_is_none(monkeypatch, mocker):
     import dream_recorder
-    # Patch dream_db.get_all_dreams to return a list with None
-    monkeypatch.setattr(dream_recorder.dream_db, 'get_all_dreams', lambda: [None])
+    # The neighbouring ID resolves but the dream row is gone
+    monkeypatch.setattr(dream_recorder.dream_db, 'get_adjacent_dream_id', lambda dream_id: 2)
+    monkeypatch.setattr(dream_recorder.dream_db, 'get_dream', lambda dream_id: None)
     # Patch logger to record warnings
     logs = []
     class FakeLogger:
@@ -132,33 +134,17 @@ def test_handle_show_previous_dream_dream_is_none(monkeypatch, mocker):
     monkeypatch.setattr(dream_recorder.socketio, 'emit', lambda name, data=None: emitted.append((name, data)))
     # Set video_playback_state to simulate playing
     dream_recorder.video_playback_state['is_playing'] = True
-    dream_recorder.video_playback_state['current_index'] = 0
+    dream_recorder.video_playback_state['current_dream_id'] = 1
     dream_recorder.handle_show_previous_dream()
     # Should emit error
     assert any(name == 'error' for name, _ in emitted)
 
-def test_delete_dream_file_deletion_error(test_client, mocker, mock_dream_db):
-    # Simulate dream exists and delete_dream returns True
-    mock_dream_db.get_dream.return_value = {
-        'id': 1, 'video_filename': 'dream1.mp4', 'thumb_filename': 'thumb1.jpg', 'audio_filename': 'audio1.wav'
-    }
-    mock_dream_db.delete_dream.return_value = True
-    # Patch os.path.exists to True so it tries to remove
-    mocker.patch('os.path.exists', return_value=True)
-    # Patch os.remove to raise exception
-    mocker.patch('os.remove', side_effect=Exception('fail'))
-    # Patch get_config
-    mocker.patch('dream_recorder.get_config', return_value={
-        'VIDEOS_DIR': '.', 'THUMBS_DIR': '.', 'RECORDINGS_DIR': '.'
-    })
-    # Patch logger
-    mock_logger = mocker.Mock()
-    mocker.patch('dream_recorder.logger', mock_logger)
+def test_delete_dream_soft_delete_failure(test_client, mock_dream_db):
+    mock_dream_db.get_dream.return_value = {'id': 1, 'video_filename': 'dream1.mp4', 'audio_filename': 'audio1.wav'}
+    mock_dream_db.delete_dream.return_value = False
     resp = test_client.delete('/api/dreams/1')
-    # Should still succeed, but logger.error should be called
-    assert resp.status_code == 200
-    assert resp.get_json()['success'] is True
-    assert mock_logger.error.called
+    assert resp.status_code == 500
+    assert resp.get_json()['success'] is False
 
 def test_api_gpio_single_tap_error(test_client, mocker):
     mocker.patch('dream_recorder.socketio.emit', side_effect=Exception('fail'))
@@ -15,9 +15,10 @@ def patch_sample_dreams(monkeypatch):
 def test_copies_and_inserts(monkeypatch, patch_sample_dreams):
     # Patch os.path.exists to always return False (force copy)
     monkeypatch.setattr('os.path.exists', lambda path: False)
-    # Patch shutil.copy2 to record calls
+    # Patch the blob store to record calls
     copy_calls = []
-    monkeypatch.setattr('shutil.copy2', lambda src, dst: copy_calls.append((src, dst)))
+    monkeypatch.setattr('scripts.init_sample_dreams.store_file', lambda db, src, dst: copy_calls.append((src, dst)) or 'digest')
+    monkeypatch.setattr('scripts.init_sample_dreams.link_or_copy', lambda src, dst: copy_calls.append((src, dst)))
     # Patch print to capture output
     printed = []
     monkeypatch.setattr(builtins, 'print', lambda *a, **kw: printed.append(a))
@@ -32,8 +33,10 @@ def test_copies_and_inserts(monkeypatch, patch_sample_dreams):
 def test_already_exists(monkeypatch, patch_sample_dreams):
     # Patch os.path.exists to always return True (no copy)
     monkeypatch.setattr('os.path.exists', lambda path: True)
-    # Patch shutil.copy2 to record calls
-    monkeypatch.setattr('shutil.copy2', lambda src, dst: None)
+    # Patch the blob store to record calls
+    copy_calls = []
+    monkeypatch.setattr('scripts.init_sample_dreams.store_file', lambda db, src, dst: copy_calls.append((src, dst)))
+    monkeypatch.setattr('scripts.init_sample_dreams.link_or_copy', lambda src, dst: copy_calls.append((src, dst)))
     # Patch print to capture output
     printed = []
     monkeypatch.setattr(builtins, 'print', lambda *a, **kw: printed.append(a))
@@ -43,5 +46,6 @@ def test_already_exists(monkeypatch, patch_sample_dreams):
         {'video_filename': f'dream_{i}.mp4'} for i in range(1, 5)
     ]
     mod.main()
-    # Should print already exists for all samples
+    # Should link nothing and print already exists for all samples
+    assert copy_calls == []
     assert all('already exists' in str(x) for x in printed) 
\ No newline at end of file
@@ -0,0 +1,225 @@
+import io
+import os
+import json
+import zipfile
+import pytest
+from functions import blob_store, library_archive
+from functions.dream_db import DreamDB, DreamData
+
+MEDIA_DIRS = ('VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR', 'MEDIA_BLOBS_DIR')
+
+@pytest.fixture
+def config(monkeypatch):
+    config = {}
+    monkeypatch.setattr('functions.media_layout.get_config', lambda: config)
+    monkeypatch.setattr(blob_store, 'get_config', lambda: config)
+    return config
+
+@pytest.fixture
+def library(tmp_path, monkeypatch, config):
+    """Make a library (database plus media directories) and point the config at it."""
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    opened = []
+
+    def make(name):
+        paths = {key: str(tmp_path / name / key.lower()) for key in MEDIA_DIRS}
+        for directory in paths.values():
+            os.makedirs(directory)
+        config.update(paths)
+        db = DreamDB(db_path=str(tmp_path / name / 'dreams.sqlite3'))
+        opened.append(db)
+        return db, paths
+    yield make
+    for db in opened:
+        db.close()
+
+def write(directory, name, data):
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read(directory, name):
+    with open(os.path.join(directory, name), 'rb') as f:
+        return f.read()
+
+def populate(db, media):
+    write(media['VIDEOS_DIR'], '2024/03/v.mp4', b'video' * 100)
+    write(media['RECORDINGS_DIR'], '2024/03/a.wav', b'first')
+    write(media['RECORDINGS_DIR'], '2024/05/b.wav', b'second')
+    write(media['THUMBS_DIR'], '2024/03/t.webp', b'thumb')
+    write(media['THUMBS_DIR'], '2024/03/t_160.webp', b'small')
+    write(media['STREAMS_DIR'], '2024/03/v/master.m3u8', b'#EXTM3U')
+    write(media['STREAMS_DIR'], '2024/03/v/v0/seg_000.ts', b'segment')
+    digest = blob_store.store_video(db, '2024/03/v.mp4')
+    original = db.save_dream(DreamData(
+        user_prompt='flying over the sea', generated_prompt='g', audio_filename='2024/03/a.wav',
+        video_filename='2024/03/v.mp4', thumb_filename='2024/03/t.webp', thumb_sizes='160,540',
+        preview_filename='2024/03/p.mp4', stream_manifest='2024/03/v/master.m3u8', video_digest=digest,
+    ).model_dump())
+    # Reuses the first dream's video and derived media
+    reuse = db.save_dream(DreamData(
+        user_prompt='flying again', generated_prompt='g', audio_filename='2024/05/b.wav',
+        video_filename='2024/03/v.mp4', thumb_filename='2024/03/t.webp', thumb_sizes='160,540',
+        stream_manifest='2024/03/v/master.m3u8', video_digest=digest, source_dream_id=original,
+    ).model_dump())
+    gone = db.save_dream(DreamData(
+        user_prompt='deleted', generated_prompt='g', audio_filename='c.wav', video_filename='c.mp4',
+    ).model_dump())
+    db.update_dream(original, {'created_at': '2024-03-05 10:00:00', 'last_played_at': '2024-06-01 08:00:00'})
+    db.update_dream(reuse, {'created_at': '2024-05-01 10:00:00'})
+    db.delete_dream(gone)
+    return digest
+
+def export(db, **kwargs):
+    chunks = list(library_archive.iter_export(db, **kwargs))
+    assert chunks and all(chunks)
+    return chunks, zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+def test_export_streams_rows_and_media(library, monkeypatch):
+    db, media = library('source')
+    populate(db, media)
+    monkeypatch.setattr(library_archive, 'COPY_CHUNK_SIZE', 64)
+    chunks, archive = export(db)
+    assert archive.testzip() is None
+    assert json.loads(archive.read('manifest.json'))['format'] == library_archive.ARCHIVE_FORMAT
+    rows = [json.loads(line) for line in archive.read('dreams.ndjson').splitlines()]
+    assert [row['user_prompt'] for row in rows] == ['flying over the sea', 'flying again']
+    # Shared media is written once; the missing preview is left out
+    assert sorted(name for name in archive.namelist() if name.startswith('media/')) == [
+        'media/audio/2024/03/a.wav', 'media/audio/2024/05/b.wav',
+        'media/streams/2024/03/v/master.m3u8', 'media/streams/2024/03/v/v0/seg_000.ts',
+        'media/thumbs/2024/03/t.webp', 'media/thumbs/2024/03/t_160.webp', 'media/video/2024/03/v.mp4',
+    ]
+    assert archive.read('media/video/2024/03/v.mp4') == b'video' * 100
+    # The video went out in read-sized pieces rather than in one piece
+    assert sum(len(chunk) == 64 for chunk in chunks) >= 500 // 64 - 1
+    _, rows_only = export(db, include_media=False)
+    assert rows_only.namelist() == ['manifest.json', 'dreams.ndjson']
+
+@pytest.mark.parametrize('unzip', [False, True])
+def test_import_round_trip(library, tmp_path, unzip):
+    source_db, source_media = library('source')
+    digest = populate(source_db, source_media)
+    _, archive = export(source_db)
+    path = str(tmp_path / 'export.zip')
+    archive.fp.seek(0)
+    with open(path, 'wb') as f:
+        f.write(archive.fp.read())
+    if unzip:
+        zipfile.ZipFile(path).extractall(tmp_path / 'export')
+        path = str(tmp_path / 'export')
+    db, media = library('target')
+    # Ids in the new library do not line up with the exported ones
+    db.save_dream(DreamData(user_prompt='mine', generated_prompt='g', audio_filename='m.wav', video_filename='m.mp4').model_dump())
+    report = library_archive.import_library(db, path, batch_size=1, workers=2)
+    assert report['dreams_imported'] == 2 and report['dreams_skipped'] == 0
+    assert report['files_linked' if unzip else 'files_copied'] == 7
+    original, reuse = sorted(
+        (dream for dream in db.get_all_dreams() if dream['user_prompt'] != 'mine'), key=lambda dream: dream['created_at']
+    )
+    assert original['created_at'] == '2024-03-05 10:00:00' and original['last_played_at'] == '2024-06-01 08:00:00'
+    assert reuse['source_dream_id'] == original['id'] != 1
+    assert original['video_digest'] == reuse['video_digest'] == digest
+    assert db.get_blob(digest)['refcount'] == 2
+    assert read(media['VIDEOS_DIR'], '2024/03/v.mp4') == b'video' * 100
+    assert read(media['STREAMS_DIR'], '2024/03/v/v0/seg_000.ts') == b'segment'
+    assert db.search_dreams('flying')
+    # Running it again changes nothing
+    again = library_archive.import_library(db, path)
+    assert again == {'dreams_imported': 0, 'dreams_skipped': 2, 'files_copied': 0, 'files_linked': 0}
+    assert len(db.get_all_dreams()) == 3
+
+def test_imported_media_survives_an_orphan_scan_before_commit(library, tmp_path, config, monkeypatch):
+    from functions import media_gc
+    source_db, source_media = library('source')
+    populate(source_db, source_media)
+    _, archive = export(source_db)
+    archive.extractall(tmp_path / 'export')
+    # An unzipped export keeps its files' old mtimes, which hardlinks share
+    day_ago = os.path.getmtime(tmp_path / 'export' / 'manifest.json') - 86400
+    for root, _, names in os.walk(tmp_path / 'export'):
+        for name in names:
+            os.utime(os.path.join(root, name), (day_ago, day_ago))
+    db, media = library('target')
+    monkeypatch.setattr(media_gc, 'get_config', lambda: config)
+    import_dreams = db.import_dreams
+    def scan_then_import(rows):
+        # The app's GC runs between the copy and the commit
+        list(media_gc.iter_orphan_batches(db, min_age=3600))
+        return import_dreams(rows)
+    monkeypatch.setattr(db, 'import_dreams', scan_then_import)
+    assert library_archive.import_library(db, str(tmp_path / 'export'))['dreams_imported'] == 2
+    assert read(media['VIDEOS_DIR'], '2024/03/v.mp4') == b'video' * 100
+    assert read(media['RECORDINGS_DIR'], '2024/05/b.wav') == b'second'
+    assert read(media['THUMBS_DIR'], '2024/03/t_160.webp') == b'small'
+
+def test_import_renames_media_colliding_with_other_files(library, tmp_path):
+    source_db, source_media = library('source')
+    digest = populate(source_db, source_media)
+    path = tmp_path / 'export.zip'
+    path.write_bytes(b''.join(library_archive.iter_export(source_db)))
+    db, media = library('target')
+    # This library has its own, unrelated media under the same names
+    write(media['VIDEOS_DIR'], '2024/03/v.mp4', b'other' * 100)
+    write(media['RECORDINGS_DIR'], '2024/05/b.wav', b'theirs')
+    write(media['STREAMS_DIR'], '2024/03/v/master.m3u8', b'#EXTM3U other')
+    # A file identical to the exported one is kept as it is
+    write(media['RECORDINGS_DIR'], '2024/03/a.wav', b'first')
+    assert library_archive.import_library(db, str(path))['dreams_imported'] == 2
+    original, reuse = sorted(db.get_all_dreams(), key=lambda dream: dream['created_at'])
+    assert original['video_filename'] == reuse['video_filename'] != '2024/03/v.mp4'
+    assert read(media['VIDEOS_DIR'], original['video_filename']) == b'video' * 100
+    assert original['video_digest'] == digest
+    assert original['audio_filename'] == '2024/03/a.wav'
+    assert reuse['audio_filename'] != '2024/05/b.wav'
+    assert read(media['RECORDINGS_DIR'], reuse['audio_filename']) == b'second'
+    manifest = original['stream_manifest']
+    assert manifest.endswith('/master.m3u8') and manifest == reuse['stream_manifest'] != '2024/03/v/master.m3u8'
+    assert read(media['STREAMS_DIR'], os.path.join(os.path.dirname(manifest), 'v0/seg_000.ts')) == b'segment'
+    assert read(media['VIDEOS_DIR'], '2024/03/v.mp4') == b'other' * 100
+    assert read(media['RECORDINGS_DIR'], '2024/05/b.wav') == b'theirs'
+    # Re-running picks the same names, so it finds the dreams already there
+    again = library_archive.import_library(db, str(path))
+    assert again['dreams_imported'] == 0 and again['dreams_skipped'] == 2
+    assert len(db.get_all_dreams()) == 2
+
+def test_import_rejects_bad_archives(library, tmp_path):
+    db, _ = library('target')
+    not_export = tmp_path / 'other.zip'
+    with zipfile.ZipFile(not_export, 'w') as archive:
+        archive.writestr('readme.txt', 'hello')
+    with pytest.raises(ValueError, match='not a dream library export'):
+        library_archive.import_library(db, str(not_export))
+    hostile = tmp_path / 'hostile.zip'
+    with zipfile.ZipFile(hostile, 'w') as archive:
+        archive.writestr('manifest.json', json.dumps({'format': 1}))
+        archive.writestr('dreams.ndjson', json.dumps({
+            'id': 1, 'user_prompt': 'u', 'generated_prompt': 'g', 'audio_filename': 'a.wav',
+            'video_filename': '../../../etc/cron.d/x',
+        }))
+    with pytest.raises(ValueError, match='Unsafe media name'):
+        library_archive.import_library(db, str(hostile))
+    assert db.get_all_dreams() == []
+
+def test_export_route_streams_a_zip(library, test_client, monkeypatch):
+    db, media = library('source')
+    populate(db, media)
+    monkeypatch.setattr('dream_recorder.dream_db', db)
+    resp = test_client.get('/api/export?media=0')
+    assert resp.status_code == 200 and resp.mimetype == 'application/zip'
+    assert resp.headers['Content-Disposition'].startswith('attachment; filename="dream-library-')
+    archive = zipfile.ZipFile(io.BytesIO(resp.data))
+    assert len(archive.read('dreams.ndjson').splitlines()) == 2
+
+def test_import_script(library, tmp_path, monkeypatch, capsys):
+    import scripts.import_library as script
+    source_db, source_media = library('source')
+    populate(source_db, source_media)
+    path = tmp_path / 'export.zip'
+    path.write_bytes(b''.join(library_archive.iter_export(source_db)))
+    db, _ = library('target')
+    monkeypatch.setattr(script, 'DreamDB', lambda: db)
+    assert script.main([str(tmp_path / 'missing.zip')]) == 1
+    assert script.main([str(path), '--workers', '1']) == 0
+    assert 'Imported 2 dreams (0 already present). Media files: 0 linked, 7 copied' in capsys.readouterr().out
@@ -0,0 +1,175 @@
+import os
+import time
+import pytest
+from unittest import mock
+from functions import media_gc
+from functions.dream_db import DreamDB, DreamData
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    dirs = {}
+    for key in ('VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR'):
+        dirs[key] = tmp_path / key.lower()
+        dirs[key].mkdir()
+    monkeypatch.setattr(media_gc, 'get_config', lambda: {k: str(v) for k, v in dirs.items()})
+    return dirs
+
+@pytest.fixture
+def dream_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    db = DreamDB(db_path=str(tmp_path / 'dreams.sqlite3'))
+    yield db
+    db.close()
+
+def write(path, size=10, age=0):
+    path.write_bytes(b'x' * size)
+    if age:
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+    return path
+
+def save(db, **fields):
+    data = dict(user_prompt='u', generated_prompt='g', audio_filename='a.wav', video_filename='v.mp4')
+    data.update(fields)
+    return db.save_dream(DreamData(**data).model_dump())
+
+def test_reaper_removes_deleted_dreams_files(media, dream_db):
+    files = [
+        write(media['VIDEOS_DIR'] / 'v.mp4', 100), write(media['THUMBS_DIR'] / 't.webp', 10),
+        write(media['THUMBS_DIR'] / 't_160.webp', 5), write(media['PREVIEWS_DIR'] / 'p.mp4', 20),
+        write(media['PREVIEWS_DIR'] / 's.webp', 20), write(media['RECORDINGS_DIR'] / 'a.wav', 50),
+    ]
+    (media['STREAMS_DIR'] / 'v').mkdir()
+    write(media['STREAMS_DIR'] / 'v' / 'master.m3u8', 7)
+    dream_id = save(
+        dream_db, thumb_filename='t.webp', thumb_sizes='160,540', preview_filename='p.mp4',
+        sprite_filename='s.webp', stream_manifest='v/master.m3u8'
+    )
+    dream_db.delete_dream(dream_id)
+    assert media_gc.reap_deleted_dreams(dream_db) == (1, 212)
+    assert not any(f.exists() for f in files)
+    assert not (media['STREAMS_DIR'] / 'v').exists()
+    assert dream_db.get_deleted_dreams() == []
+
+def test_reaper_keeps_shared_media_until_last_reference(media, dream_db):
+    video = write(media['VIDEOS_DIR'] / 'v.mp4')
+    first_audio = write(media['RECORDINGS_DIR'] / 'a.wav')
+    second_audio = write(media['RECORDINGS_DIR'] / 'b.wav')
+    first = save(dream_db)
+    second = save(dream_db, audio_filename='b.wav', source_dream_id=first)
+    dream_db.delete_dream(first)
+    media_gc.reap_deleted_dreams(dream_db)
+    # Only the deleted dream's own recording goes; the reused video stays
+    assert not first_audio.exists() and video.exists() and second_audio.exists()
+    dream_db.delete_dream(second)
+    media_gc.reap_deleted_dreams(dream_db)
+    assert not video.exists() and not second_audio.exists()
+
+def test_reaper_retries_when_removal_fails(media, dream_db, monkeypatch):
+    write(media['VIDEOS_DIR'] / 'v.mp4')
+    dream_id = save(dream_db)
+    dream_db.delete_dream(dream_id)
+    logger = mock.Mock()
+    def fail(path): raise OSError('read-only')
+    monkeypatch.setattr(media_gc.os, 'remove', fail)
+    assert media_gc.reap_deleted_dreams(dream_db, logger=logger) == (0, 0)
+    logger.error.assert_called()
+    assert [d['id'] for d in dream_db.get_deleted_dreams()] == [dream_id]
+
+def test_orphan_scan_removes_only_old_untracked_files(media, dream_db):
+    save(dream_db, thumb_filename='t.webp', thumb_sizes='160,540')
+    kept = [
+        write(media['VIDEOS_DIR'] / 'v.mp4', age=7200), write(media['RECORDINGS_DIR'] / 'a.wav', age=7200),
+        write(media['THUMBS_DIR'] / 't.webp', age=7200), write(media['THUMBS_DIR'] / 't_160.webp', age=7200),
+        # Too new: may belong to a pipeline that has not saved its dream yet
+        write(media['VIDEOS_DIR'] / 'in_progress.mp4'),
+        write(media['VIDEOS_DIR'] / '.gitkeep', age=7200),
+    ]
+    orphans = [
+        write(media['VIDEOS_DIR'] / 'dream_9.mp4', 30, age=7200),
+        write(media['THUMBS_DIR'] / 'thumb_old_160.webp', 4, age=7200),
+        write(media['RECORDINGS_DIR'] / 'failed.wav', 6, age=7200),
+    ]
+    report = media_gc.collect_garbage(dream_db, batch_size=2, min_age=3600, dry_run=True)
+    assert report == {'dreams_purged': 0, 'orphans_removed': 3, 'blobs_released': 0, 'bytes_reclaimed': 40}
+    assert all(f.exists() for f in orphans)
+    report = media_gc.collect_garbage(dream_db, batch_size=2, min_age=3600)
+    assert report['orphans_removed'] == 3 and report['bytes_reclaimed'] == 40
+    assert not any(f.exists() for f in orphans)
+    assert all(f.exists() for f in kept)
+
+def test_orphan_scan_walks_shard_directories(media, dream_db):
+    save(dream_db, video_filename='2025/06/v.mp4', thumb_filename='2025/06/t.webp', thumb_sizes='160,540')
+    shard = media['VIDEOS_DIR'] / '2025' / '06'
+    shard.mkdir(parents=True)
+    (media['THUMBS_DIR'] / '2025' / '06').mkdir(parents=True)
+    kept = [write(shard / 'v.mp4', age=7200), write(media['THUMBS_DIR'] / '2025' / '06' / 't_160.webp', age=7200)]
+    orphan = write(shard / 'generated_x.mp4', age=7200)
+    report = media_gc.collect_garbage(dream_db, min_age=3600)
+    assert report['orphans_removed'] == 1 and not orphan.exists()
+    assert all(f.exists() for f in kept)
+
+def test_orphan_scan_collects_stream_directories(media, dream_db):
+    save(dream_db, stream_manifest='2025/06/v/master.m3u8')
+    kept = media['STREAMS_DIR'] / '2025' / '06' / 'v'
+    failed = media['STREAMS_DIR'] / '2025' / '06' / 'failed'
+    legacy = media['STREAMS_DIR'] / 'old'
+    for stream in (kept, failed, legacy):
+        (stream / 'v0').mkdir(parents=True)
+        write(stream / 'master.m3u8', age=7200)
+        write(stream / 'v0' / 'seg_000.ts', 100, age=7200)
+    report = media_gc.collect_garbage(dream_db, min_age=3600)
+    # Each stream goes as a whole directory
+    assert report['orphans_removed'] == 2 and report['bytes_reclaimed'] == 220
+    assert (kept / 'v0' / 'seg_000.ts').exists()
+    assert not failed.exists() and not legacy.exists()
+
+def test_orphan_scan_continues_through_shards_across_passes(media, dream_db):
+    orphans = []
+    for shard in ('2024/11', '2024/12', '2025/01'):
+        (media['VIDEOS_DIR'] / shard).mkdir(parents=True)
+        orphans.append(write(media['VIDEOS_DIR'] / shard / 'x.mp4', age=7200))
+    orphans.insert(0, write(media['VIDEOS_DIR'] / 'flat.mp4', age=7200))
+    # Shards are scanned in order ('.' holds the flat files), two per pass, wrapping around
+    scans = []
+    for _ in range(3):
+        media_gc.collect_garbage(dream_db, min_age=3600, shards_per_pass=2)
+        scans.append([f.exists() for f in orphans])
+        write(orphans[0], age=7200)
+    assert scans == [[False, False, True, True], [True, False, False, False], [False, False, False, False]]
+    assert (media['VIDEOS_DIR'] / media_gc.ORPHAN_CURSOR_FILE).read_text() == '2024/11'
+
+def test_orphan_scan_removes_stale_staging_leftovers(media, dream_db):
+    stale = write(media['VIDEOS_DIR'] / '.generated_x.1a2b3c4d.tmp.mp4', age=7200)
+    # May still be written by a running pipeline
+    fresh = write(media['RECORDINGS_DIR'] / '.scratch_abc.webm')
+    report = media_gc.collect_garbage(dream_db, min_age=3600)
+    assert report['orphans_removed'] == 1
+    assert not stale.exists() and fresh.exists()
+
+def test_run_media_gc_scans_orphans_on_interval_only(media, monkeypatch):
+    calls = []
+    def fake_collect(db, **kwargs):
+        calls.append(kwargs['scan_orphans'])
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(media_gc, 'collect_garbage', fake_collect)
+    wakeup = mock.Mock()
+    with pytest.raises(KeyboardInterrupt):
+        media_gc.run_media_gc(mock.Mock(), wakeup)
+    # The first pass scans; passes woken by deletions within the interval only reap
+    assert calls == [True, False, False]
+    assert wakeup.clear.call_count == 2
+
+def test_dream_media_paths_default_newer_directories(monkeypatch):
+    # config.json files from before previews and streams existed have neither directory
+    monkeypatch.setattr(media_gc, 'get_config', lambda: {
+        'VIDEOS_DIR': 'media/video', 'THUMBS_DIR': 'media/thumbs', 'RECORDINGS_DIR': 'media/audio',
+    })
+    dream = {
+        'video_filename': 'v.mp4', 'audio_filename': 'a.wav', 'preview_filename': 'p.mp4',
+        'stream_manifest': 'v/master.m3u8',
+    }
+    paths = media_gc.dream_media_paths(dream)
+    assert os.path.join('media/previews', 'p.mp4') in paths
+    assert os.path.join('media/streams', 'v') in paths
@@ -0,0 +1,58 @@
+import os
+import time
+import pytest
+from functions import media_writer
+
+def test_staged_write_appears_atomically(tmp_path):
+    target = tmp_path / '2025' / '06' / 'video.mp4'
+    with media_writer.staged(str(target)) as (tmp_path_,):
+        # Staged next to the target, hidden, with the extension kept for FFmpeg
+        assert os.path.dirname(tmp_path_) == str(target.parent)
+        assert os.path.basename(tmp_path_).startswith('.video.') and tmp_path_.endswith('.tmp.mp4')
+        with open(tmp_path_, 'wb') as f:
+            f.write(b'complete')
+        assert not target.exists()
+    assert target.read_bytes() == b'complete'
+    assert os.listdir(target.parent) == ['video.mp4']
+
+def test_failed_write_keeps_previous_file(tmp_path):
+    target = tmp_path / 'video.mp4'
+    target.write_bytes(b'old')
+    with pytest.raises(RuntimeError):
+        with media_writer.staged(str(target), str(tmp_path / 'thumb.webp')) as (video_tmp, thumb_tmp):
+            with open(video_tmp, 'wb') as f:
+                f.write(b'torn')
+            raise RuntimeError('ffmpeg killed')
+    assert target.read_bytes() == b'old'
+    assert os.listdir(tmp_path) == ['video.mp4']
+
+def test_missing_output_fails_the_commit(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        with media_writer.staged(str(tmp_path / 'a.webp'), str(tmp_path / 'b.webp')) as (a, b):
+            open(a, 'wb').close()
+    assert os.listdir(tmp_path) == []
+
+def test_staged_dir_replaces_previous_version(tmp_path):
+    stream_dir = tmp_path / 'streams' / 'dream'
+    (stream_dir / 'v0').mkdir(parents=True)
+    (stream_dir / 'v0' / 'old.ts').write_bytes(b'old')
+    with media_writer.staged_dir(str(stream_dir)) as staging:
+        os.makedirs(os.path.join(staging, 'v0'))
+        with open(os.path.join(staging, 'master.m3u8'), 'w') as f:
+            f.write('#EXTM3U')
+        # Players keep seeing the old stream until the new one is complete
+        assert (stream_dir / 'v0' / 'old.ts').exists()
+    assert sorted(os.listdir(stream_dir)) == ['master.m3u8', 'v0']
+    assert os.listdir(stream_dir.parent) == ['dream']
+
+def test_scratch_file_location_and_cleanup(tmp_path, monkeypatch):
+    config = {'MEDIA_SCRATCH_DIR': str(tmp_path / 'shm')}
+    monkeypatch.setattr(media_writer, 'get_config', lambda: config)
+    with media_writer.scratch_file('.mp4', near=str(tmp_path / 'videos' / 'x.mp4')) as path:
+        assert os.path.dirname(path) == str(tmp_path / 'shm') and path.endswith('.mp4')
+        assert media_writer.LEFTOVER_RE.match(os.path.basename(path))
+    assert not os.path.exists(path)
+    config['MEDIA_SCRATCH_DIR'] = ''
+    with media_writer.scratch_file('.mp4', near=str(tmp_path / 'videos' / 'x.mp4')) as path:
+        # Without a scratch dir, intermediates stay on the destination filesystem
+        assert os.path.dirname(path) == str(tmp_path / 'videos')
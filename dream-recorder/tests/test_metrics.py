@@ -0,0 +1,96 @@
+import pytest
+from unittest import mock
+import functions.metrics as metrics
+from functions.metrics import Counter, Gauge, Histogram, external_call, render_metrics
+
+@pytest.fixture(autouse=True)
+def isolated_registry(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    monkeypatch.setattr(metrics, '_storage_refreshed', None)
+
+def test_text_exposition():
+    requests = Counter('requests_total', 'Requests "made".', labels=('provider',))
+    clients = Gauge('clients', 'Connected clients.')
+    latency = Histogram('latency_seconds', 'Latency.', (0.1, 1), labels=('stage',))
+    requests.inc(provider='luma')
+    requests.inc(2, provider='a"b\\c\n')
+    clients.inc()
+    clients.inc()
+    clients.dec()
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, stage='gpt')
+    assert render_metrics() == (
+        '# HELP requests_total Requests \\"made\\".\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{provider="a\\"b\\\\c\\n"} 2\n'
+        'requests_total{provider="luma"} 1\n'
+        '# HELP clients Connected clients.\n'
+        '# TYPE clients gauge\n'
+        'clients 1\n'
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{stage="gpt",le="0.1"} 2\n'
+        'latency_seconds_bucket{stage="gpt",le="1"} 3\n'
+        'latency_seconds_bucket{stage="gpt",le="+Inf"} 4\n'
+        'latency_seconds_sum{stage="gpt"} 3.65\n'
+        'latency_seconds_count{stage="gpt"} 4\n'
+    )
+    with pytest.raises(ValueError):
+        requests.inc()
+
+def test_unlabelled_metrics_start_at_zero():
+    Counter('bytes_total', 'Bytes.')
+    Histogram('lag_seconds', 'Lag.', (1,))
+    text = render_metrics()
+    assert 'bytes_total 0\n' in text
+    assert 'lag_seconds_bucket{le="+Inf"} 0\n' in text and 'lag_seconds_count 0\n' in text
+
+def test_external_call_counts_errors(monkeypatch):
+    requests, errors = Counter('r', 'r', ('provider', 'operation')), Counter('e', 'e', ('provider', 'operation'))
+    monkeypatch.setattr(metrics, 'EXTERNAL_REQUESTS', requests)
+    monkeypatch.setattr(metrics, 'EXTERNAL_ERRORS', errors)
+    with external_call('luma', 'poll') as call:
+        call['status'] = 200
+    with external_call('luma', 'poll') as call:
+        call['status'] = 503
+    with pytest.raises(RuntimeError):
+        with external_call('luma', 'poll'):
+            raise RuntimeError('timeout')
+    assert requests._values == {('luma', 'poll'): 3}
+    assert errors._values == {('luma', 'poll'): 2}
+
+def test_storage_gauges_are_cached(monkeypatch):
+    media = Gauge('media', 'm', ('dir',))
+    monkeypatch.setattr(metrics, 'MEDIA_BYTES', media)
+    usage = mock.Mock(return_value={'dirs': {'VIDEOS_DIR': 10}, 'quota_bytes': 0, 'free_bytes': 5})
+    metrics.update_storage_gauges(usage)
+    metrics.update_storage_gauges(usage)
+    usage.assert_called_once_with()
+    assert media._values == {('videos',): 10}
+    metrics.update_storage_gauges(usage, max_age=0)
+    assert usage.call_count == 2
+
+def test_measure_loop_lag(monkeypatch):
+    lag = Histogram('lag', 'l', (0.5,))
+    monkeypatch.setattr(metrics, 'LOOP_LAG_SECONDS', lag)
+    assert 0 <= metrics.measure_loop_lag(0.01) < 0.5
+    assert lag._values[()][2] == 1
+
+def test_db_calls_and_pipeline_stages_are_timed(monkeypatch):
+    from functions.db_threadpool import ThreadedDreamDB
+    from functions.tracing import Trace, span
+    db_calls = Histogram('db', 'd', (1,), ('method',))
+    stages = Histogram('stages', 's', (1,), ('stage',))
+    monkeypatch.setattr('functions.db_threadpool.DB_CALL_SECONDS', db_calls)
+    monkeypatch.setattr('functions.tracing.PIPELINE_STAGE_SECONDS', stages)
+    db = ThreadedDreamDB(mock.Mock(), threads=1)
+    db.get_dream(1)
+    db.close()
+    assert db_calls._values[('get_dream',)][2] == 1
+    trace = Trace().start()
+    try:
+        with span('whisper'):
+            pass
+    finally:
+        trace.stop()
+    assert stages._values[('whisper',)][2] == 1
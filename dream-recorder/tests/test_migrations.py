@@ -0,0 +1,112 @@
+import sqlite3
+import logging
+import pytest
+import functions.migrations as migrations
+from functions.migrations import migrate, current_version, pending_backfills, run_backfill_batch, BACKFILL_DONE
+from functions.dream_db import DreamDB
+
+def insert(conn, user_prompt, generated_prompt='g'):
+    cursor = conn.execute(
+        "INSERT INTO dreams (user_prompt, generated_prompt, audio_filename, video_filename) VALUES (?, ?, 'a', 'v')",
+        (user_prompt, generated_prompt)
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+def search(conn, text):
+    return [row[0] for row in conn.execute("SELECT rowid FROM dreams_fts WHERE dreams_fts MATCH ? ORDER BY rowid", (text,))]
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'dreams.sqlite3'))
+    yield conn
+    conn.close()
+
+def test_migrate_fresh_database_records_versions(conn, caplog):
+    with caplog.at_level('INFO'):
+        applied = migrate(conn, logging.getLogger('test'))
+    assert [version for version, _, _ in applied] == [version for version, _, _ in migrations.MIGRATIONS]
+    assert current_version(conn) == migrations.MIGRATIONS[-1][0]
+    assert all(ms >= 0 for _, _, ms in applied)
+    assert 'Schema now at version' in caplog.text
+    # An empty library has nothing to backfill, and a second run is a no-op
+    assert pending_backfills(conn) == []
+    assert migrate(conn) == []
+
+def test_migrate_skips_steps_another_process_applied(conn, tmp_path, monkeypatch):
+    other = sqlite3.connect(str(tmp_path / 'dreams.sqlite3'))
+    try:
+        reads = []
+        real_current_version = migrations.current_version
+        def stale_first_read(c):
+            reads.append(c)
+            # The other process migrates between this one's first read and its write lock
+            if len(reads) == 1:
+                migrate(other)
+                return 0
+            return real_current_version(c)
+        monkeypatch.setattr(migrations, 'current_version', stale_first_read)
+        assert migrate(conn) == []
+    finally:
+        other.close()
+    assert real_current_version(conn) == migrations.MIGRATIONS[-1][0]
+
+def test_failed_migration_rolls_back(conn, monkeypatch):
+    migrate(conn)
+    def broken(cursor):
+        cursor.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError('boom')
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + ((99, 'broken', broken),))
+    with pytest.raises(RuntimeError):
+        migrate(conn)
+    assert current_version(conn) == migrations.MIGRATIONS[-2][0]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+
+def test_full_text_backfill_runs_in_batches_alongside_writes(conn):
+    # A library created before versioning
+    migrations._create_dreams_table(conn.cursor())
+    old = [insert(conn, f'dream number {i} about lighthouses') for i in range(5)]
+    migrate(conn)
+    assert pending_backfills(conn) == ['dreams_fts']
+    assert run_backfill_batch(conn, 'dreams_fts', batch_size=2)
+    # Writes during the backfill: on an indexed row, on a pending row, and a new row
+    conn.execute("UPDATE dreams SET user_prompt = 'a harbour' WHERE id = ?", (old[0],))
+    conn.execute("UPDATE dreams SET user_prompt = 'a harbour too' WHERE id = ?", (old[3],))
+    conn.execute("DELETE FROM dreams WHERE id = ?", (old[4],))
+    conn.commit()
+    new = insert(conn, 'a brand new lighthouse')
+    while run_backfill_batch(conn, 'dreams_fts', batch_size=2):
+        pass
+    assert pending_backfills(conn) == []
+    assert conn.execute("SELECT cursor FROM schema_backfills WHERE name = 'dreams_fts'").fetchone()[0] == BACKFILL_DONE
+    assert search(conn, 'lighthouse') == [old[1], old[2], new]
+    assert search(conn, 'harbour') == [old[0], old[3]]
+    # The index is consistent with its content table
+    conn.execute("INSERT INTO dreams_fts (dreams_fts, rank) VALUES ('integrity-check', 1)")
+    # Triggers cover every row once the backfill is done
+    conn.execute("UPDATE dreams SET user_prompt = 'a lighthouse again' WHERE id = ?", (old[0],))
+    conn.commit()
+    assert search(conn, 'lighthouse') == [old[0], old[1], old[2], new]
+
+def test_dream_db_runs_backfills(tmp_path):
+    path = str(tmp_path / 'dreams.sqlite3')
+    with sqlite3.connect(path) as conn:
+        migrations._create_dreams_table(conn.cursor())
+        insert(conn, 'an old dream')
+    with DreamDB(db_path=path) as db:
+        db.run_backfills(batch_size=1, pause=0)
+        assert [d['prompt_excerpt'] for d in db.search_dreams('old')] == ['an old dream']
+
+def test_stats_migration_summarizes_existing_dreams(conn, monkeypatch):
+    monkeypatch.setattr(migrations, 'MIGRATIONS', tuple(step for step in migrations.MIGRATIONS if step[0] < 9))
+    migrate(conn)
+    insert(conn, 'hello')
+    insert(conn, 'hi')
+    conn.execute("UPDATE dreams SET deleted_at = CURRENT_TIMESTAMP WHERE user_prompt = 'hi'")
+    conn.execute("UPDATE dreams SET created_at = '2024-03-05 10:00:00'")
+    conn.commit()
+    monkeypatch.undo()
+    migrate(conn)
+    assert conn.execute("SELECT day, dreams, prompt_chars FROM dream_stats_daily").fetchall() == [('2024-03-05', 1, 5)]
+    insert(conn, 'hey')
+    assert conn.execute("SELECT SUM(dreams) FROM dream_stats_daily").fetchone()[0] == 2
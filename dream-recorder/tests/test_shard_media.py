@@ -0,0 +1,107 @@
+import os
+import pytest
+import builtins
+from unittest import mock
+
+import scripts.shard_media as mod
+from functions.dream_db import DreamDB, DreamData
+from functions.media_layout import new_media_filename, derived_filename, sharded_filename, is_sharded
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    config = {}
+    for key in ('VIDEOS_DIR', 'THUMBS_DIR', 'RECORDINGS_DIR', 'PREVIEWS_DIR', 'STREAMS_DIR'):
+        (tmp_path / key.lower()).mkdir()
+        config[key] = str(tmp_path / key.lower())
+    monkeypatch.setattr(mod, 'get_config', lambda: config)
+    monkeypatch.setattr(builtins, 'print', lambda *a, **kw: None)
+    return config
+
+@pytest.fixture
+def dream_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    db = DreamDB(db_path=str(tmp_path / 'dreams.sqlite3'))
+    monkeypatch.setattr(mod, 'DreamDB', lambda: db)
+    yield db
+    db.close()
+
+def touch(directory, name):
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(name)
+    return path
+
+def test_media_names():
+    first, second = new_media_filename('generated', '.mp4'), new_media_filename('generated', '.mp4')
+    assert first != second and is_sharded('video_filename', first)
+    assert derived_filename('2025/06/generated_x.mp4', 'thumb', '.webp') == '2025/06/thumb_generated_x.webp'
+    assert derived_filename('dream_1.mp4', 'preview', '.mp4') == 'preview_dream_1.mp4'
+    assert sharded_filename('video_filename', 'dream_1.mp4', '2024-03-05 10:00:00') == '2024/03/dream_1.mp4'
+    assert sharded_filename('stream_manifest', 'x/master.m3u8', '2024-03-05') == '2024/03/x/master.m3u8'
+    assert sharded_filename('video_filename', '2024/03/dream_1.mp4', '2025-01-01') == '2024/03/dream_1.mp4'
+
+def test_shards_files_and_rewrites_names(media, dream_db):
+    original = dream_db.save_dream(DreamData(
+        user_prompt='u', generated_prompt='g', audio_filename='a.wav', video_filename='v.mp4',
+        thumb_filename='t.webp', thumb_sizes='160,540', preview_filename='p.mp4', sprite_filename='s.webp',
+        stream_manifest='v/master.m3u8',
+    ).model_dump())
+    # Shares the video, so it must follow it to the same shard
+    reuse = dream_db.save_dream(DreamData(
+        user_prompt='u', generated_prompt='g', audio_filename='b.wav', video_filename='v.mp4', source_dream_id=original,
+    ).model_dump())
+    dream_db.update_dream(original, {'created_at': '2024-03-05 10:00:00'})
+    dream_db.update_dream(reuse, {'created_at': '2025-01-02 10:00:00'})
+    touch(media['VIDEOS_DIR'], 'v.mp4')
+    touch(media['RECORDINGS_DIR'], 'a.wav')
+    touch(media['RECORDINGS_DIR'], 'b.wav')
+    touch(media['THUMBS_DIR'], 't.webp')
+    touch(media['THUMBS_DIR'], 't_160.webp')
+    touch(media['PREVIEWS_DIR'], 'p.mp4')
+    touch(media['STREAMS_DIR'], 'v/v0/seg_000.ts')
+    assert mod.main(['--batch-size', '1']) == 0
+    first, second = dream_db.get_dream(original), dream_db.get_dream(reuse)
+    assert first['video_filename'] == second['video_filename'] == '2024/03/v.mp4'
+    assert first['audio_filename'] == '2024/03/a.wav' and second['audio_filename'] == '2025/01/b.wav'
+    assert first['stream_manifest'] == '2024/03/v/master.m3u8'
+    for key, name in (
+        ('VIDEOS_DIR', '2024/03/v.mp4'), ('THUMBS_DIR', '2024/03/t.webp'), ('THUMBS_DIR', '2024/03/t_160.webp'),
+        ('PREVIEWS_DIR', '2024/03/p.mp4'), ('STREAMS_DIR', '2024/03/v/v0/seg_000.ts'), ('RECORDINGS_DIR', '2025/01/b.wav'),
+    ):
+        assert os.path.exists(os.path.join(media[key], name)), name
+    assert not os.path.exists(os.path.join(media['VIDEOS_DIR'], 'v.mp4'))
+    # The missing sprite sheet is renamed anyway, so the run terminates
+    assert first['sprite_filename'] == '2024/03/s.webp'
+    assert dream_db.get_unsharded_dreams() == []
+
+def test_failed_transaction_moves_files_back(media, dream_db, monkeypatch):
+    dream_db.save_dream(DreamData(user_prompt='u', generated_prompt='g', audio_filename='a.wav', video_filename='v.mp4').model_dump())
+    video = touch(media['VIDEOS_DIR'], 'v.mp4')
+    monkeypatch.setattr(dream_db, 'rename_media', mock.Mock(side_effect=RuntimeError('database is locked')))
+    assert mod.main([]) == 1
+    assert os.path.exists(video)
+    assert dream_db.get_dream(1)['video_filename'] == 'v.mp4'
+
+def test_moved_files_survive_an_orphan_scan_before_commit(media, dream_db, monkeypatch):
+    from functions import media_gc
+    monkeypatch.setattr(media_gc, 'get_config', lambda: media)
+    dream_db.save_dream(DreamData(user_prompt='u', generated_prompt='g', audio_filename='a.wav', video_filename='v.mp4').model_dump())
+    dream_db.update_dream(1, {'created_at': '2024-03-05 10:00:00'})
+    day_ago = os.path.getmtime(touch(media['VIDEOS_DIR'], 'v.mp4')) - 86400
+    os.utime(os.path.join(media['VIDEOS_DIR'], 'v.mp4'), (day_ago, day_ago))
+    rename_media = dream_db.rename_media
+    def scan_then_rename(renames):
+        # The app's GC runs between the move and the commit
+        list(media_gc.iter_orphan_batches(dream_db, min_age=3600))
+        rename_media(renames)
+    monkeypatch.setattr(dream_db, 'rename_media', scan_then_rename)
+    assert mod.main([]) == 0
+    assert os.path.exists(os.path.join(media['VIDEOS_DIR'], '2024/03/v.mp4'))
+
+def test_dry_run_moves_nothing(media, dream_db):
+    dream_db.save_dream(DreamData(user_prompt='u', generated_prompt='g', audio_filename='a.wav', video_filename='v.mp4').model_dump())
+    video = touch(media['VIDEOS_DIR'], 'v.mp4')
+    assert mod.main(['--dry-run']) == 0
+    assert os.path.exists(video)
+    assert dream_db.get_dream(1)['video_filename'] == 'v.mp4'
@@ -26,13 +26,13 @@ def test_playback_flow(mocker):
     # Patch dream_db before creating the client
     from dream_recorder import socketio, app, video_playback_state
     # Reset playback state
-    video_playback_state['current_index'] = 0
+    video_playback_state['current_dream_id'] = None
     video_playback_state['is_playing'] = False
     mock_db = mocker.MagicMock()
-    mock_db.get_all_dreams.return_value = [
-        {'video_filename': 'dream1.mp4'},
-        {'video_filename': 'dream2.mp4'}
-    ]
+    dreams = {1: {'video_filename': 'dream1.mp4'}, 2: {'video_filename': 'dream2.mp4'}}
+    mock_db.get_latest_dream_id.return_value = 1
+    mock_db.get_adjacent_dream_id.side_effect = lambda dream_id: 2 if dream_id == 1 else 1
+    mock_db.get_dream.side_effect = dreams.get
     mocker.patch('dream_recorder.dream_db', mock_db)
     client = socketio.test_client(app)
     # Play latest dream
@@ -45,10 +45,13 @@ def test_playback_flow(mocker):
     time.sleep(0.1)
     received = client.get_received()
     assert any(x['name'] == 'play_video' and 'dream2.mp4' in x['args'][0]['video_url'] for x in received)
+    # Each play is recorded for least-recently-played storage eviction
+    assert [c.args for c in mock_db.mark_played.call_args_list] == [(1,), (2,)]
     client.disconnect()
 
 def test_no_dreams_playback(socketio_client, mock_dream_db):
-    mock_dream_db.get_all_dreams.return_value = []
+    mock_dream_db.get_latest_dream_id.return_value = None
+    mock_dream_db.get_adjacent_dream_id.return_value = None
     socketio_client.emit('show_previous_dream')
     time.sleep(0.1)
     received = socketio_client.get_received()
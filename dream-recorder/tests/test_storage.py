@@ -0,0 +1,136 @@
+import os
+import threading
+import pytest
+from unittest import mock
+from functions import storage
+from functions.dream_db import DreamDB, DreamData
+
+MB = storage.MB
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    config = {'STORAGE_QUOTA_MB': 1, 'STORAGE_RESERVE_MB': 0.5}
+    for key in storage.STORAGE_DIRS:
+        path = tmp_path / key.lower()
+        path.mkdir()
+        config[key] = str(path)
+    monkeypatch.setattr(storage, 'get_config', lambda: config)
+    monkeypatch.setattr('functions.media_gc.get_config', lambda: config)
+    return config
+
+@pytest.fixture
+def dream_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(DreamDB, '_init_sample_dreams', lambda self: None)
+    db = DreamDB(db_path=str(tmp_path / 'dreams.sqlite3'))
+    yield db
+    db.close()
+
+def save(db, name, **fields):
+    data = dict(user_prompt=name, generated_prompt='g', audio_filename=f'{name}.wav', video_filename=f'{name}.mp4')
+    data.update(fields)
+    return db.save_dream(DreamData(**data).model_dump())
+
+def test_storage_usage_counts_media_dirs(media):
+    with open(f"{media['VIDEOS_DIR']}/v.mp4", 'wb') as f:
+        f.write(b'x' * 300)
+    with open(f"{media['RECORDINGS_DIR']}/a.wav", 'wb') as f:
+        f.write(b'x' * 200)
+    usage = storage.storage_usage()
+    assert usage['dirs']['VIDEOS_DIR'] == 300 and usage['dirs']['RECORDINGS_DIR'] == 200
+    assert usage['used_bytes'] == 500
+    assert usage['quota_bytes'] == MB
+    assert usage['free_bytes'] > 0
+
+def test_storage_usage_walks_media_off_the_hub(media, monkeypatch):
+    walkers = []
+    def path_size(path, seen=None):
+        walkers.append(threading.get_ident())
+        return 0
+    monkeypatch.setattr(storage, 'path_size', path_size)
+    assert storage.storage_usage()['used_bytes'] == 0
+    assert walkers and threading.get_ident() not in walkers
+
+def test_coldest_dreams_follow_policy(dream_db):
+    first, second, third = (save(dream_db, name) for name in ('one', 'two', 'three'))
+    for dream_id, created in ((first, '2024-01-01'), (second, '2024-02-01'), (third, '2024-03-01')):
+        dream_db.update_dream(dream_id, {'created_at': created})
+    dream_db.mark_played(first)
+    assert [d['id'] for d in dream_db.get_coldest_dreams('lru')] == [second, third, first]
+    assert [d['id'] for d in dream_db.get_coldest_dreams('age')] == [first, second, third]
+    dream_db.update_video_dreams('two.mp4', {'archived_at': '2024-04-01 00:00:00', 'bitrate': 400000})
+    assert [d['id'] for d in dream_db.get_coldest_dreams('lru', archived=False)] == [third, first]
+    assert [d['id'] for d in dream_db.get_coldest_dreams('lru', archived=True)] == [second]
+    with pytest.raises(ValueError):
+        dream_db.get_coldest_dreams('random')
+    with pytest.raises(ValueError):
+        dream_db.update_video_dreams('two.mp4', {'id; DROP TABLE dreams': 1})
+
+def test_ensure_capacity_noop_when_space_is_available(media, monkeypatch):
+    archive = mock.Mock()
+    monkeypatch.setattr(storage, 'archive_dream', archive)
+    report = storage.ensure_capacity(mock.Mock())
+    assert report['ok'] and report['needed_bytes'] == 0
+    archive.assert_not_called()
+
+def test_ensure_capacity_archives_coldest_until_enough(media, dream_db, monkeypatch):
+    ids = [save(dream_db, f'dream{i}') for i in range(3)]
+    for day, dream_id in enumerate(ids, 1):
+        dream_db.update_dream(dream_id, {'created_at': f'2024-01-0{day} 00:00:00'})
+    dream_db.mark_played(ids[0])
+    usage = {'dirs': {}, 'used_bytes': int(0.8 * MB), 'quota_bytes': MB, 'free_bytes': 10 * MB}
+    monkeypatch.setattr(storage, 'storage_usage', lambda: dict(usage))
+    archived = []
+    def fake_archive(db, dream, logger=None):
+        archived.append(dream['id'])
+        if dream['id'] == ids[1]:
+            raise RuntimeError('ffmpeg missing')
+        db.update_video_dreams(dream['video_filename'], {'archived_at': '2024-01-01 00:00:00'})
+        usage['used_bytes'] -= int(0.2 * MB)
+        return int(0.2 * MB)
+    monkeypatch.setattr(storage, 'archive_dream', fake_archive)
+    report = storage.ensure_capacity(dream_db)
+    # 0.3 MB needed: the never-played dreams go first, a failure moves on to the next
+    assert archived == [ids[1], ids[2], ids[0]]
+    assert report['archived'] == 2 and report['evicted'] == 0
+    assert report['ok']
+
+def test_ensure_capacity_evicts_only_when_allowed(media, dream_db, monkeypatch):
+    ids = [save(dream_db, f'dream{i}') for i in range(storage.EVICT_KEEP_MINIMUM + 2)]
+    usage = {'dirs': {}, 'used_bytes': 2 * MB, 'quota_bytes': MB, 'free_bytes': 10 * MB}
+    monkeypatch.setattr(storage, 'storage_usage', lambda: dict(usage))
+    monkeypatch.setattr(storage, 'archive_dream', mock.Mock(side_effect=RuntimeError('no gain')))
+    assert not storage.ensure_capacity(dream_db)['ok']
+    assert len(dream_db.list_dreams()) == len(ids)
+    media['STORAGE_EVICT_DELETE'] = True
+    report = storage.ensure_capacity(dream_db)
+    # Eviction stops at the minimum library size even though space is still short
+    assert report['evicted'] == 2 and not report['ok']
+    assert sorted(d['id'] for d in dream_db.list_dreams()) == ids[2:]
+
+def test_archive_dream_replaces_media_with_smaller_renditions(media, dream_db, monkeypatch):
+    videos, recordings, streams = media['VIDEOS_DIR'], media['RECORDINGS_DIR'], media['STREAMS_DIR']
+    with open(f'{videos}/v.mp4', 'wb') as f:
+        f.write(b'v' * 1000)
+    with open(f'{recordings}/a.wav', 'wb') as f:
+        f.write(b'a' * 500)
+    os.makedirs(f'{streams}/v/v0')
+    with open(f'{streams}/v/v0/seg_000.ts', 'wb') as f:
+        f.write(b's' * 300)
+    first = save(dream_db, 'first', video_filename='v.mp4', audio_filename='a.wav', stream_manifest='v/master.m3u8')
+    shared = save(dream_db, 'shared', video_filename='v.mp4', stream_manifest='v/master.m3u8')
+    encodes = []
+    def fake_transcode(source, target, logger=None, **options):
+        encodes.append(options)
+        with open(target, 'wb') as f:
+            f.write(b'x' * (100 if target.endswith('.mp4') else 50))
+    monkeypatch.setattr(storage, '_transcode', fake_transcode)
+    monkeypatch.setattr(storage, 'media_metadata', lambda path, logger=None: {'file_size': 100, 'bitrate': 400000})
+    reclaimed = storage.archive_dream(dream_db, dream_db.get_dream(first))
+    assert reclaimed == (1000 - 100) + 300 + (500 - 50)
+    assert encodes[0]['b:v'] == '400k' and encodes[1]['acodec'] == 'libopus'
+    assert not os.path.exists(f'{streams}/v') and not os.path.exists(f'{recordings}/a.wav')
+    dream = dream_db.get_dream(first)
+    assert dream['audio_filename'] == 'a.ogg' and dream['archived_at']
+    assert dream['stream_manifest'] is None and dream['file_size'] == 100
+    # The dream sharing the video sees the new rendition too
+    assert dream_db.get_dream(shared)['file_size'] == 100
@@ -0,0 +1,86 @@
+import logging
+import numpy as np
+import functions.vector_index as vector_index
+from functions.vector_index import HashingEmbedder, VectorIndex, get_embedder, dream_text
+
+def dream(dream_id, user_prompt, generated_prompt=''):
+    return {'id': dream_id, 'user_prompt': user_prompt, 'generated_prompt': generated_prompt}
+
+def test_hashing_embedder_is_normalized_and_deterministic():
+    embedder = HashingEmbedder(dim=64)
+    vectors = embedder.embed(['a whale in the ocean', 'A WHALE in the ocean!', ''])
+    assert vectors.shape == (3, 64)
+    assert vectors.dtype == np.float32
+    assert np.allclose(np.linalg.norm(vectors[:2], axis=1), 1.0)
+    assert np.allclose(vectors[0], vectors[1])
+    assert not vectors[2].any()
+
+def test_get_embedder_falls_back_to_hashing(caplog):
+    assert isinstance(get_embedder('hashing'), HashingEmbedder)
+    with caplog.at_level('WARNING'):
+        embedder = get_embedder('sentence-transformers:missing-model', logging.getLogger('test'))
+    assert isinstance(embedder, HashingEmbedder)
+
+def test_dream_text_combines_prompts():
+    assert dream_text({'user_prompt': 'u', 'generated_prompt': None}) == 'u\n'
+
+def test_index_query_add_remove_and_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, 'INDEX_GROWTH', 2)
+    base = str(tmp_path / 'dreams')
+    index = VectorIndex(base, HashingEmbedder(dim=64))
+    index.rebuild([dream(1, 'flying over a purple ocean with whales'), dream(2, 'lost in a school hallway')])
+    # Growing past the preallocated capacity keeps existing rows
+    index.add(dream(3, 'swimming with whales in the ocean'))
+    assert len(index.ids) == 4
+    assert [hit for hit, _ in index.similar(1, k=2)] == [3, 2]
+    index.remove(3)
+    assert [hit for hit, _ in index.similar(1, k=5)] == [2]
+    assert index.similar(3) == []
+    # Re-adding replaces the vector in place
+    index.add(dream(2, 'whales in a purple ocean'))
+    assert index.size == 2
+    reloaded = VectorIndex(base, HashingEmbedder(dim=64))
+    assert reloaded.load()
+    assert reloaded.slots == {1: 0, 2: 1}
+    hits = reloaded.similar(1, k=1)
+    assert hits[0][0] == 2 and 0 < hits[0][1] <= 1
+    # An index built by another embedder is not reused
+    assert not VectorIndex(base, HashingEmbedder(dim=32)).load()
+
+def test_empty_index_query(tmp_path):
+    index = VectorIndex(str(tmp_path / 'dreams'), HashingEmbedder(dim=16))
+    index.rebuild([])
+    assert index.query(np.ones(16, dtype=np.float32)) == []
+
+def test_indexes_opened_by_several_processes_stay_consistent(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, 'INDEX_GROWTH', 2)
+    base = str(tmp_path / 'dreams')
+    app = VectorIndex(base, HashingEmbedder(dim=64))
+    app.rebuild([dream(1, 'flying over a purple ocean')])
+    # A CLI process maps the same files while the app keeps them open
+    cli = VectorIndex(base, HashingEmbedder(dim=64))
+    assert cli.load()
+    app.add(dream(2, 'lost in a school hallway'))
+    cli.add(dream(3, 'whales in the ocean'))
+    # Growing past capacity replaces the files under the other process
+    app.add(dream(4, 'a city made of glass'))
+    assert sorted(int(i) for i in np.load(f"{base}.ids.npy") if i) == [1, 2, 3, 4]
+    assert sorted(hit for hit, _ in cli.similar(1, k=5)) == [2, 3, 4]
+    assert app.watermark() == cli.watermark() == (4, 4)
+    app.close()
+    cli.close()
+
+def test_freed_slots_are_reused_and_watermark_checked(tmp_path):
+    base = str(tmp_path / 'dreams')
+    index = VectorIndex(base, HashingEmbedder(dim=16))
+    index.rebuild([dream(1, 'a'), dream(2, 'b'), dream(3, 'c')])
+    index.remove(2)
+    index.add(dream(4, 'd'))
+    assert index.slots == {1: 0, 4: 1, 3: 2} and index.size == 3
+    reloaded = VectorIndex(base, HashingEmbedder(dim=16))
+    assert reloaded.load(watermark=(3, 4))
+    # A database that moved on without the index (e.g. restored) is detected
+    assert not VectorIndex(base, HashingEmbedder(dim=16)).load(watermark=(3, 5))
+    rebuilt = VectorIndex(base, HashingEmbedder(dim=16))
+    rebuilt.open((2, 7), lambda: [dream(5, 'e'), dream(7, 'f')])
+    assert rebuilt.slots == {5: 0, 7: 1}
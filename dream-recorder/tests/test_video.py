@@ -1,4 +1,6 @@
+import re
 import pytest
+from contextlib import contextmanager
 from unittest import mock
 from functions import video
 
@@ -27,14 +29,38 @@ def mock_config(monkeypatch):
 def mock_logger():
     return mock.Mock()
 
+@pytest.fixture(autouse=True)
+def direct_writes(monkeypatch):
+    """FFmpeg is faked here, so outputs go straight to their final paths (staging is tested in test_media_writer)."""
+    @contextmanager
+    def passthrough(*paths):
+        yield paths
+    @contextmanager
+    def passthrough_dir(path):
+        yield path
+    monkeypatch.setattr(video, 'staged', passthrough)
+    monkeypatch.setattr(video, 'staged_dir', passthrough_dir)
+
+def failing_commit(monkeypatch):
+    """Make committing staged outputs fail, as a full disk or a crashed rename would."""
+    @contextmanager
+    def staged(*paths):
+        yield paths
+        raise OSError('rename fail')
+    monkeypatch.setattr(video, 'staged', staged)
+
 def test_process_video_success(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(video.ffmpeg, 'input', lambda x: x)
     monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
     monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p: (s, p))
-    monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
-    monkeypatch.setattr(video.shutil, 'move', lambda src, dst: None)
+    runs = []
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda stream, **k: runs.append(stream))
     result = video.process_video('input.mp4', logger=mock_logger)
     assert result == 'input.mp4'
+    assert runs == [('input.mp4', 'input.mp4')]
+    # Filtering a scratch download writes the stored video
+    assert video.process_video('/scratch/raw.mp4', output_path='/videos/x.mp4') == '/videos/x.mp4'
+    assert runs[-1] == ('/scratch/raw.mp4', '/videos/x.mp4')
     mock_logger.info.assert_called()
 
 def test_process_video_error(monkeypatch, mock_config, mock_logger):
@@ -71,8 +97,7 @@ def test_process_video_exception(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
     monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p: (s, p))
     monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
-    def raise_exc(*a, **k): raise Exception('move fail')
-    monkeypatch.setattr(video.shutil, 'move', raise_exc)
+    failing_commit(monkeypatch)
     with pytest.raises(Exception):
         video.process_video('input.mp4', logger=mock_logger)
     mock_logger.error.assert_called()
@@ -83,11 +108,80 @@ def test_process_thumbnail_success(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
     monkeypatch.setattr(video.ffmpeg, 'input', lambda *a, **k: 'stream')
     monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
-    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, vframes: (s, p, vframes))
-    monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: (s, p))
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *outputs: list(outputs))
+    runs = []
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda outputs, **k: runs.append(outputs))
     result = video.process_thumbnail('video.mp4', logger=mock_logger)
-    assert result.startswith('thumb_') and result.endswith('.png')
+    assert re.fullmatch(r'\d{4}/\d{2}/thumb_\d{8}_\d{6}_[0-9a-f]{8}\.webp', result)
     mock_logger.info.assert_called()
+    # Every configured size is capped at the 80px crop, leaving a single output
+    assert len(runs) == 1
+    assert [p for _, p in runs[0]] == [f"/tmp/{result}"]
+
+def test_process_thumbnail_writes_each_size(monkeypatch, mock_config, mock_logger):
+    monkeypatch.setattr(video, 'get_config', lambda: {'THUMBS_DIR': '/thumbs', 'THUMBNAIL_SIZES': '160, 320,540', 'THUMBNAIL_QUALITY': 70})
+    fake_probe = {'streams': [{'codec_type': 'video', 'width': 1280, 'height': 540}]}
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda x: fake_probe)
+    monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
+    monkeypatch.setattr(video.ffmpeg, 'input', lambda *a, **k: 'stream')
+    monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    outputs = []
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: outputs.append((p, k)) or p)
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *o: o)
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
+    result = video.process_thumbnail('video.mp4', logger=mock_logger, thumb_filename='thumb_x.webp')
+    assert result == 'thumb_x.webp'
+    assert [p for p, _ in outputs] == ['/thumbs/thumb_x_160.webp', '/thumbs/thumb_x_320.webp', '/thumbs/thumb_x.webp']
+    assert all(k == {'vframes': 1, 'quality': 70} for _, k in outputs)
+
+def test_thumbnail_variant_filename():
+    assert video.thumbnail_variant_filename('thumb_1.webp', 160) == 'thumb_1_160.webp'
+
+def test_thumbnail_details_missing_file(monkeypatch, mock_config):
+    assert video.thumbnail_details('missing.webp') == {'thumb_sizes': None, 'thumb_placeholder': None}
+    assert video.thumbnail_details(None) == {'thumb_sizes': None, 'thumb_placeholder': None}
+
+def test_thumbnail_details(monkeypatch, tmp_path, mock_logger):
+    import numpy as np
+    monkeypatch.setattr(video, 'get_config', lambda: {'THUMBS_DIR': str(tmp_path), 'THUMBNAIL_SIZES': '160,320,540'})
+    for name in ('thumb_x.webp', 'thumb_x_160.webp'):
+        (tmp_path / name).write_bytes(b'img')
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda p: {'streams': [{'codec_type': 'video', 'width': 540, 'height': 540}]})
+    decoded = []
+    class FakeStream:
+        def __init__(self, path): decoded.append(path)
+        def filter(self, *a): return self
+        def output(self, *a, **k): return self
+        def run(self, **k): return np.full((32, 32, 3), 128, np.uint8).tobytes(), b''
+    monkeypatch.setattr(video.ffmpeg, 'input', FakeStream)
+    details = video.thumbnail_details('thumb_x.webp', logger=mock_logger)
+    # 320 variant is missing on disk so it is not advertised
+    assert details['thumb_sizes'] == '160,540'
+    assert decoded == [str(tmp_path / 'thumb_x_160.webp')]
+    assert len(details['thumb_placeholder']) == 4 + 2 * 16
+
+def test_thumbnail_details_decode_error(monkeypatch, tmp_path, mock_logger):
+    monkeypatch.setattr(video, 'get_config', lambda: {'THUMBS_DIR': str(tmp_path)})
+    (tmp_path / 'thumb_x.webp').write_bytes(b'img')
+    def raise_exc(*a, **k): raise Exception('probe fail')
+    monkeypatch.setattr(video.ffmpeg, 'probe', raise_exc)
+    details = video.thumbnail_details('thumb_x.webp', logger=mock_logger)
+    assert details['thumb_placeholder'] is None
+    mock_logger.warning.assert_called()
+
+def test_blurhash_encode_known_values():
+    import numpy as np
+    # A flat image has no AC energy and encodes its colour in the DC term
+    flat = np.full((8, 8, 3), [255, 0, 0], np.uint8)
+    assert video.blurhash_encode(flat, 1, 1) == '00TI:j'
+    pixels = np.zeros((32, 32, 3), np.uint8)
+    pixels[:, 16:] = 255
+    result = video.blurhash_encode(pixels)
+    assert len(result) == 4 + 2 * 16
+    assert result[0] == video.BASE83_CHARS[3 + 3 * 9]
 
 def test_process_thumbnail_ffmpeg_error(monkeypatch, mock_config, mock_logger):
     fake_probe = {'streams': [{'codec_type': 'video', 'width': 100, 'height': 80}]}
@@ -95,7 +189,9 @@ def test_process_thumbnail_ffmpeg_error(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
     monkeypatch.setattr(video.ffmpeg, 'input', lambda *a, **k: 'stream')
     monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
-    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, vframes: (s, p, vframes))
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: (s, p))
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *outputs: list(outputs))
     class FakeFFmpegError(video.ffmpeg.Error):
         def __init__(self):
             self.stderr = b'fail'
@@ -124,7 +220,9 @@ def test_process_thumbnail_ffmpeg_error_block(monkeypatch, mock_config, mock_log
     monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
     monkeypatch.setattr(video.ffmpeg, 'input', lambda *a, **k: 'stream')
     monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
-    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, vframes: (s, p, vframes))
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: (s, p))
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *outputs: list(outputs))
     class FakeFFmpegError(video.ffmpeg.Error):
         def __init__(self):
             self.stderr = b'fail'
@@ -356,9 +454,8 @@ def test_process_video_generic_exception(monkeypatch, mock_config, mock_logger):
     monkeypatch.setattr(video.ffmpeg, 'input', lambda x: x)
     monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
     monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p: (s, p))
-    def raise_exc(*a, **k): raise Exception('fail')
     monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
-    monkeypatch.setattr(video.shutil, 'move', raise_exc)
+    failing_commit(monkeypatch)
     with pytest.raises(Exception):
         video.process_video('input.mp4', logger=mock_logger)
     with pytest.raises(Exception):
@@ -378,4 +475,228 @@ def test_generate_video_outer_exception_no_logger(monkeypatch, mock_config):
     def raise_exc(*a, **k): raise Exception('outer fail')
     monkeypatch.setattr(video.requests, 'post', raise_exc)
     with pytest.raises(Exception):
-        video.generate_video('prompt', filename='file.mp4', luma_extend=False, logger=None) 
\ No newline at end of file
+        video.generate_video('prompt', filename='file.mp4', luma_extend=False, logger=None) 
+
+
+def test_score_frames_prefers_sharp_well_exposed_colorful():
+    import numpy as np
+    rng = np.random.default_rng(0)
+    dark = np.full((32, 32, 3), 5, np.uint8)
+    flat_grey = np.full((32, 32, 3), 128, np.uint8)
+    detailed = rng.integers(40, 220, (32, 32, 3), dtype=np.uint8)
+    scores = video.score_frames(np.stack([dark, flat_grey, detailed]))
+    assert scores.argmax() == 2
+    assert scores[0] < scores[1]
+
+def test_select_thumbnail_time(monkeypatch, mock_logger):
+    import numpy as np
+    monkeypatch.setattr(video, 'get_config', lambda: {'THUMBNAIL_SAMPLE_FRAMES': 4})
+    size = video.FRAME_SAMPLE_SIZE
+    frames = np.full((4, size, size, 3), 128, np.uint8)
+    frames[0] = 0  # black fade-in
+    frames[2] = np.random.default_rng(1).integers(30, 230, (size, size, 3), dtype=np.uint8)
+    calls = []
+    class FakeStream:
+        def __init__(self, path): calls.append(path)
+        def filter(self, name, *a): calls.append((name, a)); return self
+        def output(self, *a, **k): return self
+        def run(self, **k): return frames.tobytes(), b''
+    monkeypatch.setattr(video.ffmpeg, 'input', FakeStream)
+    best = video.select_thumbnail_time('video.mp4', 8.0, (540, 10, 0), logger=mock_logger)
+    # Frame 3 of 4 at 0.5 fps
+    assert best == pytest.approx(4.0)
+    assert ('crop', (540, 540, 10, 0)) in calls
+    assert any('Selected thumbnail frame' in str(c[0][0]) for c in mock_logger.info.call_args_list)
+
+def test_select_thumbnail_time_without_duration(monkeypatch):
+    monkeypatch.setattr(video, 'get_config', lambda: {})
+    assert video.select_thumbnail_time('video.mp4', 0, (10, 0, 0)) is None
+
+def test_process_thumbnail_seeks_to_best_frame(monkeypatch, mock_config, mock_logger):
+    fake_probe = {'streams': [{'codec_type': 'video', 'width': 100, 'height': 80, 'duration': '5.0'}]}
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda x: fake_probe)
+    monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
+    monkeypatch.setattr(video, 'select_thumbnail_time', lambda path, duration, crop, logger: 2.5)
+    seeks = []
+    monkeypatch.setattr(video.ffmpeg, 'input', lambda path, ss: seeks.append(ss) or 'stream')
+    monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: (s, p))
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *o: o)
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
+    video.process_thumbnail('video.mp4', logger=mock_logger)
+    assert seeks == [2.5]
+
+def test_process_thumbnail_best_frame_failure_falls_back(monkeypatch, mock_config, mock_logger):
+    fake_probe = {'streams': [{'codec_type': 'video', 'width': 100, 'height': 80, 'duration': '5.0'}]}
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda x: fake_probe)
+    monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
+    def raise_exc(*a, **k): raise Exception('decode fail')
+    monkeypatch.setattr(video, 'select_thumbnail_time', raise_exc)
+    seeks = []
+    monkeypatch.setattr(video.ffmpeg, 'input', lambda path, ss: seeks.append(ss) or 'stream')
+    monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, *a, **k: s)
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: (s, p))
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *o: o)
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
+    video.process_thumbnail('video.mp4', logger=mock_logger)
+    assert seeks == [1]
+    mock_logger.warning.assert_called()
+
+def test_preview_filenames():
+    assert video.preview_filenames('generated_1.mp4') == ('preview_generated_1.mp4', 'sprite_generated_1.webp')
+
+def test_process_previews_single_pass(monkeypatch, mock_logger):
+    monkeypatch.setattr(video, 'get_config', lambda: {'PREVIEWS_DIR': '/previews', 'PREVIEW_DURATION': 2, 'PREVIEW_SIZE': 200})
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda x: {'streams': [{'codec_type': 'video', 'duration': '5.0'}]})
+    monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
+    monkeypatch.setattr(video.ffmpeg, 'input', lambda path: 'stream')
+    filters = []
+    monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, name, *a, **k: filters.append((name, a, k)) or s)
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    outputs = []
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda s, p, **k: outputs.append(p) or p)
+    monkeypatch.setattr(video.ffmpeg, 'merge_outputs', lambda *o: o)
+    runs = []
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda o, **k: runs.append(o))
+    result = video.process_previews('video.mp4', 'preview_x.mp4', 'sprite_x.webp', logger=mock_logger)
+    assert result == ('preview_x.mp4', 'sprite_x.webp')
+    assert runs == [('/previews/preview_x.mp4', '/previews/sprite_x.webp')]
+    assert ('trim', (), {'duration': 2.0}) in filters
+    assert ('fps', (video.SPRITE_COLUMNS * video.SPRITE_ROWS / 5.0,), {}) in filters
+    assert ('tile', (f"{video.SPRITE_COLUMNS}x{video.SPRITE_ROWS}",), {}) in filters
+
+def test_process_previews_without_duration(monkeypatch, mock_logger):
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda x: {'streams': [{'codec_type': 'video'}], 'format': {}})
+    with pytest.raises(Exception):
+        video.process_previews('video.mp4', 'p.mp4', 's.webp', logger=mock_logger)
+    mock_logger.error.assert_called()
+
+def test_generate_previews(monkeypatch, tmp_path, mock_logger):
+    monkeypatch.setattr(video, 'get_config', lambda: {'VIDEOS_DIR': str(tmp_path)})
+    assert video.generate_previews('missing.mp4') == {'preview_filename': None, 'sprite_filename': None}
+    (tmp_path / 'dream.mp4').write_bytes(b'v')
+    monkeypatch.setattr(video, 'process_previews', lambda path, p, s, logger=None: (p, s))
+    assert video.generate_previews('dream.mp4', logger=mock_logger) == {
+        'preview_filename': 'preview_dream.mp4', 'sprite_filename': 'sprite_dream.webp'
+    }
+    def raise_exc(*a, **k): raise Exception('fail')
+    monkeypatch.setattr(video, 'process_previews', raise_exc)
+    assert video.generate_previews('dream.mp4', logger=mock_logger)['preview_filename'] is None
+    mock_logger.warning.assert_called()
+
+def test_stream_renditions(monkeypatch):
+    monkeypatch.setattr(video, 'get_config', lambda: {'STREAMING_RENDITIONS': '240:350,540:1500,360:700'})
+    assert video._stream_renditions(540) == [(540, 1500), (360, 700), (240, 350)]
+    assert video._stream_renditions(400) == [(360, 700), (240, 350)]
+    assert video._stream_renditions(200) == [(200, 350)]
+
+def test_package_stream(monkeypatch, mock_logger):
+    monkeypatch.setattr(video, 'get_config', lambda: {'STREAMS_DIR': '/streams', 'STREAMING_RENDITIONS': '540:1500,360:700'})
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda x: {'streams': [{'codec_type': 'video', 'height': 540}]})
+    monkeypatch.setattr(video.os, 'makedirs', lambda d, exist_ok: None)
+    monkeypatch.setattr(video.ffmpeg, 'input', lambda path: 'stream')
+    monkeypatch.setattr(video.ffmpeg, 'filter_multi_output', lambda s, name, n: [s] * n)
+    monkeypatch.setattr(video.ffmpeg, 'filter', lambda s, name, *a: a)
+    outputs = []
+    monkeypatch.setattr(video.ffmpeg, 'output', lambda *a, **k: outputs.append((a, k)) or 'out')
+    monkeypatch.setattr(video.ffmpeg, 'run', lambda *a, **k: None)
+    assert video.package_stream('dream.mp4', 'dream', logger=mock_logger) == 'dream/master.m3u8'
+    (args, options), = outputs
+    assert args == ((-2, 540), (-2, 360), '/streams/dream/v%v/index.m3u8')
+    assert options['var_stream_map'] == 'v:0 v:1'
+    assert options['b:v:0'] == '1500k' and options['b:v:1'] == '700k'
+    assert options['master_pl_name'] == 'master.m3u8'
+
+def test_package_stream_error(monkeypatch, mock_logger):
+    def raise_exc(*a, **k): raise Exception('probe fail')
+    monkeypatch.setattr(video.ffmpeg, 'probe', raise_exc)
+    with pytest.raises(Exception):
+        video.package_stream('dream.mp4', 'dream', logger=mock_logger)
+    mock_logger.error.assert_called()
+
+def test_generate_stream(monkeypatch, tmp_path, mock_logger):
+    config = {'VIDEOS_DIR': str(tmp_path), 'STREAMING_ENABLED': False}
+    monkeypatch.setattr(video, 'get_config', lambda: config)
+    (tmp_path / 'dream.mp4').write_bytes(b'v')
+    monkeypatch.setattr(video, 'package_stream', lambda path, name, logger=None: f"{name}/master.m3u8")
+    # Disabled by default
+    assert video.generate_stream('dream.mp4') is None
+    config['STREAMING_ENABLED'] = True
+    assert video.generate_stream('dream.mp4') == 'dream/master.m3u8'
+    assert video.generate_stream('missing.mp4') is None
+    def raise_exc(*a, **k): raise Exception('fail')
+    monkeypatch.setattr(video, 'package_stream', raise_exc)
+    assert video.generate_stream('dream.mp4', logger=mock_logger) is None
+    mock_logger.warning.assert_called()
+
+def test_probe_video_probes_each_file_version_once(monkeypatch, tmp_path):
+    video._cached_probe.cache_clear()
+    path = tmp_path / 'v.mp4'
+    path.write_bytes(b'one')
+    probe = mock.Mock(return_value={'streams': []})
+    monkeypatch.setattr(video.ffmpeg, 'probe', probe)
+    video.probe_video(str(path))
+    video.probe_video(str(path))
+    assert probe.call_count == 1
+    # Rewriting the file invalidates the cached probe
+    path.write_bytes(b'longer')
+    video.probe_video(str(path))
+    assert probe.call_count == 2
+    # Missing files are not cached
+    video.probe_video(str(tmp_path / 'missing.mp4'))
+    video.probe_video(str(tmp_path / 'missing.mp4'))
+    assert probe.call_count == 4
+
+def test_media_metadata(monkeypatch, tmp_path, mock_logger):
+    video._cached_probe.cache_clear()
+    path = tmp_path / 'v.mp4'
+    path.write_bytes(b'x' * 10)
+    monkeypatch.setattr(video.ffmpeg, 'probe', lambda p: {
+        'format': {'duration': '5.040000', 'bit_rate': '4000000'},
+        'streams': [{'codec_type': 'audio'}, {'codec_type': 'video', 'codec_name': 'h264', 'width': 1280, 'height': 720}],
+    })
+    assert video.media_metadata(str(path), mock_logger) == {
+        'duration': 5.04, 'width': 1280, 'height': 720, 'bitrate': 4000000, 'video_codec': 'h264', 'file_size': 10,
+    }
+
+def test_media_metadata_is_best_effort(monkeypatch, tmp_path, mock_logger):
+    video._cached_probe.cache_clear()
+    path = tmp_path / 'v.mp4'
+    path.write_bytes(b'x')
+    def raise_exc(p): raise Exception('probe fail')
+    monkeypatch.setattr(video.ffmpeg, 'probe', raise_exc)
+    metadata = video.media_metadata(str(path), mock_logger)
+    assert metadata['file_size'] == 1 and metadata['duration'] is None
+    mock_logger.warning.assert_called()
+    assert video.media_metadata(str(tmp_path / 'missing.mp4'))['file_size'] is None
+
+def test_generate_video_records_spans(monkeypatch, mock_config, mock_logger):
+    from functions.tracing import Trace
+    fake_post = mock.Mock(status_code=200)
+    fake_post.json.return_value = {'id': 'genid'}
+    monkeypatch.setattr(video.requests, 'post', lambda *a, **k: fake_post)
+    states = iter(['queued', 'dreaming', 'completed'])
+    def fake_get(*a, **k):
+        resp = mock.Mock(status_code=200)
+        resp.json.return_value = {'state': next(states, 'completed'), 'assets': {'video': 'http://video.url'}}
+        resp.iter_content = lambda chunk_size: [b'data']
+        resp.raise_for_status = lambda: None
+        return resp
+    monkeypatch.setattr(video.requests, 'get', fake_get)
+    config = dict(video.get_config(), LUMA_MAX_POLL_ATTEMPTS=5)
+    monkeypatch.setattr(video, 'get_config', lambda: config)
+    monkeypatch.setattr(video.time, 'sleep', lambda s: None)
+    monkeypatch.setattr(video, 'process_video', lambda *a, **k: 'processed.mp4')
+    monkeypatch.setattr(video, 'process_thumbnail', lambda *a, **k: 'thumb.png')
+    trace = Trace().start()
+    try:
+        video.generate_video('prompt', filename='file.mp4', logger=mock_logger)
+    finally:
+        trace.stop()
+    assert [span['name'] for span in trace.spans] == [
+        'luma_submit', 'luma_poll', 'luma_poll', 'luma_poll', 'download', 'filter', 'thumbnail',
+    ]
+    assert [span['attrs'].get('state') for span in trace.spans[1:4]] == ['queued', 'dreaming', 'completed']
+    assert trace.spans[1]['attrs']['attempt'] == 1 and trace.spans[4]['attrs']['bytes'] == 4